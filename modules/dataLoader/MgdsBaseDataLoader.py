@@ -1,12 +1,80 @@
 from mgds.MGDS import MGDS
 from mgds.TransformersDataLoaderModules import *
 
+from torch.utils.tensorboard import SummaryWriter
+
+from modules.dataLoader.cache.ShardedDiskCache import ShardedDiskCache
+from modules.dataLoader.cache.TieredRamCache import TieredRamCache
+from modules.dataLoader.generic.LoadPreResizedImage import LoadPreResizedImage
+from modules.dataLoader.generic.ParallelLoad import ParallelLoad
+from modules.dataLoader.stableDiffusion.BatchedEncodeVAE import BatchedEncodeVAE
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
 from modules.util.dtype_util import allow_mixed_precision
 
 
 class MgdsBaseDataLoader:
+    # the names of all models in the model object that calculate cached data
+    caching_model_names = []
+
+    def start_next_epoch(self):
+        self.ds.start_next_epoch()
+
+    def report_cache_statistics(self, tensorboard: SummaryWriter | None, global_step: int):
+        """
+        Writes the statistics of all caches of the dataset to tensorboard
+        """
+        for cache in self.tiered_ram_caches:
+            cache.report(tensorboard, global_step)
+
+    def _cache_settings(self, args: TrainArgs) -> dict:
+        """
+        Returns all settings that change the cached data of a sample, apart from the concept settings
+        """
+        weight_dtypes = args.weight_dtypes()
+
+        return {
+            'model_type': args.model_type,
+            'base_model_name': args.base_model_name,
+            'vae_weight_dtype': weight_dtypes.vae,
+            'train_dtype': args.train_dtype,
+            'resolution': args.resolution,
+            'aspect_ratio_bucketing': args.aspect_ratio_bucketing,
+            'aspect_bucket_planning': args.aspect_bucket_planning,
+            'aspect_bucket_count': args.aspect_bucket_count,
+            'pre_resize_images': args.pre_resize_images,
+            'draft_jpeg_decoding': args.draft_jpeg_decoding,
+            'probe_image_resolution': args.probe_image_resolution,
+            'masked_training': args.masked_training,
+            'circular_mask_generation': args.circular_mask_generation,
+            'random_rotate_and_crop': args.random_rotate_and_crop,
+        }
+
+    def _can_probe_resolution(self, args: TrainArgs) -> bool:
+        """
+        Returns True if the original resolution of each image can be read from the file header. This is not possible if
+        the image is rotated and cropped before the aspect ratio is calculated.
+        """
+        return not (args.random_rotate_and_crop and (args.masked_training or args.model_type.has_mask_input()))
+
+    def _can_pre_resize(self, args: TrainArgs) -> bool:
+        """
+        Returns True if the original resolution is read from the file header, and images are loaded at their scale
+        resolution, optionally from the pre-resized image cache or with reduced scale jpeg decoding. The scale
+        resolution is needed to load an image, so the aspect ratio is calculated before any image is loaded. Probed
+        resolutions and loaded images both apply the exif orientation of the file.
+        """
+        return (args.probe_image_resolution or args.pre_resize_images or args.draft_jpeg_decoding) \
+            and self._can_probe_resolution(args)
+
+    def _cache_output_device(self, args: TrainArgs) -> torch.device | None:
+        """
+        Returns the device of tensors read from the sharded latent cache. If batches are prefetched to the train device,
+        cached tensors stay on the CPU, unless a module after the cache needs them on the train device.
+        """
+        if args.device_prefetch_batches > 0 and not args.debug_mode and not args.model_type.has_mask_input():
+            return torch.device('cpu')
+        return None
 
     def _create_mgds(
             self,
@@ -20,6 +88,29 @@ class MgdsBaseDataLoader:
             "enable_random_mask_rotate_crop": args.random_rotate_and_crop,
         }
 
+        self.tiered_ram_caches = [
+            module for modules in definition if modules is not None
+            for module in modules if isinstance(module, TieredRamCache)
+        ]
+        self.sharded_disk_caches = [
+            module for modules in definition if modules is not None
+            for module in modules if isinstance(module, ShardedDiskCache)
+        ]
+        planning_modules = [
+            module for modules in definition if modules is not None
+            for module in modules if isinstance(module, (BatchedEncodeVAE, ParallelLoad))
+        ]
+        for sharded_disk_cache in self.sharded_disk_caches:
+            sharded_disk_cache.planning_modules = planning_modules
+
+        pre_resized_image_loaders = [
+            module for modules in definition if modules is not None
+            for module in modules if isinstance(module, LoadPreResizedImage)
+        ]
+        for module in planning_modules:
+            if isinstance(module, ParallelLoad):
+                module.prefetch_modules = pre_resized_image_loaders
+
         ds = MGDS(
             torch.device(args.train_device),
             args.train_dtype.torch_dtype(),
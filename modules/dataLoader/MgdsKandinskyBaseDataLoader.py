@@ -8,6 +8,13 @@ from mgds.TransformersDataLoaderModules import *
 
 from modules.dataLoader.kandinsky.KandinskyPrior import KandinskyPrior
 from modules.dataLoader.MgdsBaseDataLoader import MgdsBaseDataLoader
+from modules.dataLoader.cache.ShardedDiskCache import ShardedDiskCache
+from modules.dataLoader.cache.TieredRamCache import TieredRamCache
+from modules.dataLoader.generic.CollectIndexedPaths import CollectIndexedPaths
+from modules.dataLoader.generic.LoadPreResizedImage import LoadPreResizedImage
+from modules.dataLoader.generic.ParallelLoad import ParallelLoad
+from modules.dataLoader.generic.PlannedAspectBucketing import PlannedAspectBucketing
+from modules.dataLoader.generic.ProbeImageResolution import ProbeImageResolution
 from modules.model.KandinskyModel import KandinskyModel
 from modules.util import path_util
 from modules.util.TrainProgress import TrainProgress
@@ -15,6 +22,8 @@ from modules.util.args.TrainArgs import TrainArgs
 
 
 class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
+    caching_model_names = ['movq']
+
     def __init__(
             self,
             args: TrainArgs,
@@ -40,10 +49,19 @@ class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
             concept_in_name='concept', path_in_name='path', name_in_name='name', path_out_name='image_path', concept_out_name='concept',
             extensions=supported_extensions, include_postfix=None, exclude_postfix=['-masklabel'], include_subdirectories_in_name='concept.include_subdirectories'
         )
+        collect_indexed_paths = CollectIndexedPaths(
+            concept_in_name='concept', path_in_name='path', path_out_name='image_path', concept_out_name='concept',
+            include_postfix=None, exclude_postfix=['-masklabel'], include_subdirectories_in_name='concept.include_subdirectories',
+            extensions=supported_extensions, index_dir=os.path.join(args.cache_dir, 'dataset-index'), caption_path_out_name='sample_prompt_path', mask_path_out_name='mask_path' if args.masked_training else None
+        )
 
         mask_path = ModifyPath(in_name='image_path', out_name='mask_path', postfix='-masklabel', extension='.png')
         sample_prompt_path = ModifyPath(in_name='image_path', out_name='sample_prompt_path', postfix='', extension='.txt')
 
+        # the dataset index already provides the caption and mask paths
+        if args.dataset_index:
+            return [collect_indexed_paths]
+
         modules = [collect_paths, sample_prompt_path]
 
         if args.masked_training:
@@ -54,9 +72,11 @@ class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
 
     def _load_input_modules(self, args: TrainArgs, model: KandinskyModel) -> list:
         load_image = LoadImage(path_in_name='image_path', image_out_name='image', range_min=0, range_max=1)
+        load_pre_resized_image = LoadPreResizedImage(path_in_name='image_path', scale_resolution_in_name='scale_resolution', image_out_name='image', range_min=0, range_max=1, cache_dir=os.path.join(args.cache_dir, 'pre-resized') if args.pre_resize_images else None, draft=args.draft_jpeg_decoding or args.pre_resize_images)
 
         generate_mask = GenerateImageLike(image_in_name='image', image_out_name='mask', color=255, range_min=0, range_max=1, channels=1)
         load_mask = LoadImage(path_in_name='mask_path', image_out_name='mask', range_min=0, range_max=1, channels=1)
+        load_pre_resized_mask = LoadPreResizedImage(path_in_name='mask_path', scale_resolution_in_name='scale_resolution', image_out_name='mask', range_min=0, range_max=1, cache_dir=os.path.join(args.cache_dir, 'pre-resized') if args.pre_resize_images else None, draft=args.draft_jpeg_decoding or args.pre_resize_images, channels=1)
 
         load_sample_prompts = LoadMultipleTexts(path_in_name='sample_prompt_path', texts_out_name='sample_prompts')
         load_concept_prompts = LoadMultipleTexts(path_in_name='concept.prompt_path', texts_out_name='concept_prompts')
@@ -68,11 +88,11 @@ class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
         }, default_in_name='sample_prompts')
         select_random_text = SelectRandomText(texts_in_name='prompts', text_out_name='prompt')
 
-        modules = [load_image, load_sample_prompts, load_concept_prompts, filename_prompt, select_prompt_input, select_random_text]
+        modules = [load_pre_resized_image if self._can_pre_resize(args) else load_image, load_sample_prompts, load_concept_prompts, filename_prompt, select_prompt_input, select_random_text]
 
         if args.masked_training:
             modules.append(generate_mask)
-            modules.append(load_mask)
+            modules.append(load_pre_resized_mask if self._can_pre_resize(args) else load_mask)
         elif args.model_type.has_mask_input():
             modules.append(generate_mask)
 
@@ -101,6 +121,7 @@ class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
 
     def _aspect_bucketing_in(self, args: TrainArgs):
         calc_aspect = CalcAspect(image_in_name='image', resolution_out_name='original_resolution')
+        probe_resolution = ProbeImageResolution(path_in_name='image_path', concept_in_name='concept', resolution_out_name='original_resolution', index_dir=os.path.join(args.cache_dir, 'dataset-index') if args.dataset_index else None)
 
         aspect_bucketing = AspectBucketing(
             target_resolution=args.resolution,
@@ -111,6 +132,17 @@ class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
             possible_resolutions_out_name='possible_resolutions'
         )
 
+        planned_aspect_bucketing = PlannedAspectBucketing(
+            target_resolution=args.resolution,
+            quantization=64,
+            max_buckets=args.aspect_bucket_count,
+            min_bucket_size=args.batch_size,
+            resolution_in_name='original_resolution',
+            scale_resolution_out_name='scale_resolution',
+            crop_resolution_out_name='crop_resolution',
+            possible_resolutions_out_name='possible_resolutions'
+        )
+
         single_aspect_calculation = SingleAspectCalculation(
             target_resolution=args.resolution,
             resolution_in_name='original_resolution',
@@ -119,9 +151,11 @@ class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
             possible_resolutions_out_name='possible_resolutions'
         )
 
-        modules = [calc_aspect]
+        modules = [probe_resolution if self._can_pre_resize(args) else calc_aspect]
 
-        if args.aspect_ratio_bucketing:
+        if args.aspect_ratio_bucketing and args.aspect_bucket_planning:
+            modules.append(planned_aspect_bucketing)
+        elif args.aspect_ratio_bucketing:
             modules.append(aspect_bucketing)
         else:
             modules.append(single_aspect_calculation)
@@ -186,6 +220,29 @@ class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
         return modules
 
 
+    def _parallel_load_modules(self, args: TrainArgs):
+        names = ['image', 'prompt']
+        passthrough_names = ['crop_resolution', 'possible_resolutions', 'image_path', 'concept']
+
+        if args.masked_training or args.model_type.has_mask_input():
+            names.append('mask')
+
+        if args.model_type.has_conditioning_image_input():
+            names.append('conditioning_image')
+
+        if args.model_type.has_depth_input():
+            names.append('depth')
+
+        parallel_load = ParallelLoad(names=names, num_workers=args.dataloader_threads, prefetch_items=args.dataloader_prefetch_batches * args.batch_size, passthrough_names=passthrough_names)
+
+        modules = []
+
+        if args.dataloader_threads > 0:
+            modules.append(parallel_load)
+
+        return modules
+
+
     def _preparation_modules(self, args: TrainArgs, model: KandinskyModel):
         rescale_image = RescaleImageChannels(image_in_name='image', image_out_name='image', in_range_min=0, in_range_max=1, out_range_min=-1, out_range_max=1)
         rescale_conditioning_image = RescaleImageChannels(image_in_name='conditioning_image', image_out_name='conditioning_image', in_range_min=0, in_range_max=1, out_range_min=-1, out_range_max=1)
@@ -226,12 +283,18 @@ class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
         aggregate_names = ['crop_resolution', 'image_path']
 
         disk_cache = DiskCache(cache_dir=args.cache_dir, split_names=split_names, aggregate_names=aggregate_names, cached_epochs=args.latent_caching_epochs)
+        sharded_disk_cache = ShardedDiskCache(cache_dir=args.cache_dir, split_names=split_names, aggregate_names=aggregate_names, cached_epochs=args.latent_caching_epochs, settings=self._cache_settings(args), device=self._cache_output_device(args), key_names=['crop_resolution'] if args.aspect_ratio_bucketing and args.aspect_bucket_planning else None, distribution_mode='mean' if args.latent_cache_mean_only else None, distribution_dtype=args.latent_cache_dtype.torch_dtype(), compression='zstd' if args.latent_cache_compression else None)
         ram_cache = RamCache(names=split_names + aggregate_names)
+        tiered_ram_cache = TieredRamCache(names=split_names + aggregate_names, max_ram_bytes=int(args.ram_cache_budget_gb * (1 << 30)), spill_dir=os.path.join(args.cache_dir, 'ram-cache-spill'), distribution_dtype=args.ram_cache_dtype.torch_dtype(), device=self._cache_output_device(args))
 
         modules = []
 
-        if args.latent_caching:
+        if args.latent_caching and args.sharded_latent_cache:
+            modules.append(sharded_disk_cache)
+        elif args.latent_caching:
             modules.append(disk_cache)
+        elif args.ram_cache_budget_gb > 0 or args.ram_cache_dtype.torch_dtype() is not None:
+            modules.append(tiered_ram_cache)
         else:
             modules.append(ram_cache)
 
@@ -322,23 +385,29 @@ class MgdsKandinskyBaseDataLoader(MgdsBaseDataLoader):
         crop_modules = self._crop_modules(args)
         augmentation_modules = self._augmentation_modules(args)
         inpainting_modules = self._inpainting_modules(args)
+        parallel_load_modules = self._parallel_load_modules(args)
         preparation_modules = self._preparation_modules(args, model)
         cache_modules = self._cache_modules(args)
         output_modules = self._output_modules(args, model)
 
         debug_modules = self._debug_modules(args, model)
 
+        pre_resize = self._can_pre_resize(args)
+
         return self._create_mgds(
             args,
             concepts,
             [
                 enumerate_input,
+                # with pre-resized images, the scale resolution is calculated before the images are loaded
+                aspect_bucketing_in if pre_resize else None,
                 load_input,
                 mask_augmentation,
-                aspect_bucketing_in,
+                aspect_bucketing_in if not pre_resize else None,
                 crop_modules,
                 augmentation_modules,
                 inpainting_modules,
+                parallel_load_modules,
                 preparation_modules,
                 cache_modules,
                 output_modules,
@@ -6,6 +6,14 @@ from mgds.GenericDataLoaderModules import *
 from mgds.MGDS import MGDS, TrainDataLoader, OutputPipelineModule
 
 from modules.dataLoader.MgdsBaseDataLoader import MgdsBaseDataLoader
+from modules.dataLoader.cache.ShardedDiskCache import ShardedDiskCache
+from modules.dataLoader.cache.TieredRamCache import TieredRamCache
+from modules.dataLoader.generic.CollectIndexedPaths import CollectIndexedPaths
+from modules.dataLoader.generic.LoadPreResizedImage import LoadPreResizedImage
+from modules.dataLoader.generic.ParallelLoad import ParallelLoad
+from modules.dataLoader.generic.PlannedAspectBucketing import PlannedAspectBucketing
+from modules.dataLoader.generic.ProbeImageResolution import ProbeImageResolution
+from modules.dataLoader.stableDiffusion.BatchedEncodeVAE import BatchedEncodeVAE
 from modules.model.StableDiffusionModel import StableDiffusionModel
 from modules.util import path_util
 from modules.util.TrainProgress import TrainProgress
@@ -13,6 +21,8 @@ from modules.util.args.TrainArgs import TrainArgs
 
 
 class MgdsStableDiffusionFineTuneVaeDataLoader(MgdsBaseDataLoader):
+    caching_model_names = ['vae']
+
     def __init__(
             self,
             args: TrainArgs,
@@ -39,9 +49,18 @@ class MgdsStableDiffusionFineTuneVaeDataLoader(MgdsBaseDataLoader):
             concept_out_name='concept', extensions=supported_extensions, include_postfix=None,
             exclude_postfix=['-masklabel'], include_subdirectories_in_name='concept.include_subdirectories'
         )
+        collect_indexed_paths = CollectIndexedPaths(
+            concept_in_name='concept', path_in_name='path', path_out_name='image_path', concept_out_name='concept',
+            include_postfix=None, exclude_postfix=['-masklabel'], include_subdirectories_in_name='concept.include_subdirectories',
+            extensions=supported_extensions, index_dir=os.path.join(args.cache_dir, 'dataset-index'), mask_path_out_name='mask_path' if args.masked_training else None
+        )
 
         mask_path = ModifyPath(in_name='image_path', out_name='mask_path', postfix='-masklabel', extension='.png')
 
+        # the dataset index already provides the mask paths
+        if args.dataset_index:
+            return [collect_indexed_paths]
+
         modules = [collect_paths]
 
         if args.masked_training:
@@ -52,12 +71,16 @@ class MgdsStableDiffusionFineTuneVaeDataLoader(MgdsBaseDataLoader):
 
     def __load_input_modules(self, args: TrainArgs) -> list:
         load_image = LoadImage(path_in_name='image_path', image_out_name='image', range_min=-1.0, range_max=1.0)
+        load_pre_resized_image = LoadPreResizedImage(path_in_name='image_path', scale_resolution_in_name='scale_resolution', image_out_name='image', range_min=-1.0, range_max=1.0, cache_dir=os.path.join(args.cache_dir, 'pre-resized') if args.pre_resize_images else None, draft=args.draft_jpeg_decoding or args.pre_resize_images)
         load_mask = LoadImage(path_in_name='mask_path', image_out_name='mask', range_min=0, range_max=1, channels=1)
+        load_pre_resized_mask = LoadPreResizedImage(path_in_name='mask_path', scale_resolution_in_name='scale_resolution', image_out_name='mask', range_min=0, range_max=1, cache_dir=os.path.join(args.cache_dir, 'pre-resized') if args.pre_resize_images else None, draft=args.draft_jpeg_decoding or args.pre_resize_images, channels=1)
 
-        modules = [load_image]
+        pre_resize = self._can_pre_resize(args) and args.aspect_ratio_bucketing
+
+        modules = [load_pre_resized_image if pre_resize else load_image]
 
         if args.masked_training:
-            modules.append(load_mask)
+            modules.append(load_pre_resized_mask if pre_resize else load_mask)
 
         return modules
 
@@ -79,6 +102,7 @@ class MgdsStableDiffusionFineTuneVaeDataLoader(MgdsBaseDataLoader):
 
     def __aspect_bucketing_in(self, args: TrainArgs):
         calc_aspect = CalcAspect(image_in_name='image', resolution_out_name='original_resolution')
+        probe_resolution = ProbeImageResolution(path_in_name='image_path', concept_in_name='concept', resolution_out_name='original_resolution', index_dir=os.path.join(args.cache_dir, 'dataset-index') if args.dataset_index else None)
         aspect_bucketing = AspectBucketing(
             target_resolution=args.resolution,
             quantization=8,
@@ -88,11 +112,25 @@ class MgdsStableDiffusionFineTuneVaeDataLoader(MgdsBaseDataLoader):
             possible_resolutions_out_name='possible_resolutions'
         )
 
+        planned_aspect_bucketing = PlannedAspectBucketing(
+            target_resolution=args.resolution,
+            quantization=8,
+            max_buckets=args.aspect_bucket_count,
+            min_bucket_size=args.batch_size,
+            resolution_in_name='original_resolution',
+            scale_resolution_out_name='scale_resolution',
+            crop_resolution_out_name='crop_resolution',
+            possible_resolutions_out_name='possible_resolutions'
+        )
+
         modules = []
 
         if args.aspect_ratio_bucketing:
-            modules.append(calc_aspect)
-            modules.append(aspect_bucketing)
+            modules.append(probe_resolution if self._can_pre_resize(args) else calc_aspect)
+            if args.aspect_bucket_planning:
+                modules.append(planned_aspect_bucketing)
+            else:
+                modules.append(aspect_bucketing)
 
         return modules
 
@@ -128,8 +166,25 @@ class MgdsStableDiffusionFineTuneVaeDataLoader(MgdsBaseDataLoader):
         return modules
 
 
+    def __parallel_load_modules(self, args: TrainArgs):
+        names = ['image']
+        passthrough_names = ['crop_resolution', 'possible_resolutions', 'image_path', 'concept']
+
+        if args.masked_training:
+            names.append('mask')
+
+        parallel_load = ParallelLoad(names=names, num_workers=args.dataloader_threads, prefetch_items=args.dataloader_prefetch_batches * args.batch_size, passthrough_names=passthrough_names)
+
+        modules = []
+
+        if args.dataloader_threads > 0:
+            modules.append(parallel_load)
+
+        return modules
+
+
     def __preparation_modules(self, args: TrainArgs, model: StableDiffusionModel):
-        image = EncodeVAE(in_name='image', out_name='latent_image_distribution', vae=model.vae)
+        image = BatchedEncodeVAE(in_name='image', out_name='latent_image_distribution', vae=model.vae, batch_size=args.vae_batch_size)
         mask = Downscale(in_name='mask', out_name='latent_mask', factor=8)
 
         modules = [image]
@@ -150,12 +205,18 @@ class MgdsStableDiffusionFineTuneVaeDataLoader(MgdsBaseDataLoader):
 
         disk_cache = DiskCache(cache_dir=args.cache_dir, split_names=split_names, aggregate_names=aggregate_names,
                                cached_epochs=args.latent_caching_epochs)
+        sharded_disk_cache = ShardedDiskCache(cache_dir=args.cache_dir, split_names=split_names, aggregate_names=aggregate_names, cached_epochs=args.latent_caching_epochs, settings=self._cache_settings(args), device=self._cache_output_device(args), key_names=['crop_resolution'] if args.aspect_ratio_bucketing and args.aspect_bucket_planning else None, distribution_mode='mean' if args.latent_cache_mean_only else None, distribution_dtype=args.latent_cache_dtype.torch_dtype(), compression='zstd' if args.latent_cache_compression else None)
         ram_cache = RamCache(names=split_names + aggregate_names)
+        tiered_ram_cache = TieredRamCache(names=split_names + aggregate_names, max_ram_bytes=int(args.ram_cache_budget_gb * (1 << 30)), spill_dir=os.path.join(args.cache_dir, 'ram-cache-spill'), distribution_dtype=args.ram_cache_dtype.torch_dtype(), device=self._cache_output_device(args))
 
         modules = []
 
-        if args.latent_caching:
+        if args.latent_caching and args.sharded_latent_cache:
+            modules.append(sharded_disk_cache)
+        elif args.latent_caching:
             modules.append(disk_cache)
+        elif args.ram_cache_budget_gb > 0 or args.ram_cache_dtype.torch_dtype() is not None:
+            modules.append(tiered_ram_cache)
         else:
             modules.append(ram_cache)
 
@@ -196,6 +257,7 @@ class MgdsStableDiffusionFineTuneVaeDataLoader(MgdsBaseDataLoader):
         aspect_bucketing_in = self.__aspect_bucketing_in(args)
         crop_modules = self.__crop_modules(args)
         augmentation_modules = self.__augmentation_modules(args)
+        parallel_load_modules = self.__parallel_load_modules(args)
         preparation_modules = self.__preparation_modules(args, model)
         cache_modules = self.__cache_modules(args)
         output_modules = self.__output_modules(args)
@@ -210,16 +272,21 @@ class MgdsStableDiffusionFineTuneVaeDataLoader(MgdsBaseDataLoader):
             # SaveImage(image_in_name='latent_mask', original_path_in_name='image_path', path=debug_dir, in_range_min=0, in_range_max=1),
         ]
 
+        pre_resize = self._can_pre_resize(args) and args.aspect_ratio_bucketing
+
         return self._create_mgds(
             args,
             concepts,
             [
                 enumerate_input,
+                # with pre-resized images, the scale resolution is calculated before the images are loaded
+                aspect_bucketing_in if pre_resize else None,
                 load_input,
                 mask_augmentation,
-                aspect_bucketing_in,
+                aspect_bucketing_in if not pre_resize else None,
                 crop_modules,
                 augmentation_modules,
+                parallel_load_modules,
                 preparation_modules,
                 cache_modules,
                 output_modules,
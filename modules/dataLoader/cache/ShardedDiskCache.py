@@ -0,0 +1,428 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import time
+import uuid
+
+import numpy as np
+import torch
+from diffusers.models.vae import DiagonalGaussianDistribution
+from mgds.MGDS import PipelineModule
+from tqdm import tqdm
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ShardedDiskCache(PipelineModule):
+    """
+    Caches the outputs of previous modules on disk, like the mgds DiskCache.
+
+    Instead of writing one file per item, all tensors of a concept are packed into a few large shard files. An index
+    stores the shard, offset, dtype and shape of each tensor, together with all non-tensor values. While reading, each
+    shard is memory mapped once, and tensors are returned as views into the mapped memory. VAE distributions are stored
+    as their parameter tensor.
+
+    Distributions can be stored in a compact format: if distribution_mode is 'mean', only the mean is stored, and a
+    deterministic distribution is returned. If distribution_dtype is set, the tensor is stored in that data type, and
+    converted back to its original data type while reading. With compression='zstd', the bytes of each of these tensors
+    are compressed. Compressed tensors are copied out of the mapped memory while reading. Each storage format has its
+    own cache directories.
+
+    Every cache entry is addressed by a hash of the source file path, the file content, the concept settings, the
+    global settings and the values of all key_names. When an epoch is started, the cache is reconciled with the dataset: only new or changed items are
+    calculated, and entries that are no longer used are removed. Each concept has its own shards, so changing one
+    concept does not touch the cache of any other concept.
+    """
+
+    # byte alignment of every tensor inside a shard
+    ALIGNMENT = 64
+
+    # a concept is compacted if less than this fraction of its shard bytes is still in use
+    MIN_LIVE_FRACTION = 0.5
+
+    def __init__(
+            self,
+            cache_dir: str,
+            split_names: list[str] | None = None,
+            aggregate_names: list[str] | None = None,
+            cached_epochs: int = 1,
+            max_shard_size: int = 1 << 30,
+            path_in_name: str = 'image_path',
+            concept_in_name: str = 'concept',
+            settings: dict | None = None,
+            device: torch.device | None = None,
+            key_names: list[str] | None = None,
+            distribution_mode: str | None = None,
+            distribution_dtype: torch.dtype | None = None,
+            compression: str | None = None,
+            max_duty_cycle: float = 1.0,
+    ):
+        super(ShardedDiskCache, self).__init__()
+        self.cache_dir = cache_dir
+        self.split_names = [] if split_names is None else split_names
+        self.aggregate_names = [] if aggregate_names is None else aggregate_names
+        self.cached_epochs = max(1, cached_epochs)
+        self.max_shard_size = max_shard_size
+        self.path_in_name = path_in_name
+        self.concept_in_name = concept_in_name
+        self.settings = json.dumps({} if settings is None else settings, sort_keys=True, default=str)
+        # device of the returned tensors, defaults to the device of the pipeline
+        self.device = device
+        # names of previous items that change the cached data, but are not part of the settings
+        self.key_names = [] if key_names is None else key_names
+
+        if compression == 'zstd' and zstandard is None:
+            print("the zstandard package is not installed, the latent cache is stored without compression")
+            compression = None
+        self.distribution_mode = distribution_mode
+        self.distribution_dtype = distribution_dtype
+        self.compression = compression
+        self.storage_format = json.dumps([distribution_mode, str(distribution_dtype), compression])
+        # the fraction of time spent calculating new items, the rest of the time is spent waiting
+        self.max_duty_cycle = max_duty_cycle
+
+        # modules before the cache that are told which indices are calculated, see BatchedEncodeVAE.plan_indices
+        self.planning_modules = []
+
+        # (concept directory, entries) for each item of the current epoch
+        self.items = None
+        self.shards = {}
+
+    def length(self) -> int:
+        if self.items is None:
+            return self.get_previous_length(self.split_names[0])
+        return len(self.items)
+
+    def get_inputs(self) -> list[str]:
+        return self.split_names + self.aggregate_names + [self.path_in_name, self.concept_in_name] + self.key_names
+
+    def get_outputs(self) -> list[str]:
+        return self.split_names + self.aggregate_names
+
+    def __get_cache_dir(self, variation: int) -> str:
+        return os.path.join(self.cache_dir, f"epoch-{variation}-shards")
+
+    @staticmethod
+    def __hash(data: str) -> str:
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @staticmethod
+    def __align(offset: int) -> int:
+        return (offset + ShardedDiskCache.ALIGNMENT - 1) // ShardedDiskCache.ALIGNMENT * ShardedDiskCache.ALIGNMENT
+
+    @staticmethod
+    def __get_index_path(concept_dir: str) -> str:
+        return os.path.join(concept_dir, "index.pt")
+
+    @staticmethod
+    def __get_shard_path(concept_dir: str, shard: int) -> str:
+        return os.path.join(concept_dir, f"shard-{shard}.bin")
+
+    @staticmethod
+    def __list_shards(concept_dir: str) -> list[int]:
+        shards = []
+        for filename in os.listdir(concept_dir):
+            match = re.fullmatch(r"shard-(\d+)\.bin", filename)
+            if match:
+                shards.append(int(match.group(1)))
+        return shards
+
+    @staticmethod
+    def __save_atomic(data, path: str):
+        # several caches can write the same file at the same time, each one uses its own temporary file
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        torch.save(data, temp_path)
+        os.replace(temp_path, path)
+
+    def __content_hashes(self, concept_id: str, paths: list[str]) -> dict[str, str]:
+        """
+        Returns a hash of the content of each file. Hashes are stored in the cache, and only recalculated if the
+        modification time or the size of a file changed.
+        """
+        manifest_path = os.path.join(self.cache_dir, "content-hashes", f"concept-{concept_id}.pt")
+        manifest = torch.load(manifest_path) if os.path.isfile(manifest_path) else {}
+
+        content_hashes = {}
+        updated_manifest = {}
+        for path in paths:
+            stat = os.stat(path)
+            manifest_entry = manifest.get(path)
+            if manifest_entry is None or manifest_entry[0] != stat.st_mtime_ns or manifest_entry[1] != stat.st_size:
+                sha = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        sha.update(chunk)
+                manifest_entry = (stat.st_mtime_ns, stat.st_size, sha.hexdigest())
+            updated_manifest[path] = manifest_entry
+            content_hashes[path] = manifest_entry[2]
+
+        if updated_manifest != manifest:
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            self.__save_atomic(updated_manifest, manifest_path)
+
+        return content_hashes
+
+    def __write_entries(
+            self,
+            concept_dir: str,
+            first_shard: int,
+            values,
+    ) -> tuple[dict[str, dict], int]:
+        """
+        Writes the tensors of all (key, item) pairs into new shards, starting at first_shard
+
+        Returns:
+            the index entries of all written items, and the next unused shard number
+        """
+        entries = {}
+        shard = first_shard
+        shard_file = None
+        offset = 0
+
+        try:
+            for key, item in values:
+                item_entries = {}
+                for name, value in item.items():
+                    kind = 'tensor'
+                    codec = None
+                    if isinstance(value, DiagonalGaussianDistribution):
+                        if self.distribution_mode == 'mean':
+                            kind = 'distribution_mean'
+                            value = value.mean
+                        else:
+                            kind = 'distribution'
+                            value = value.parameters
+                    elif not isinstance(value, torch.Tensor):
+                        item_entries[name] = ('value', value)
+                        continue
+
+                    original_dtype = value.dtype
+                    if kind != 'tensor':
+                        if self.distribution_dtype is not None:
+                            value = value.to(self.distribution_dtype)
+                        codec = self.compression
+
+                    data = value.detach().contiguous().cpu().flatten().view(torch.uint8).numpy()
+                    if codec == 'zstd':
+                        data = np.frombuffer(zstandard.ZstdCompressor().compress(data.tobytes()), dtype=np.uint8)
+
+                    if shard_file is None or (offset > 0 and offset + data.nbytes > self.max_shard_size):
+                        if shard_file is not None:
+                            shard_file.close()
+                            shard += 1
+                        shard_file = open(self.__get_shard_path(concept_dir, shard), "wb")
+                        offset = 0
+
+                    aligned_offset = self.__align(offset)
+                    shard_file.write(bytes(aligned_offset - offset))
+                    shard_file.write(data.tobytes())
+                    offset = aligned_offset + data.nbytes
+
+                    item_entries[name] = (
+                        kind, shard, aligned_offset, str(value.dtype).removeprefix('torch.'), tuple(value.shape),
+                        data.nbytes, codec, str(original_dtype).removeprefix('torch.'),
+                    )
+                entries[key] = item_entries
+        finally:
+            if shard_file is not None:
+                shard_file.close()
+                shard += 1
+
+        return entries, shard
+
+    def __calculate_items(self, indices: list[int], keys: list[str]):
+        for index, key in zip(indices, keys):
+            start_time = time.perf_counter()
+            item = {}
+            for name in self.split_names + self.aggregate_names:
+                item[name] = self.get_previous_item(name, index)
+            yield key, item
+
+            if self.max_duty_cycle < 1.0:
+                # the item is written before the generator continues, so the pause covers calculating and writing it
+                elapsed_time = time.perf_counter() - start_time
+                time.sleep(elapsed_time * (1.0 - self.max_duty_cycle) / self.max_duty_cycle)
+
+    def __read_items(self, concept_dir: str, entries: dict[str, dict]):
+        for key, item_entries in entries.items():
+            yield key, {name: self.__read(concept_dir, entry) for name, entry in item_entries.items()}
+
+    @staticmethod
+    def __used_shards(entries: dict[str, dict]) -> set[int]:
+        return {
+            entry[1] for item_entries in entries.values() for entry in item_entries.values() if entry[0] != 'value'
+        }
+
+    @staticmethod
+    def __tensor_bytes(entries: dict[str, dict]) -> int:
+        return sum(
+            entry[5] for item_entries in entries.values() for entry in item_entries.values() if entry[0] != 'value'
+        )
+
+    def __reconcile_concept(self, concept_dir: str, indices: list[int], keys: list[str]) -> dict[str, dict]:
+        os.makedirs(concept_dir, exist_ok=True)
+
+        index_path = self.__get_index_path(concept_dir)
+        old_entries = torch.load(index_path) if os.path.isfile(index_path) else {}
+
+        live_entries = {key: old_entries[key] for key in keys if key in old_entries}
+        new_keys = [key for key in keys if key not in live_entries]
+        new_indices = [index for index, key in zip(indices, keys) if key not in live_entries]
+
+        existing_shards = self.__list_shards(concept_dir)
+        if not new_keys and len(live_entries) == len(old_entries) \
+                and set(existing_shards) == self.__used_shards(live_entries):
+            return live_entries
+
+        next_shard = max(existing_shards, default=-1) + 1
+        old_shard_bytes = sum(os.path.getsize(self.__get_shard_path(concept_dir, shard)) for shard in existing_shards)
+
+        # move the remaining entries into new shards if most of the old shards are unused
+        if old_shard_bytes > 0 and self.__tensor_bytes(live_entries) < old_shard_bytes * self.MIN_LIVE_FRACTION:
+            compacted_entries, next_shard = self.__write_entries(
+                concept_dir, next_shard, self.__read_items(concept_dir, live_entries)
+            )
+            live_entries = compacted_entries
+
+        if new_keys:
+            for module in self.planning_modules:
+                module.plan_indices(new_indices)
+            try:
+                new_entries, next_shard = self.__write_entries(
+                    concept_dir, next_shard, self.__calculate_items(new_indices, new_keys)
+                )
+            finally:
+                for module in self.planning_modules:
+                    module.plan_indices(None)
+            live_entries |= new_entries
+
+        # the index is replaced before unused shards are deleted, so an interrupted run always leaves a valid cache
+        self.__save_atomic(live_entries, index_path)
+
+        self.shards = {}
+        used_shards = self.__used_shards(live_entries)
+        for shard in self.__list_shards(concept_dir):
+            if shard not in used_shards:
+                try:
+                    os.remove(self.__get_shard_path(concept_dir, shard))
+                except OSError:
+                    # the shard is still mapped, it will be removed during the next run
+                    pass
+
+        return live_entries
+
+    def __get_shard(self, concept_dir: str, shard: int) -> mmap.mmap:
+        if (concept_dir, shard) not in self.shards:
+            with open(self.__get_shard_path(concept_dir, shard), "rb") as f:
+                # copy on write, to return writable tensors without modifying the file
+                self.shards[(concept_dir, shard)] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return self.shards[(concept_dir, shard)]
+
+    def __read(self, concept_dir: str, entry: tuple, device: torch.device | None = None):
+        if entry[0] == 'value':
+            return entry[1]
+
+        kind, shard, offset, dtype, shape, nbytes, codec, original_dtype = entry
+        dtype = getattr(torch, dtype)
+        count = 1
+        for size in shape:
+            count *= size
+
+        if count == 0:
+            tensor = torch.empty(shape, dtype=dtype)
+        elif codec == 'zstd':
+            compressed = self.__get_shard(concept_dir, shard)[offset:offset + nbytes]
+            element_size = torch.empty(0, dtype=dtype).element_size()
+            data = zstandard.ZstdDecompressor().decompress(compressed, max_output_size=count * element_size)
+            tensor = torch.frombuffer(bytearray(data), dtype=dtype, count=count).reshape(shape)
+        else:
+            tensor = torch.frombuffer(self.__get_shard(concept_dir, shard), dtype=dtype, count=count, offset=offset)
+            tensor = tensor.reshape(shape)
+
+        tensor = tensor.to(device=device, dtype=getattr(torch, original_dtype))
+
+        if kind == 'distribution':
+            return DiagonalGaussianDistribution(tensor)
+        if kind == 'distribution_mean':
+            return DiagonalGaussianDistribution(torch.cat([tensor, torch.zeros_like(tensor)], dim=1), deterministic=True)
+        return tensor
+
+    def start(self, variation: int):
+        cache_dir = self.__get_cache_dir(variation % self.cached_epochs)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # tensors that were already returned keep their mapping alive
+        self.shards = {}
+
+        length = self.get_previous_length(self.split_names[0])
+        concepts = {}
+        for index in range(length):
+            concept = self.get_previous_item(self.concept_in_name, index)
+            path = self.get_previous_item(self.path_in_name, index)
+            key_values = [self.get_previous_item(name, index) for name in self.key_names]
+            concept_settings = json.dumps(concept, sort_keys=True, default=str)
+            concepts.setdefault(concept_settings, (concept, []))[1].append((index, path, key_values))
+
+        items = [None] * length
+        concept_dirnames = set()
+        for concept_settings, (concept, concept_items) in tqdm(concepts.items(), desc='reconciling cache'):
+            concept_dirname = f"concept-{self.__hash(concept_settings + self.storage_format)[:16]}"
+            concept_dirnames.add(concept_dirname)
+            concept_dir = os.path.join(cache_dir, concept_dirname)
+
+            content_hashes = self.__content_hashes(
+                self.__hash(str(concept.get('path', '')))[:16], [path for _, path, _ in concept_items]
+            )
+            indices = [index for index, _, _ in concept_items]
+            keys = [
+                self.__hash(json.dumps(
+                    [path, content_hashes[path], concept_settings, self.settings, key_values], default=str
+                ))
+                for _, path, key_values in concept_items
+            ]
+
+            entries = self.__reconcile_concept(concept_dir, indices, keys)
+            for index, key in zip(indices, keys):
+                items[index] = (concept_dir, entries[key])
+
+        # remove concepts that were deleted or changed
+        for dirname in os.listdir(cache_dir):
+            if dirname.startswith("concept-") and dirname not in concept_dirnames:
+                shutil.rmtree(os.path.join(cache_dir, dirname), ignore_errors=True)
+
+        self.items = items
+
+    def read_index(self, variation: int) -> dict[str, tuple[str, dict]]:
+        """
+        Returns the (concept directory, entries) of every key that is stored in the cache of a variation
+        """
+        cache_dir = self.__get_cache_dir(variation % self.cached_epochs)
+        if not os.path.isdir(cache_dir):
+            return {}
+
+        index = {}
+        for dirname in sorted(os.listdir(cache_dir)):
+            concept_dir = os.path.join(cache_dir, dirname)
+            index_path = self.__get_index_path(concept_dir)
+            if dirname.startswith("concept-") and os.path.isfile(index_path):
+                for key, entries in torch.load(index_path).items():
+                    index[key] = (concept_dir, entries)
+        return index
+
+    def read_entries(self, concept_dir: str, entries: dict, device: torch.device | None = None) -> dict:
+        """
+        Reads all values of an item that was returned by read_index
+        """
+        return {name: self.__read(concept_dir, entry, device) for name, entry in entries.items()}
+
+    def get_item(self, index: int, requested_name: str = None) -> dict:
+        concept_dir, entries = self.items[index]
+
+        device = self.pipeline.device if self.device is None else self.device
+        return {name: self.__read(concept_dir, entry, device) for name, entry in entries.items()}
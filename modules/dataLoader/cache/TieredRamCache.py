@@ -0,0 +1,188 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import torch
+from diffusers.models.vae import DiagonalGaussianDistribution
+from mgds.MGDS import PipelineModule
+from torch.utils.tensorboard import SummaryWriter
+from tqdm import tqdm
+
+
+class TieredRamCache(PipelineModule):
+    """
+    Caches the outputs of previous modules in RAM, like the mgds RamCache, but with a bounded RAM budget.
+
+    All items are calculated when the first epoch is started. Tensors are kept on the CPU. If the cached tensors exceed
+    the RAM budget, the least recently used items are spilled to a temporary file in the spill directory, and read
+    back when they are requested again. Each item is written to the file at most once. VAE distributions are stored as
+    their parameter tensor, optionally converted to a smaller data type, and restored to their original data type when
+    they are returned.
+
+    Args:
+        names: the names of all cached values
+        max_ram_bytes: the RAM budget of all cached tensors. Values of 0 or less disable spilling
+        spill_dir: the directory of the spill file
+        distribution_dtype: the data type of cached distribution parameters, or None to keep the original data type
+        device: device of the returned tensors, defaults to the device of the pipeline
+    """
+
+    def __init__(
+            self,
+            names: list[str],
+            max_ram_bytes: int,
+            spill_dir: str,
+            distribution_dtype: torch.dtype | None = None,
+            device: torch.device | None = None,
+    ):
+        super(TieredRamCache, self).__init__()
+        self.names = names
+        self.max_ram_bytes = max_ram_bytes
+        self.spill_dir = spill_dir
+        self.distribution_dtype = distribution_dtype
+        self.device = device
+
+        # item index -> packed item, in least recently used order
+        self.ram_items = None
+        self.ram_bytes = 0
+        # item index -> spilled item, with file offsets instead of tensors
+        self.spilled_items = {}
+        self.spill_file = None
+        self.spill_size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def length(self) -> int:
+        return self.get_previous_length(self.names[0])
+
+    def get_inputs(self) -> list[str]:
+        return self.names
+
+    def get_outputs(self) -> list[str]:
+        return self.names
+
+    @staticmethod
+    def __element_size(dtype: torch.dtype) -> int:
+        return torch.empty(0, dtype=dtype).element_size()
+
+    def __pack(self, item: dict) -> dict:
+        packed = {}
+        for name, value in item.items():
+            if isinstance(value, DiagonalGaussianDistribution):
+                parameters = value.parameters.detach()
+                dtype = parameters.dtype
+                if self.distribution_dtype is not None and self.__element_size(self.distribution_dtype) < parameters.element_size():
+                    parameters = parameters.to(self.distribution_dtype)
+                packed[name] = ('distribution', parameters.cpu().contiguous(), dtype)
+            elif isinstance(value, torch.Tensor):
+                packed[name] = ('tensor', value.detach().cpu().contiguous(), value.dtype)
+            else:
+                packed[name] = ('value', value)
+        return packed
+
+    @staticmethod
+    def __packed_bytes(packed: dict) -> int:
+        return sum(entry[1].numel() * entry[1].element_size() for entry in packed.values() if entry[0] != 'value')
+
+    def __unpack(self, packed: dict) -> dict:
+        device = self.pipeline.device if self.device is None else self.device
+
+        item = {}
+        for name, entry in packed.items():
+            if entry[0] == 'value':
+                item[name] = entry[1]
+                continue
+
+            kind, tensor, dtype = entry
+            tensor = tensor.to(device=device, dtype=dtype)
+            item[name] = DiagonalGaussianDistribution(tensor) if kind == 'distribution' else tensor
+        return item
+
+    def __spill(self, index: int, packed: dict):
+        if self.spill_file is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            # the file is deleted automatically when it is closed
+            self.spill_file = tempfile.TemporaryFile(dir=self.spill_dir, prefix='spill-')
+
+        spilled = {}
+        self.spill_file.seek(self.spill_size)
+        for name, entry in packed.items():
+            if entry[0] == 'value':
+                spilled[name] = entry
+                continue
+
+            kind, tensor, dtype = entry
+            data = tensor.flatten().view(torch.uint8).numpy()
+            self.spill_file.write(data.tobytes())
+            spilled[name] = (kind, self.spill_size, tensor.dtype, tuple(tensor.shape), dtype)
+            self.spill_size += data.nbytes
+
+        self.spilled_items[index] = spilled
+
+    def __read_spilled(self, index: int) -> dict:
+        packed = {}
+        for name, entry in self.spilled_items[index].items():
+            if entry[0] == 'value':
+                packed[name] = entry
+                continue
+
+            kind, offset, stored_dtype, shape, dtype = entry
+            tensor = torch.empty(shape, dtype=stored_dtype)
+            self.spill_file.seek(offset)
+            self.spill_file.readinto(tensor.flatten().view(torch.uint8).numpy())
+            packed[name] = (kind, tensor, dtype)
+        return packed
+
+    def __put(self, index: int, packed: dict):
+        self.ram_items[index] = packed
+        self.ram_bytes += self.__packed_bytes(packed)
+
+        # the newest item always stays in RAM
+        while self.max_ram_bytes > 0 and self.ram_bytes > self.max_ram_bytes and len(self.ram_items) > 1:
+            evicted_index, evicted = self.ram_items.popitem(last=False)
+            self.ram_bytes -= self.__packed_bytes(evicted)
+            if evicted_index not in self.spilled_items:
+                self.__spill(evicted_index, evicted)
+            self.evictions += 1
+
+    def start(self, variation: int):
+        if self.ram_items is not None:
+            return
+
+        self.ram_items = OrderedDict()
+        for index in tqdm(range(self.length()), desc='caching'):
+            item = {name: self.get_previous_item(name, index) for name in self.names}
+            self.__put(index, self.__pack(item))
+
+    def get_item(self, index: int, requested_name: str = None) -> dict:
+        with self.lock:
+            packed = self.ram_items.get(index)
+            if packed is not None:
+                self.ram_items.move_to_end(index)
+                self.hits += 1
+            else:
+                packed = self.__read_spilled(index)
+                self.__put(index, packed)
+                self.misses += 1
+
+        return self.__unpack(packed)
+
+    def report(self, tensorboard: SummaryWriter | None, global_step: int):
+        """
+        Writes the hit, miss and eviction counters, and the size of both tiers to tensorboard
+        """
+        if tensorboard is None or self.ram_items is None:
+            return
+
+        with self.lock:
+            requests = self.hits + self.misses
+            tensorboard.add_scalar("ram_cache/hits", self.hits, global_step)
+            tensorboard.add_scalar("ram_cache/misses", self.misses, global_step)
+            tensorboard.add_scalar("ram_cache/evictions", self.evictions, global_step)
+            tensorboard.add_scalar("ram_cache/hit_rate", self.hits / requests if requests > 0 else 1.0, global_step)
+            tensorboard.add_scalar("ram_cache/ram_bytes", self.ram_bytes, global_step)
+            tensorboard.add_scalar("ram_cache/disk_bytes", self.spill_size, global_step)
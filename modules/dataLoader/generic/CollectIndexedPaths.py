@@ -0,0 +1,130 @@
+import os
+
+from mgds.MGDS import PipelineModule
+from tqdm import tqdm
+
+from modules.dataLoader.index.DatasetIndex import DatasetIndex
+
+
+class CollectIndexedPaths(PipelineModule):
+    """
+    Collects the image paths of all concepts, like the mgds CollectPaths, but reads them from a persistent DatasetIndex
+    for each concept. The index is refreshed incrementally, so only directories that changed since the last run are
+    listed again.
+
+    If output names for the caption and mask paths are set, these paths are also taken from the index, instead of
+    probing the file system for each sample. The path of a file that does not exist is an empty string, which the
+    loading modules treat like a missing file.
+    """
+
+    def __init__(
+            self,
+            concept_in_name: str,
+            path_in_name: str,
+            path_out_name: str,
+            concept_out_name: str,
+            include_postfix: list[str] | None,
+            exclude_postfix: list[str] | None,
+            include_subdirectories_in_name: str,
+            extensions: list[str],
+            index_dir: str,
+            num_workers: int = 16,
+            caption_path_out_name: str | None = None,
+            mask_path_out_name: str | None = None,
+    ):
+        super(CollectIndexedPaths, self).__init__()
+        self.concept_in_name = concept_in_name
+        self.path_in_name = path_in_name
+        self.path_out_name = path_out_name
+        self.concept_out_name = concept_out_name
+        self.include_postfix = include_postfix
+        self.exclude_postfix = exclude_postfix
+        self.include_subdirectories_in_name = include_subdirectories_in_name
+        self.extensions = extensions
+        self.index_dir = index_dir
+        self.num_workers = num_workers
+        self.caption_path_out_name = caption_path_out_name
+        self.mask_path_out_name = mask_path_out_name
+
+        self.paths = None
+        self.concepts = None
+        self.caption_paths = None
+        self.mask_paths = None
+
+    def length(self) -> int:
+        if self.paths is None:
+            self.__collect()
+        return len(self.paths)
+
+    def get_inputs(self) -> list[str]:
+        return [self.concept_in_name]
+
+    def get_outputs(self) -> list[str]:
+        outputs = [self.path_out_name, self.concept_out_name]
+        if self.caption_path_out_name is not None:
+            outputs.append(self.caption_path_out_name)
+        if self.mask_path_out_name is not None:
+            outputs.append(self.mask_path_out_name)
+        return outputs
+
+    def __get_concept_value(self, concept: dict, name: str, default=None):
+        # names are relative to the concept, for example "concept.include_subdirectories"
+        value = concept
+        for key in name.split('.')[1:]:
+            if not isinstance(value, dict) or key not in value:
+                return default
+            value = value[key]
+        return value
+
+    def __is_included(self, path: str) -> bool:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if self.include_postfix and not any(stem.endswith(postfix) for postfix in self.include_postfix):
+            return False
+        if self.exclude_postfix and any(stem.endswith(postfix) for postfix in self.exclude_postfix):
+            return False
+        return True
+
+    def __collect(self):
+        self.paths = []
+        self.concepts = []
+        self.caption_paths = []
+        self.mask_paths = []
+
+        for index in tqdm(range(self.get_previous_length(self.concept_in_name)), desc='enumerating sample paths'):
+            concept = self.get_previous_item(self.concept_in_name, index)
+            concept_path = concept[self.path_in_name]
+            if not os.path.isdir(concept_path):
+                print(f"concept directory {concept_path} does not exist, skipping")
+                continue
+
+            include_subdirectories = self.__get_concept_value(concept, self.include_subdirectories_in_name, False)
+
+            dataset_index = DatasetIndex(DatasetIndex.get_database_path(self.index_dir, concept_path), self.extensions, self.num_workers)
+            try:
+                files = dataset_index.refresh(concept_path, include_subdirectories)
+            finally:
+                dataset_index.close()
+
+            for file in files:
+                if self.__is_included(file.path):
+                    self.paths.append(file.path)
+                    self.concepts.append(concept)
+
+                    stem = os.path.splitext(file.path)[0]
+                    self.caption_paths.append(stem + DatasetIndex.CAPTION_EXTENSION if file.has_caption else '')
+                    self.mask_paths.append(stem + DatasetIndex.MASK_POSTFIX if file.has_mask else '')
+
+    def start(self, variation: int):
+        if self.paths is None:
+            self.__collect()
+
+    def get_item(self, index: int, requested_name: str = None) -> dict:
+        item = {
+            self.path_out_name: self.paths[index],
+            self.concept_out_name: self.concepts[index],
+        }
+        if self.caption_path_out_name is not None:
+            item[self.caption_path_out_name] = self.caption_paths[index]
+        if self.mask_path_out_name is not None:
+            item[self.mask_path_out_name] = self.mask_paths[index]
+        return item
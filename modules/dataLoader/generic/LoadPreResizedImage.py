@@ -0,0 +1,182 @@
+import hashlib
+import os
+import uuid
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+from mgds.MGDS import PipelineModule
+from torchvision import transforms
+
+from modules.util.image_util import load_image_draft
+
+
+class LoadPreResizedImage(PipelineModule):
+    """
+    Loads an image, like the mgds LoadImage, but already downsized to its scale resolution, which is the smallest size
+    that supports every crop of its bucket. Crop jitter and all augmentations are applied after scaling, so they work
+    on the downsized image just like on the original.
+
+    Like the mgds LoadImage, the exif orientation is not applied, so images match their masks and the resolutions
+    read by ProbeImageResolution. If draft is set, jpeg images are decoded at a reduced scale if they are much bigger
+    than the scale resolution, before they are resized with a high quality filter. If a cache directory is set, the
+    downsized image is stored as a lossless png file, and later loads only decode that copy. Each copy records the
+    size and modification time of its source, and is recreated if the source changed, a bigger scale resolution is
+    needed, or the copy is much bigger than the scale resolution, for example after the training resolution was
+    lowered. Copies that are only slightly bigger are resized after loading. Images that would be upscaled are not
+    cached.
+
+    ParallelLoad can call prefetch from its worker threads to decode and resize images outside of its lock. Only the
+    path and scale resolution are read under the lock, and get_item uses the prefetched image if they still match.
+    """
+
+    # a cached copy is recreated from its source if one of its sides is this much bigger than needed
+    MAX_CACHED_OVERSIZE = 1.25
+
+    def __init__(
+            self,
+            path_in_name: str,
+            scale_resolution_in_name: str,
+            image_out_name: str,
+            range_min: float,
+            range_max: float,
+            cache_dir: str | None = None,
+            channels: int = 3,
+            draft: bool = True,
+    ):
+        super(LoadPreResizedImage, self).__init__()
+        self.path_in_name = path_in_name
+        self.scale_resolution_in_name = scale_resolution_in_name
+        self.image_out_name = image_out_name
+        self.range_min = range_min
+        self.range_max = range_max
+        self.cache_dir = cache_dir
+        self.channels = channels
+        self.draft = draft
+
+        self.mode = 'RGB' if channels == 3 else 'L'
+
+        # index -> (path, height, width, image_tensor), filled by prefetch
+        self.prefetched = {}
+
+    def length(self) -> int:
+        return self.get_previous_length(self.path_in_name)
+
+    def get_inputs(self) -> list[str]:
+        return [self.path_in_name, self.scale_resolution_in_name]
+
+    def get_outputs(self) -> list[str]:
+        return [self.image_out_name]
+
+    def start(self, variation: int):
+        self.prefetched.clear()
+
+    def __cache_path(self, path: str) -> str:
+        key = hashlib.sha256(f"{os.path.abspath(path)}:{self.mode}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.png')
+
+    def __load_cached(self, cache_path: str, stat: os.stat_result, height: int, width: int) -> Image.Image | None:
+        try:
+            image = Image.open(cache_path)
+        except (FileNotFoundError, OSError):
+            return None
+
+        # the text chunks are read with the header, before any pixel data is decoded
+        if image.info.get('source_size') != str(stat.st_size) \
+                or image.info.get('orientation') != 'raw' \
+                or image.info.get('source_mtime_ns') != str(stat.st_mtime_ns) \
+                or image.width < width or image.height < height \
+                or image.width > width * self.MAX_CACHED_OVERSIZE or image.height > height * self.MAX_CACHED_OVERSIZE:
+            image.close()
+            return None
+
+        try:
+            image.load()
+        except OSError:
+            # a damaged copy is recreated from the source
+            image.close()
+            return None
+        return image
+
+    def __store(self, cache_path: str, image: Image.Image, stat: os.stat_result):
+        info = PngInfo()
+        info.add_text('source_size', str(stat.st_size))
+        info.add_text('source_mtime_ns', str(stat.st_mtime_ns))
+        # copies without this entry were rotated by their exif orientation
+        info.add_text('orientation', 'raw')
+
+        # other workers can read the cache at the same time, so the copy is written to a temporary file first
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            image.save(temp_path, format='PNG', pnginfo=info, compress_level=1)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"could not store the pre-resized copy of an image: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def __load(self, path: str, height: int, width: int) -> Image.Image:
+        stat = os.stat(path) if self.cache_dir is not None else None
+        cache_path = self.__cache_path(path) if self.cache_dir is not None else None
+
+        if cache_path is not None:
+            image = self.__load_cached(cache_path, stat, height, width)
+            if image is not None:
+                if image.size != (width, height):
+                    image = image.resize((width, height), resample=Image.LANCZOS)
+                return image
+
+        image = load_image_draft(path, height, width, self.mode, self.draft)
+
+        if image.width > width and image.height > height:
+            image = image.resize((width, height), resample=Image.LANCZOS)
+            if cache_path is not None:
+                self.__store(cache_path, image, stat)
+
+        return image
+
+    def __load_tensor(self, path: str, height: int, width: int):
+        image = self.__load(path, height, width)
+
+        image_tensor = transforms.ToTensor()(image.convert(self.mode))
+        image_tensor = image_tensor.to(device=self.pipeline.device, dtype=self.pipeline.dtype)
+        return image_tensor * (self.range_max - self.range_min) + self.range_min
+
+    def prefetch(self, index: int, lock):
+        with lock:
+            path = self.get_previous_item(self.path_in_name, index)
+            height, width = self.get_previous_item(self.scale_resolution_in_name, index)
+
+        try:
+            image_tensor = self.__load_tensor(path, height, width)
+        except:
+            # get_item loads the image again and reports the error
+            return
+
+        self.prefetched[index] = (path, height, width, image_tensor)
+
+    def discard(self, indices: list[int]):
+        for index in indices:
+            self.prefetched.pop(index, None)
+
+    def get_item(self, index: int, requested_name: str = None) -> dict:
+        path = self.get_previous_item(self.path_in_name, index)
+        height, width = self.get_previous_item(self.scale_resolution_in_name, index)
+
+        prefetched = self.prefetched.pop(index, None)
+        if prefetched is not None and prefetched[:3] == (path, height, width):
+            return {
+                self.image_out_name: prefetched[3]
+            }
+
+        try:
+            image_tensor = self.__load_tensor(path, height, width)
+        except FileNotFoundError:
+            image_tensor = None
+        except:
+            print("could not load image, it might be corrupted: " + path)
+            raise
+
+        return {
+            self.image_out_name: image_tensor
+        }
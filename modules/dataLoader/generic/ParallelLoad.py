@@ -0,0 +1,133 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from mgds.MGDS import PipelineModule
+
+
+class ParallelLoad(PipelineModule):
+    """
+    Calculates the items of all previous modules on a pool of worker threads, ahead of the consumer.
+
+    The previous modules keep the state of their last item, so they are never called by two threads at the same time.
+    Workers hold a lock while they call them, and names in passthrough_names, which later modules request without
+    loading the whole item, are read under the same lock. Only the prefetch step of prefetch_modules, for example
+    decoding and resizing in LoadPreResizedImage, runs outside the lock on several threads at once. Workers call the
+    previous modules just like the consumer would, so items are the same as without this module.
+
+    When an item is requested, the next prefetch_items items are scheduled as well. A cache that only requests some of
+    the items can announce them with plan_indices, then the next planned items are scheduled. Without a plan, nothing
+    is scheduled ahead of an item that is requested out of order.
+    """
+
+    def __init__(
+            self,
+            names: list[str],
+            num_workers: int,
+            prefetch_items: int,
+            passthrough_names: list[str] | None = None,
+    ):
+        super(ParallelLoad, self).__init__()
+        self.names = names
+        self.num_workers = max(1, num_workers)
+        self.prefetch_items = max(0, prefetch_items)
+        self.passthrough_names = [] if passthrough_names is None else passthrough_names
+
+        # modules before this module with a prefetch(index, lock) and a discard(indices) function, see
+        # LoadPreResizedImage.prefetch
+        self.prefetch_modules = []
+
+        self.lock = threading.Lock()
+        self.executor = None
+        self.futures = {}
+        self.wanted_indices = set()
+        self.previous_index = None
+        self.planned_indices = None
+        self.planned_positions = {}
+
+    def length(self) -> int:
+        return self.get_previous_length(self.names[0])
+
+    def get_inputs(self) -> list[str]:
+        return self.names + self.passthrough_names
+
+    def get_outputs(self) -> list[str]:
+        return self.names + self.passthrough_names
+
+    def __cancel(self, indices: list[int]):
+        for index in indices:
+            # a worker that already started checks whether its item is still wanted before each step
+            self.wanted_indices.discard(index)
+            self.futures.pop(index).cancel()
+        for module in self.prefetch_modules:
+            module.discard(indices)
+
+    def __shutdown(self):
+        self.__cancel(list(self.futures.keys()))
+        if self.executor is not None:
+            # running workers are finished, so they don't call the previous modules while they are started
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def start(self, variation: int):
+        # items of the previous epoch were calculated with a different variation
+        self.__shutdown()
+        self.previous_index = None
+        self.plan_indices(None)
+
+    def plan_indices(self, indices: list[int] | None):
+        """
+        Sets the indices that will be requested next, in order of their request. None resets the plan, and items are
+        expected to be requested in order of their index.
+        """
+        self.planned_indices = indices
+        self.planned_positions = {}
+        if indices is not None:
+            self.planned_positions = {index: position for position, index in enumerate(indices)}
+
+    def __load(self, index: int) -> dict | None:
+        for module in self.prefetch_modules:
+            if index not in self.wanted_indices:
+                return None
+            module.prefetch(index, self.lock)
+
+        if index not in self.wanted_indices:
+            return None
+        with self.lock:
+            return {name: self.get_previous_item(name, index) for name in self.names}
+
+    def __schedule(self, index: int) -> Future:
+        if index not in self.futures:
+            self.wanted_indices.add(index)
+            self.futures[index] = self.executor.submit(self.__load, index)
+        return self.futures[index]
+
+    def __prefetch_indices(self, index: int) -> list[int]:
+        if self.planned_indices is not None:
+            if index not in self.planned_positions:
+                return []
+            position = self.planned_positions[index]
+            return self.planned_indices[position + 1:position + self.prefetch_items + 1]
+        if self.previous_index is not None and index != self.previous_index + 1:
+            return []
+        return list(range(index + 1, min(index + self.prefetch_items + 1, self.length())))
+
+    def get_item(self, index: int, requested_name: str = None) -> dict:
+        if requested_name in self.passthrough_names:
+            with self.lock:
+                return {requested_name: self.get_previous_item(requested_name, index)}
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='ParallelLoad')
+
+        prefetch_indices = self.__prefetch_indices(index)
+        self.previous_index = index
+
+        wanted_indices = set(prefetch_indices)
+        wanted_indices.add(index)
+        self.__cancel([future_index for future_index in self.futures if future_index not in wanted_indices])
+
+        future = self.__schedule(index)
+        for prefetch_index in prefetch_indices:
+            self.__schedule(prefetch_index)
+
+        return future.result()
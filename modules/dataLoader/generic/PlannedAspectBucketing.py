@@ -0,0 +1,169 @@
+import math
+
+import numpy as np
+from mgds.MGDS import PipelineModule
+
+
+class PlannedAspectBucketing(PipelineModule):
+    """
+    Assigns each image to an aspect ratio bucket, like the mgds AspectBucketing, but derives the buckets from the
+    aspect ratios of the dataset instead of using a fixed set.
+
+    Candidate buckets have sides that are multiples of the quantization, and at most target_resolution^2 pixels. The
+    images are sorted by aspect ratio and split into at most max_buckets contiguous groups. Each group gets the
+    candidate bucket that minimizes the cropped area of its images, and the split with the smallest total cropped
+    area is selected. Every group needs at least min_bucket_size images, so batches can be filled.
+
+    The resolutions that are collected for the plan are kept, so later requests, like the crop resolutions that key
+    the latent cache in every epoch, don't load the images again.
+    """
+
+    # aspect ratios are grouped into bins of this width in log space before planning
+    LOG_ASPECT_BIN_SIZE = 0.01
+
+    # the most extreme aspect ratio of a candidate bucket
+    MAX_ASPECT_RATIO = 4.0
+
+    def __init__(
+            self,
+            target_resolution: int,
+            quantization: int,
+            max_buckets: int,
+            min_bucket_size: int,
+            resolution_in_name: str,
+            scale_resolution_out_name: str,
+            crop_resolution_out_name: str,
+            possible_resolutions_out_name: str,
+    ):
+        super(PlannedAspectBucketing, self).__init__()
+        self.target_resolution = target_resolution
+        self.quantization = quantization
+        self.max_buckets = max(1, max_buckets)
+        self.min_bucket_size = max(1, min_bucket_size)
+        self.resolution_in_name = resolution_in_name
+        self.scale_resolution_out_name = scale_resolution_out_name
+        self.crop_resolution_out_name = crop_resolution_out_name
+        self.possible_resolutions_out_name = possible_resolutions_out_name
+
+        self.resolutions = None
+        self.buckets = None
+        self.bucket_indices = None
+
+    def length(self) -> int:
+        return self.get_previous_length(self.resolution_in_name)
+
+    def get_inputs(self) -> list[str]:
+        return [self.resolution_in_name]
+
+    def get_outputs(self) -> list[str]:
+        return [self.scale_resolution_out_name, self.crop_resolution_out_name, self.possible_resolutions_out_name]
+
+    def __candidate_buckets(self) -> list[tuple[int, int]]:
+        max_pixels = self.target_resolution * self.target_resolution
+        candidates = set()
+        for width in range(self.quantization, self.target_resolution * 4 + 1, self.quantization):
+            height = max_pixels // width // self.quantization * self.quantization
+            if height < self.quantization:
+                continue
+            if max(width / height, height / width) <= self.MAX_ASPECT_RATIO:
+                candidates.add((height, width))
+        return sorted(candidates, key=lambda bucket: bucket[1] / bucket[0])
+
+    @staticmethod
+    def __cropped_fraction(log_aspects: np.ndarray, bucket_log_aspects: np.ndarray) -> np.ndarray:
+        # an image that is scaled to cover a bucket loses 1 - exp(-|log aspect difference|) of its area
+        return 1.0 - np.exp(-np.abs(log_aspects[None, :] - bucket_log_aspects[:, None]))
+
+    def __plan(self, resolutions: list[tuple[int, int]]):
+        candidates = self.__candidate_buckets()
+        candidate_log_aspects = np.array([math.log(width / height) for height, width in candidates])
+
+        log_aspects = np.array([math.log(width / height) for height, width in resolutions])
+        bins = np.round(log_aspects / self.LOG_ASPECT_BIN_SIZE).astype(np.int64)
+        unique_bins, bin_of_image, bin_counts = np.unique(bins, return_inverse=True, return_counts=True)
+        bin_log_aspects = unique_bins * self.LOG_ASPECT_BIN_SIZE
+        bin_count = len(unique_bins)
+
+        # cost[c, b]: cropped area of all images in bin b if they are assigned to candidate c
+        cost = self.__cropped_fraction(bin_log_aspects, candidate_log_aspects) * bin_counts[None, :]
+        cost_prefix = np.concatenate([np.zeros((len(candidates), 1)), np.cumsum(cost, axis=1)], axis=1)
+        count_prefix = np.concatenate([[0], np.cumsum(bin_counts)])
+        min_bucket_size = min(self.min_bucket_size, len(resolutions))
+
+        # segment_cost[i, j]: the smallest cost of bins i..j-1 in a single bucket
+        segment_cost = np.full((bin_count + 1, bin_count + 1), np.inf)
+        segment_candidate = np.zeros((bin_count + 1, bin_count + 1), dtype=np.int64)
+        for start in range(bin_count):
+            costs = cost_prefix[:, start + 1:] - cost_prefix[:, start:start + 1]
+            segment_candidate[start, start + 1:] = np.argmin(costs, axis=0)
+            segment_cost[start, start + 1:] = np.min(costs, axis=0)
+        counts = count_prefix[None, :] - count_prefix[:, None]
+        segment_cost[counts < min_bucket_size] = np.inf
+
+        # total[k, j]: the smallest cost of bins 0..j-1 split into k + 1 buckets
+        total = np.full((self.max_buckets, bin_count + 1), np.inf)
+        split = np.zeros((self.max_buckets, bin_count + 1), dtype=np.int64)
+        total[0] = segment_cost[0]
+        for k in range(1, self.max_buckets):
+            for end in range(1, bin_count + 1):
+                costs = total[k - 1, :end] + segment_cost[:end, end]
+                split[k, end] = np.argmin(costs)
+                total[k, end] = costs[split[k, end]]
+
+        bucket_count = int(np.argmin(total[:, bin_count]))
+        segments = []
+        end = bin_count
+        for k in range(bucket_count, -1, -1):
+            start = int(split[k, end]) if k > 0 else 0
+            segments.append((start, end))
+            end = start
+
+        buckets = []
+        bin_buckets = np.zeros(bin_count, dtype=np.int64)
+        for start, end in reversed(segments):
+            bucket = candidates[segment_candidate[start, end]]
+            if bucket not in buckets:
+                buckets.append(bucket)
+            bin_buckets[start:end] = buckets.index(bucket)
+
+        self.buckets = buckets
+        self.bucket_indices = bin_buckets[bin_of_image].tolist()
+
+        self.__print_stats(log_aspects)
+
+    def __print_stats(self, log_aspects: np.ndarray):
+        bucket_log_aspects = np.array([math.log(width / height) for height, width in self.buckets])
+        bucket_indices = np.array(self.bucket_indices)
+        cropped = 1.0 - np.exp(-np.abs(log_aspects - bucket_log_aspects[bucket_indices]))
+
+        bucket_sizes = np.bincount(bucket_indices, minlength=len(self.buckets))
+        incomplete = int(np.sum(bucket_sizes % self.min_bucket_size))
+
+        print(
+            f"aspect bucket plan: {len(self.buckets)} distinct shapes, "
+            f"{100.0 * cropped.mean():.1f}% of the image area cropped, "
+            f"{100.0 * incomplete / len(bucket_indices):.1f}% of samples dropped in incomplete batches"
+        )
+        for (height, width), size in zip(self.buckets, bucket_sizes):
+            print(f"    {width}x{height}: {size} samples")
+
+    def start(self, variation: int):
+        if self.buckets is None:
+            self.resolutions = [self.get_previous_item(self.resolution_in_name, index) for index in range(self.length())]
+            self.__plan(self.resolutions)
+
+    def get_item(self, index: int, requested_name: str = None) -> dict:
+        height, width = self.resolutions[index]
+        crop_height, crop_width = self.buckets[self.bucket_indices[index]]
+
+        scale = max(crop_height / height, crop_width / width)
+        scale_resolution = (
+            max(crop_height, round(height * scale)),
+            max(crop_width, round(width * scale)),
+        )
+
+        return {
+            self.scale_resolution_out_name: scale_resolution,
+            self.crop_resolution_out_name: (crop_height, crop_width),
+            self.possible_resolutions_out_name: self.buckets,
+        }
@@ -0,0 +1,103 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from mgds.MGDS import PipelineModule
+from tqdm import tqdm
+
+from modules.dataLoader.index.DatasetIndex import DatasetIndex
+from modules.dataLoader.index.IndexedFile import IndexedFile
+from modules.util.image_util import probe_image_resolution
+
+
+class ProbeImageResolution(PipelineModule):
+    """
+    Returns the original (height, width) of each image, like the mgds CalcAspect, but reads it from the file header
+    instead of the decoded image. The resolutions of all items are probed in parallel when the first epoch is started,
+    so aspect buckets can be calculated before any image is decoded.
+
+    If an index directory is set, resolutions are cached in the DatasetIndex of each concept. A cached resolution is
+    used as long as the size and modification time of the file did not change.
+    """
+
+    def __init__(
+            self,
+            path_in_name: str,
+            concept_in_name: str,
+            resolution_out_name: str,
+            index_dir: str | None = None,
+            num_workers: int = 16,
+    ):
+        super(ProbeImageResolution, self).__init__()
+        self.path_in_name = path_in_name
+        self.concept_in_name = concept_in_name
+        self.resolution_out_name = resolution_out_name
+        self.index_dir = index_dir
+        self.num_workers = max(1, num_workers)
+
+        self.resolutions = None
+
+    def length(self) -> int:
+        return self.get_previous_length(self.path_in_name)
+
+    def get_inputs(self) -> list[str]:
+        return [self.path_in_name, self.concept_in_name]
+
+    def get_outputs(self) -> list[str]:
+        return [self.resolution_out_name]
+
+    @staticmethod
+    def __probe(path: str, indexed_file: IndexedFile | None) -> tuple[tuple[int, int], tuple | None]:
+        """
+        Returns the resolution, and the (path, size, mtime_ns, width, height) to store in the index if it changed
+        """
+        stat = os.stat(path)
+        if indexed_file is not None and indexed_file.width is not None \
+                and indexed_file.size == stat.st_size and indexed_file.mtime_ns == stat.st_mtime_ns:
+            return (indexed_file.height, indexed_file.width), None
+
+        height, width = probe_image_resolution(path)
+        return (height, width), (path, stat.st_size, stat.st_mtime_ns, width, height)
+
+    def __probe_concept(self, executor: ThreadPoolExecutor, concept_path: str | None, paths: list[str]) -> list:
+        dataset_index = None
+        if self.index_dir is not None and concept_path is not None:
+            database_path = DatasetIndex.get_database_path(self.index_dir, concept_path)
+            if os.path.isfile(database_path):
+                dataset_index = DatasetIndex(database_path, [])
+
+        try:
+            indexed_files = dataset_index.get_files(paths) if dataset_index is not None else {}
+            results = list(executor.map(lambda path: self.__probe(path, indexed_files.get(path)), paths))
+
+            if dataset_index is not None:
+                dataset_index.set_dimensions([update for _, update in results if update is not None])
+        finally:
+            if dataset_index is not None:
+                dataset_index.close()
+
+        return [resolution for resolution, _ in results]
+
+    def start(self, variation: int):
+        if self.resolutions is not None:
+            return
+
+        concept_indices = {}
+        for index in range(self.length()):
+            concept = self.get_previous_item(self.concept_in_name, index)
+            concept_path = concept.get('path') if isinstance(concept, dict) else None
+            concept_indices.setdefault(concept_path, []).append(index)
+
+        self.resolutions = [None] * self.length()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for concept_path, indices in tqdm(concept_indices.items(), desc='probing image resolutions'):
+                paths = [self.get_previous_item(self.path_in_name, index) for index in indices]
+                for index, resolution in zip(indices, self.__probe_concept(executor, concept_path, paths)):
+                    self.resolutions[index] = resolution
+
+    def get_item(self, index: int, requested_name: str = None) -> dict:
+        if self.resolutions is None:
+            self.start(0)
+
+        return {
+            self.resolution_out_name: self.resolutions[index],
+        }
@@ -0,0 +1,222 @@
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.dataLoader.index.IndexedFile import IndexedFile
+
+
+class DatasetIndex:
+    """
+    A persistent index of all image files of a concept, stored in an sqlite database.
+
+    For each image, the index stores the file size, the modification time, the image dimensions (once they are
+    probed) and whether a caption (.txt) and a mask (-masklabel.png) file exist next to it. Every directory is stored
+    with its modification time. When the index is refreshed, each known directory is only checked with a single stat
+    call. Only directories that changed, or were never listed, are listed again. Directories are checked and listed in
+    parallel.
+
+    Files that are modified in place, without changing the directory, keep their previous size and modification time.
+    Stored dimensions should only be used if the size and modification time still match the file.
+    """
+
+    # stored dimensions of an older version are probed again. Version 1 stores the dimensions without the exif
+    # orientation
+    DIMENSIONS_VERSION = 1
+
+    CAPTION_EXTENSION = '.txt'
+    MASK_POSTFIX = '-masklabel.png'
+
+    def __init__(
+            self,
+            database_path: str,
+            extensions: list[str],
+            num_workers: int = 16,
+    ):
+        self.database_path = database_path
+        self.extensions = [extension.lower() for extension in extensions]
+        self.num_workers = max(1, num_workers)
+
+        os.makedirs(os.path.dirname(database_path), exist_ok=True)
+        self.connection = sqlite3.connect(database_path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                parent TEXT,
+                mtime_ns INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                directory TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                width INTEGER,
+                height INTEGER,
+                has_caption INTEGER NOT NULL,
+                has_mask INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+            CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+        """)
+
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < self.DIMENSIONS_VERSION:
+            self.connection.execute("UPDATE files SET width = NULL, height = NULL")
+            self.connection.execute(f"PRAGMA user_version = {self.DIMENSIONS_VERSION}")
+            self.connection.commit()
+
+    @staticmethod
+    def get_database_path(index_dir: str, concept_path: str) -> str:
+        concept_id = hashlib.sha256(os.path.abspath(concept_path).encode()).hexdigest()[:16]
+        return os.path.join(index_dir, f"concept-{concept_id}.sqlite")
+
+    def close(self):
+        self.connection.close()
+
+    def __is_image(self, name: str) -> bool:
+        return os.path.splitext(name)[1].lower() in self.extensions
+
+    def __scan_directory(self, path: str, known_mtime_ns: int | None):
+        """
+        Runs on a worker thread. Returns None if the directory was removed, (mtime, None, None) if it did not change,
+        or (mtime, files, subdirectories) after listing it.
+        """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        if mtime_ns == known_mtime_ns:
+            return mtime_ns, None, None
+
+        names = set()
+        image_entries = []
+        subdirectories = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                names.add(entry.name)
+                if entry.is_dir():
+                    subdirectories.append(entry.path)
+                elif entry.is_file() and self.__is_image(entry.name):
+                    image_entries.append(entry)
+
+        files = []
+        for entry in image_entries:
+            stat = entry.stat()
+            stem = os.path.splitext(entry.name)[0]
+            files.append((
+                entry.path, stat.st_size, stat.st_mtime_ns,
+                stem + self.CAPTION_EXTENSION in names, stem + self.MASK_POSTFIX in names,
+            ))
+
+        return mtime_ns, files, subdirectories
+
+    def __update_directory(self, path: str, parent: str | None, result):
+        if result is None:
+            self.connection.execute("DELETE FROM files WHERE directory = ?", (path,))
+            self.connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+            return
+
+        mtime_ns, files, subdirectories = result
+        self.connection.execute(
+            "INSERT OR REPLACE INTO directories (path, parent, mtime_ns) VALUES (?, ?, ?)", (path, parent, mtime_ns)
+        )
+        if files is None:
+            return
+
+        # dimensions are kept for files that did not change
+        known_files = {
+            row[0]: row[1:] for row in
+            self.connection.execute("SELECT path, size, mtime_ns, width, height FROM files WHERE directory = ?", (path,))
+        }
+        self.connection.execute("DELETE FROM files WHERE directory = ?", (path,))
+        rows = []
+        for file_path, size, file_mtime_ns, has_caption, has_mask in files:
+            width, height = None, None
+            known_file = known_files.get(file_path)
+            if known_file is not None and known_file[0] == size and known_file[1] == file_mtime_ns:
+                width, height = known_file[2], known_file[3]
+            rows.append((file_path, path, size, file_mtime_ns, width, height, has_caption, has_mask))
+        self.connection.executemany(
+            "INSERT INTO files (path, directory, size, mtime_ns, width, height, has_caption, has_mask)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+        # subdirectories are stored without a modification time, so they are listed when they are first visited
+        known_subdirectories = self.__subdirectories(path)
+        for subdirectory in known_subdirectories - set(subdirectories):
+            self.__remove_tree(subdirectory)
+        for subdirectory in set(subdirectories) - known_subdirectories:
+            self.connection.execute(
+                "INSERT INTO directories (path, parent, mtime_ns) VALUES (?, ?, NULL)", (subdirectory, path)
+            )
+
+    def __subdirectories(self, path: str) -> set[str]:
+        return {row[0] for row in self.connection.execute("SELECT path FROM directories WHERE parent = ?", (path,))}
+
+    def __remove_tree(self, path: str):
+        for subdirectory in self.__subdirectories(path):
+            self.__remove_tree(subdirectory)
+        self.connection.execute("DELETE FROM files WHERE directory = ?", (path,))
+        self.connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+
+    def __known_mtime(self, path: str) -> int | None:
+        row = self.connection.execute("SELECT mtime_ns FROM directories WHERE path = ?", (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def refresh(self, root: str, include_subdirectories: bool) -> list[IndexedFile]:
+        """
+        Updates the index of the root directory, and returns all indexed image files, sorted by path
+        """
+        root = os.path.normpath(root)
+        visited = []
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = [(root, None)]
+            while pending:
+                # the database is only accessed from this thread
+                known_mtimes = [self.__known_mtime(path) for path, _ in pending]
+                results = executor.map(self.__scan_directory, [path for path, _ in pending], known_mtimes)
+                next_pending = []
+                for (path, parent), result in zip(pending, list(results)):
+                    self.__update_directory(path, parent, result)
+                    if result is not None:
+                        visited.append(path)
+                        if include_subdirectories:
+                            next_pending.extend((subdirectory, path) for subdirectory in self.__subdirectories(path))
+                pending = next_pending
+
+        self.connection.commit()
+
+        files = []
+        for directory in visited:
+            for row in self.connection.execute(
+                    "SELECT path, size, mtime_ns, width, height, has_caption, has_mask FROM files WHERE directory = ?",
+                    (directory,)
+            ):
+                files.append(IndexedFile(row[0], row[1], row[2], row[3], row[4], bool(row[5]), bool(row[6])))
+
+        files.sort(key=lambda file: file.path)
+        return files
+
+    def get_files(self, paths: list[str]) -> dict[str, IndexedFile]:
+        """
+        Returns the indexed entries of all given paths that are known to the index
+        """
+        files = {}
+        for path in paths:
+            row = self.connection.execute(
+                "SELECT path, size, mtime_ns, width, height, has_caption, has_mask FROM files WHERE path = ?", (path,)
+            ).fetchone()
+            if row is not None:
+                files[path] = IndexedFile(row[0], row[1], row[2], row[3], row[4], bool(row[5]), bool(row[6]))
+        return files
+
+    def set_dimensions(self, dimensions: list[tuple[str, int, int, int, int]]):
+        """
+        Stores the (path, size, mtime_ns, width, height) of probed files. Files that are not indexed are ignored.
+        """
+        self.connection.executemany(
+            "UPDATE files SET size = ?, mtime_ns = ?, width = ?, height = ? WHERE path = ?",
+            [(size, mtime_ns, width, height, path) for path, size, mtime_ns, width, height in dimensions]
+        )
+        self.connection.commit()
@@ -0,0 +1,18 @@
+class IndexedFile:
+    def __init__(
+            self,
+            path: str,
+            size: int,
+            mtime_ns: int,
+            width: int | None,
+            height: int | None,
+            has_caption: bool,
+            has_mask: bool,
+    ):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.width = width
+        self.height = height
+        self.has_caption = has_caption
+        self.has_mask = has_mask
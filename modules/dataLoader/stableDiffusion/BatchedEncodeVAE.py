@@ -0,0 +1,130 @@
+from contextlib import nullcontext
+
+import torch
+from diffusers import AutoencoderKL
+from diffusers.models.vae import DiagonalGaussianDistribution
+from mgds.MGDS import PipelineModule
+from torch import Tensor
+
+
+class BatchedEncodeVAE(PipelineModule):
+    """
+    Encodes images with a VAE, like the mgds EncodeVAE, but runs the encoder on micro-batches of images.
+
+    When an item is requested that was not yet encoded, the images of the items that will be requested next are loaded
+    as well, grouped by their resolution (the crop resolution bucket), and each group is encoded in micro-batches of up
+    to batch_size images. If the encoder runs out of memory, the batch size is halved until the batch fits. Each
+    returned distribution has the same shape and dtype as the result of encoding that image on its own, but batched
+    convolutions can select different kernels, so the values are not bit identical. With a batch_size of 1, every image
+    is encoded on its own.
+
+    A cache that only requests some of the items can announce them with plan_indices. Otherwise, items are expected to
+    be requested in order of their index.
+    """
+
+    # number of micro-batches to load ahead, to find enough images of the same resolution
+    WINDOW_BATCHES = 4
+
+    def __init__(
+            self,
+            in_name: str,
+            out_name: str,
+            vae: AutoencoderKL,
+            batch_size: int = 1,
+            override_allow_mixed_precision: bool | None = None,
+    ):
+        super(BatchedEncodeVAE, self).__init__()
+        self.in_name = in_name
+        self.out_name = out_name
+        self.vae = vae
+        self.batch_size = max(1, batch_size)
+        self.override_allow_mixed_precision = override_allow_mixed_precision
+
+        self.encoded = {}
+        self.planned_indices = None
+        self.planned_positions = {}
+
+    def length(self) -> int:
+        return self.get_previous_length(self.in_name)
+
+    def get_inputs(self) -> list[str]:
+        return [self.in_name]
+
+    def get_outputs(self) -> list[str]:
+        return [self.out_name]
+
+    def start(self, variation: int):
+        self.encoded = {}
+        self.plan_indices(None)
+
+    def plan_indices(self, indices: list[int] | None):
+        """
+        Sets the indices that will be requested next, in order of their request. None resets the plan, and items are
+        expected to be requested in order of their index.
+        """
+        self.planned_indices = indices
+        self.planned_positions = {} if indices is None else {index: position for position, index in enumerate(indices)}
+
+    @torch.no_grad()
+    def __encode(self, images: Tensor) -> Tensor:
+        allow_mixed_precision = self.pipeline.allow_mixed_precision if self.override_allow_mixed_precision is None \
+            else self.override_allow_mixed_precision
+
+        images = images.to(dtype=self.vae.dtype)
+        with torch.autocast(self.pipeline.device.type, self.pipeline.dtype) if allow_mixed_precision \
+                else nullcontext():
+            return self.vae.encode(images).latent_dist.parameters
+
+    def __encode_group(self, images: list[Tensor]) -> list[Tensor]:
+        parameters = []
+        start = 0
+        while start < len(images):
+            batch = torch.stack(images[start:start + self.batch_size])
+            try:
+                batch_parameters = self.__encode(batch)
+            except torch.cuda.OutOfMemoryError:
+                if self.batch_size == 1:
+                    raise
+                del batch
+                torch.cuda.empty_cache()
+                self.batch_size //= 2
+                print(f"Out of memory while encoding images, reducing the VAE batch size to {self.batch_size}")
+                continue
+
+            # clone each sample, so a cached item does not keep the whole batch alive
+            parameters.extend(sample_parameters.unsqueeze(0).clone() for sample_parameters in batch_parameters)
+            start += len(batch)
+        return parameters
+
+    def __window_indices(self, index: int) -> list[int]:
+        window_size = self.batch_size * self.WINDOW_BATCHES
+        if self.batch_size == 1:
+            return [index]
+        if self.planned_indices is None:
+            return list(range(index, min(index + window_size, self.length())))
+        if index in self.planned_positions:
+            position = self.planned_positions[index]
+            return self.planned_indices[position:position + window_size]
+        return [index]
+
+    def __encode_window(self, index: int):
+        groups = {}
+        for window_index in self.__window_indices(index):
+            image = self.get_previous_item(self.in_name, window_index)
+            indices, images = groups.setdefault(tuple(image.shape), ([], []))
+            indices.append(window_index)
+            images.append(image)
+
+        # results of the previous window are dropped, even if they were never requested
+        self.encoded = {}
+        for indices, images in groups.values():
+            for group_index, parameters in zip(indices, self.__encode_group(images)):
+                self.encoded[group_index] = DiagonalGaussianDistribution(parameters)
+
+    def get_item(self, index: int, requested_name: str = None) -> dict:
+        if index not in self.encoded:
+            self.__encode_window(index)
+
+        return {
+            self.out_name: self.encoded[index],
+        }
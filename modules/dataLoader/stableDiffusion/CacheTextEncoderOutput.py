@@ -0,0 +1,252 @@
+import hashlib
+import mmap
+import os
+import uuid
+from typing import Callable
+
+import torch
+from mgds.MGDS import PipelineModule
+from torch import Tensor
+from tqdm import tqdm
+from transformers import CLIPTextModel, CLIPTextModelWithProjection
+
+
+class CacheTextEncoderOutput(PipelineModule):
+    """
+    Encodes tokens with a frozen text encoder and caches the result on disk.
+
+    Cache entries are keyed by the tokens, so every distinct prompt is only encoded once. All entries are stored in a
+    directory named after a fingerprint of the text encoder. The fingerprint is calculated by encoding a fixed probe
+    input, so changes to the weights, LoRA hooks or the selected layer automatically result in a new directory.
+
+    When all items of an epoch are cached, the entries they use are packed into a single file, which is memory mapped
+    while reading, like the shards of the ShardedDiskCache. Items are then returned as views into the mapped memory,
+    instead of loading a file for every item in every step. The packed file contains every cached entry, and is only
+    rewritten if an item of a later epoch is missing from it.
+
+    While is_enabled() returns False, the text encoder is not called and empty placeholder tensors are returned.
+    """
+
+    def __init__(
+            self,
+            tokens_in_name: str,
+            hidden_state_out_name: str,
+            pooled_out_name: str | None,
+            text_encoder: CLIPTextModel | CLIPTextModelWithProjection,
+            hidden_state_output_index: int,
+            apply_final_layer_norm: bool,
+            cache_dir: str,
+            is_enabled: Callable[[], bool],
+    ):
+        super(CacheTextEncoderOutput, self).__init__()
+        self.tokens_in_name = tokens_in_name
+        self.hidden_state_out_name = hidden_state_out_name
+        self.pooled_out_name = pooled_out_name
+        self.text_encoder = text_encoder
+        self.hidden_state_output_index = hidden_state_output_index
+        self.apply_final_layer_norm = apply_final_layer_norm
+        self.cache_dir = cache_dir
+        self.is_enabled = is_enabled
+
+        self.fingerprint = None
+        self.packed = None
+        self.packed_entries = None
+
+    def length(self) -> int:
+        return self.get_previous_length(self.tokens_in_name)
+
+    def get_inputs(self) -> list[str]:
+        return [self.tokens_in_name]
+
+    def get_outputs(self) -> list[str]:
+        if self.pooled_out_name is not None:
+            return [self.hidden_state_out_name, self.pooled_out_name]
+        return [self.hidden_state_out_name]
+
+    @torch.no_grad()
+    def __encode(self, tokens: Tensor) -> dict[str, Tensor]:
+        tokens = tokens.unsqueeze(0).to(self.text_encoder.device)
+        text_encoder_output = self.text_encoder(tokens, output_hidden_states=True, return_dict=True)
+
+        hidden_state = text_encoder_output.hidden_states[self.hidden_state_output_index]
+        if self.apply_final_layer_norm:
+            hidden_state = self.text_encoder.text_model.final_layer_norm(hidden_state)
+
+        output = {self.hidden_state_out_name: hidden_state.squeeze(0)}
+        if self.pooled_out_name is not None:
+            output[self.pooled_out_name] = text_encoder_output.text_embeds.squeeze(0)
+
+        return output
+
+    def __calculate_fingerprint(self) -> str:
+        probe_length = self.text_encoder.config.max_position_embeddings
+        probe_tokens = torch.arange(probe_length) % self.text_encoder.config.vocab_size
+
+        sha = hashlib.sha256()
+        sha.update(f"{self.hidden_state_output_index}-{self.apply_final_layer_norm}".encode())
+        for name, tensor in sorted(self.__encode(probe_tokens).items()):
+            sha.update(name.encode())
+            sha.update(tensor.float().cpu().numpy().tobytes())
+        return sha.hexdigest()[:16]
+
+    @staticmethod
+    def __key(tokens: Tensor) -> str:
+        return hashlib.sha256(tokens.cpu().numpy().tobytes()).hexdigest()
+
+    def __cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"text-{self.fingerprint}", key[:2], key + ".pt")
+
+    def __packed_index_path(self) -> str:
+        return os.path.join(self.cache_dir, f"text-{self.fingerprint}", "packed-index.pt")
+
+    def __get_cached(self, key: str, tokens: Tensor) -> dict[str, Tensor]:
+        path = self.__cache_path(key)
+        if os.path.exists(path):
+            return torch.load(path, map_location=self.pipeline.device)
+
+        output = {name: tensor.cpu() for name, tensor in self.__encode(tokens).items()}
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + f".{os.getpid()}.tmp"
+        torch.save(output, temp_path)
+        os.replace(temp_path, path)
+
+        return {name: tensor.to(self.pipeline.device) for name, tensor in output.items()}
+
+    def __cached_keys(self) -> list[str]:
+        directory = os.path.dirname(self.__packed_index_path())
+        keys = []
+        for dirname in os.listdir(directory):
+            if len(dirname) == 2 and os.path.isdir(os.path.join(directory, dirname)):
+                keys.extend(
+                    filename.removesuffix(".pt") for filename in os.listdir(os.path.join(directory, dirname))
+                    if filename.endswith(".pt")
+                )
+        return sorted(keys)
+
+    def __write_packed(self, keys: list[str], previous_index: dict | None) -> dict:
+        """
+        Writes the cached outputs of all keys into a new packed file, and returns its index. Outputs that are already
+        in the previous packed file are copied from it, all others are loaded from their own files.
+        """
+        directory = os.path.dirname(self.__packed_index_path())
+        filename = f"packed-{uuid.uuid4().hex}.bin"
+        entries = {}
+        offset = 0
+
+        previous_packed = None
+        previous_entries = {}
+        if previous_index is not None:
+            with open(os.path.join(directory, previous_index['filename']), "rb") as f:
+                previous_packed = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            previous_entries = previous_index['entries']
+
+        try:
+            with open(os.path.join(directory, filename), "wb") as f:
+                for key in tqdm(keys, desc="packing text encoder outputs"):
+                    if key in previous_entries:
+                        items = [
+                            (name, previous_packed[entry[0]:entry[0] + entry[3]], entry[1], entry[2])
+                            for name, entry in previous_entries[key].items()
+                        ]
+                    else:
+                        items = []
+                        for name, tensor in torch.load(self.__cache_path(key)).items():
+                            data = tensor.contiguous().flatten().view(torch.uint8).numpy().tobytes()
+                            items.append((name, data, str(tensor.dtype).removeprefix('torch.'), tuple(tensor.shape)))
+
+                    key_entries = {}
+                    for name, data, dtype, shape in items:
+                        # tensors are aligned to 64 bytes, like in the shards of the ShardedDiskCache
+                        aligned_offset = (offset + 63) // 64 * 64
+                        f.write(bytes(aligned_offset - offset))
+                        f.write(data)
+                        offset = aligned_offset + len(data)
+                        key_entries[name] = (aligned_offset, dtype, shape, len(data))
+                    entries[key] = key_entries
+        finally:
+            if previous_packed is not None:
+                previous_packed.close()
+
+        # the index is replaced after the packed file is complete, so it never points into an incomplete file
+        index = {'filename': filename, 'entries': entries}
+        index_path = self.__packed_index_path()
+        temp_path = index_path + f".{os.getpid()}.tmp"
+        torch.save(index, temp_path)
+        os.replace(temp_path, index_path)
+
+        for other_filename in os.listdir(directory):
+            if other_filename.startswith("packed-") and other_filename.endswith(".bin") and other_filename != filename:
+                try:
+                    os.remove(os.path.join(directory, other_filename))
+                except OSError:
+                    # the file can still be mapped by another cache, it is removed by a later pack
+                    pass
+
+        return index
+
+    def __pack(self, keys: list[str]):
+        self.packed = None
+        self.packed_entries = None
+        if not keys:
+            return
+
+        index_path = self.__packed_index_path()
+        index = torch.load(index_path) if os.path.isfile(index_path) else None
+        if index is not None and not os.path.isfile(os.path.join(os.path.dirname(index_path), index['filename'])):
+            index = None
+        if index is None or not set(keys).issubset(index['entries'].keys()):
+            # every cached output is packed, so later epochs that use other prompts don't need a new pack
+            index = self.__write_packed(self.__cached_keys(), index)
+
+        with open(os.path.join(os.path.dirname(index_path), index['filename']), "rb") as f:
+            # copy on write, to return writable tensors without modifying the file
+            self.packed = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.packed_entries = index['entries']
+
+    def __read_packed(self, key: str) -> dict[str, Tensor] | None:
+        if self.packed_entries is None or key not in self.packed_entries:
+            return None
+
+        output = {}
+        for name, (offset, dtype, shape, _) in self.packed_entries[key].items():
+            count = 1
+            for size in shape:
+                count *= size
+            tensor = torch.frombuffer(self.packed, dtype=getattr(torch, dtype), count=count, offset=offset)
+            output[name] = tensor.reshape(shape).to(self.pipeline.device)
+        return output
+
+    def cache_all(self):
+        """
+        Encodes the tokens of every item of the current epoch that are not yet cached. The text encoder should be on
+        the train device when this is called. Afterward, it is no longer needed during this epoch.
+        """
+        if not self.is_enabled():
+            return
+
+        self.fingerprint = self.__calculate_fingerprint()
+
+        keys = []
+        for index in tqdm(range(self.length()), desc="caching text encoder outputs"):
+            tokens = self.get_previous_item(self.tokens_in_name, index)
+            key = self.__key(tokens)
+            if not os.path.exists(self.__cache_path(key)):
+                self.__get_cached(key, tokens)
+            keys.append(key)
+
+        self.__pack(sorted(set(keys)))
+
+    def get_item(self, index: int, requested_name: str = None) -> dict:
+        if not self.is_enabled():
+            return {name: torch.zeros(0, device=self.pipeline.device) for name in self.get_outputs()}
+
+        if self.fingerprint is None:
+            self.fingerprint = self.__calculate_fingerprint()
+
+        tokens = self.get_previous_item(self.tokens_in_name, index)
+        key = self.__key(tokens)
+        output = self.__read_packed(key)
+        if output is None:
+            output = self.__get_cached(key, tokens)
+        return output
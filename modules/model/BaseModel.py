@@ -3,6 +3,7 @@ from abc import ABCMeta
 from torch.optim import Optimizer
 
 from modules.module.EMAModule import EMAModuleWrapper
+from modules.module.LoRAModule import LoRAModuleWrapper
 from modules.util.TrainProgress import TrainProgress
 from modules.util.enum.ModelType import ModelType
 from modules.util.modelSpec.ModelSpec import ModelSpec
@@ -31,3 +32,9 @@ class BaseModel(metaclass=ABCMeta):
         self.ema_state_dict = ema_state_dict
         self.train_progress = train_progress if train_progress is not None else TrainProgress()
         self.model_spec = model_spec
+
+    def loras(self) -> list[LoRAModuleWrapper]:
+        """
+        Returns all LoRA networks of the model
+        """
+        return []
@@ -81,6 +81,9 @@ class KandinskyModel(BaseModel):
 
         self.unet_lora = unet_lora
 
+    def loras(self) -> list[LoRAModuleWrapper]:
+        return [self.unet_lora] if self.unet_lora is not None else []
+
     def create_prior_pipeline(self) -> KandinskyPriorPipeline:
         return KandinskyPriorPipeline(
             tokenizer=self.prior_tokenizer,
@@ -76,6 +76,9 @@ class StableDiffusionModel(BaseModel):
         self.unet_lora = unet_lora
         self.sd_config = sd_config
 
+    def loras(self) -> list[LoRAModuleWrapper]:
+        return [lora for lora in [self.text_encoder_lora, self.unet_lora] if lora is not None]
+
     def create_pipeline(self) -> DiffusionPipeline:
         if self.model_type.has_depth_input():
             return StableDiffusionDepth2ImgPipeline(
@@ -83,6 +83,11 @@ class StableDiffusionXLModel(BaseModel):
         self.unet_lora = unet_lora
         self.sd_config = sd_config
 
+    def loras(self) -> list[LoRAModuleWrapper]:
+        return [
+            lora for lora in [self.text_encoder_1_lora, self.text_encoder_2_lora, self.unet_lora] if lora is not None
+        ]
+
     def create_pipeline(self) -> DiffusionPipeline:
         return StableDiffusionXLPipeline(
             vae=self.vae,
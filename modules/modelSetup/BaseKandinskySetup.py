@@ -9,7 +9,7 @@ from torch import Tensor
 from modules.model.KandinskyModel import KandinskyModel
 from modules.modelSetup.BaseDiffusionModelSetup import BaseDiffusionModelSetup
 from modules.modelSetup.kandinsky.kandinsky import KandinskyLoss
-from modules.util import loss_util
+from modules.util import loss_util, distributed_util, compile_util
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
 from modules.util.enum.AttentionMechanism import AttentionMechanism
@@ -56,6 +56,14 @@ class BaseKandinskySetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
                         f" correctly and a GPU is available: {e}"
                     )
 
+        if args.channels_last:
+            compile_util.enable_channels_last(model.unet)
+
+        # blocks need to be compiled before gradient checkpointing wraps their forward functions
+        compile_util.enable_compile_for_blocks(model.unet, args)
+        if args.compile_text_encoder:
+            compile_util.enable_compile_for_blocks(model.text_encoder, args)
+
         if args.gradient_checkpointing:
             model.prior_text_encoder.gradient_checkpointing_enable()
             model.prior_image_encoder.gradient_checkpointing_enable()
@@ -80,7 +88,8 @@ class BaseKandinskySetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
             scaled_latent_conditioning_image = latent_conditioning_image * movq_scaling_factor
 
         generator = torch.Generator(device=args.train_device)
-        generator.manual_seed(train_progress.global_step)
+        # every rank uses different noise
+        generator.manual_seed(train_progress.global_step * distributed_util.world_size() + distributed_util.rank())
 
         latent_noise = self.create_noise(scaled_latent_image, args, generator)
 
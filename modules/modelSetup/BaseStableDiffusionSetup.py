@@ -10,10 +10,11 @@ from modules.model.StableDiffusionModel import StableDiffusionModel
 from modules.modelSetup.BaseDiffusionModelSetup import BaseDiffusionModelSetup
 from modules.modelSetup.stableDiffusion.checkpointing_util import \
     enable_checkpointing_for_transformer_blocks, enable_checkpointing_for_clip_encoder_layers
-from modules.util import loss_util
+from modules.util import loss_util, distributed_util, compile_util
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
 from modules.util.enum.AttentionMechanism import AttentionMechanism
+from modules.util.text_encoder_util import is_text_encoder_output_cached
 
 
 class BaseStableDiffusionSetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
@@ -47,6 +48,14 @@ class BaseStableDiffusionSetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
                         f" correctly and a GPU is available: {e}"
                     )
 
+        if args.channels_last:
+            compile_util.enable_channels_last(model.unet)
+
+        # blocks need to be compiled before gradient checkpointing wraps their forward functions
+        compile_util.enable_compile_for_blocks(model.unet, args)
+        if args.compile_text_encoder:
+            compile_util.enable_compile_for_blocks(model.text_encoder, args)
+
         if args.gradient_checkpointing:
             model.vae.enable_gradient_checkpointing()
             model.unet.enable_gradient_checkpointing()
@@ -72,7 +81,8 @@ class BaseStableDiffusionSetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
             scaled_latent_conditioning_image = latent_conditioning_image * vae_scaling_factor
 
         generator = torch.Generator(device=args.train_device)
-        generator.manual_seed(train_progress.global_step)
+        # every rank uses different noise
+        generator.manual_seed(train_progress.global_step * distributed_util.world_size() + distributed_util.rank())
 
         latent_noise = self.create_noise(scaled_latent_image, args, generator)
 
@@ -88,13 +98,16 @@ class BaseStableDiffusionSetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
             original_samples=scaled_latent_image, noise=latent_noise, timesteps=timestep
         )
 
-        # TODO: use attention mask if this is true:
-        # hasattr(text_encoder.config, "use_attention_mask") and text_encoder.config.use_attention_mask:
-        text_encoder_output = model.text_encoder(batch['tokens'], return_dict=True, output_hidden_states=True)
-        final_layer_norm = model.text_encoder.text_model.final_layer_norm
-        text_encoder_output = final_layer_norm(
-            text_encoder_output.hidden_states[-(1 + args.text_encoder_layer_skip)]
-        )
+        if is_text_encoder_output_cached(args, train_progress.epoch):
+            text_encoder_output = batch['text_encoder_hidden_state']
+        else:
+            # TODO: use attention mask if this is true:
+            # hasattr(text_encoder.config, "use_attention_mask") and text_encoder.config.use_attention_mask:
+            text_encoder_output = model.text_encoder(batch['tokens'], return_dict=True, output_hidden_states=True)
+            final_layer_norm = model.text_encoder.text_model.final_layer_norm
+            text_encoder_output = final_layer_norm(
+                text_encoder_output.hidden_states[-(1 + args.text_encoder_layer_skip)]
+            )
 
         if args.model_type.has_mask_input() and args.model_type.has_conditioning_image_input():
             latent_input = torch.concat(
@@ -10,10 +10,11 @@ from modules.model.StableDiffusionXLModel import StableDiffusionXLModel
 from modules.modelSetup.BaseDiffusionModelSetup import BaseDiffusionModelSetup
 from modules.modelSetup.stableDiffusion.checkpointing_util import \
     enable_checkpointing_for_transformer_blocks, enable_checkpointing_for_clip_encoder_layers
-from modules.util import loss_util
+from modules.util import loss_util, distributed_util, compile_util
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
 from modules.util.enum.AttentionMechanism import AttentionMechanism
+from modules.util.text_encoder_util import is_text_encoder_output_cached
 
 
 class BaseStableDiffusionXLSetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
@@ -47,6 +48,15 @@ class BaseStableDiffusionXLSetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
                         f" correctly and a GPU is available: {e}"
                     )
 
+        if args.channels_last:
+            compile_util.enable_channels_last(model.unet)
+
+        # blocks need to be compiled before gradient checkpointing wraps their forward functions
+        compile_util.enable_compile_for_blocks(model.unet, args)
+        if args.compile_text_encoder:
+            compile_util.enable_compile_for_blocks(model.text_encoder_1, args)
+            compile_util.enable_compile_for_blocks(model.text_encoder_2, args)
+
         if args.gradient_checkpointing:
             model.unet.enable_gradient_checkpointing()
             enable_checkpointing_for_transformer_blocks(model.unet)
@@ -71,7 +81,8 @@ class BaseStableDiffusionXLSetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
             scaled_latent_conditioning_image = batch['latent_conditioning_image'] * vae_scaling_factor
 
         generator = torch.Generator(device=args.train_device)
-        generator.manual_seed(train_progress.global_step)
+        # every rank uses different noise
+        generator.manual_seed(train_progress.global_step * distributed_util.world_size() + distributed_util.rank())
 
         latent_noise = self.create_noise(scaled_latent_image, args, generator)
 
@@ -87,16 +98,21 @@ class BaseStableDiffusionXLSetup(BaseDiffusionModelSetup, metaclass=ABCMeta):
             original_samples=scaled_latent_image, noise=latent_noise, timesteps=timestep
         )
 
-        text_encoder_1_output = model.text_encoder_1(
-            batch['tokens_1'], output_hidden_states=True, return_dict=True
-        )
-        text_encoder_1_output = text_encoder_1_output.hidden_states[-(2 + args.text_encoder_layer_skip)]
+        if is_text_encoder_output_cached(args, train_progress.epoch):
+            text_encoder_1_output = batch['text_encoder_1_hidden_state']
+            text_encoder_2_output = batch['text_encoder_2_hidden_state']
+            pooled_text_encoder_2_output = batch['text_encoder_2_pooled_state']
+        else:
+            text_encoder_1_output = model.text_encoder_1(
+                batch['tokens_1'], output_hidden_states=True, return_dict=True
+            )
+            text_encoder_1_output = text_encoder_1_output.hidden_states[-(2 + args.text_encoder_layer_skip)]
 
-        text_encoder_2_output = model.text_encoder_2(
-            batch['tokens_2'], output_hidden_states=True, return_dict=True
-        )
-        pooled_text_encoder_2_output = text_encoder_2_output.text_embeds
-        text_encoder_2_output = text_encoder_2_output.hidden_states[-(2 + args.text_encoder_layer_skip)]
+            text_encoder_2_output = model.text_encoder_2(
+                batch['tokens_2'], output_hidden_states=True, return_dict=True
+            )
+            pooled_text_encoder_2_output = text_encoder_2_output.text_embeds
+            text_encoder_2_output = text_encoder_2_output.hidden_states[-(2 + args.text_encoder_layer_skip)]
 
         text_encoder_output = torch.concat([text_encoder_1_output, text_encoder_2_output], dim=-1)
 
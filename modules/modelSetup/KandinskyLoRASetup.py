@@ -76,6 +76,9 @@ class KandinskyLoRASetup(BaseKandinskySetup):
 
         model.unet_lora.to(dtype=args.lora_weight_dtype.torch_dtype())
 
+        if args.lora_flat_parameters:
+            model.unet_lora.flatten_parameters()
+
         model.unet_lora.hook_to_module()
 
         model.optimizer = create.create_optimizer(
@@ -8,6 +8,7 @@ from modules.modelSetup.BaseStableDiffusionSetup import BaseStableDiffusionSetup
 from modules.util import create
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
+from modules.util.text_encoder_util import is_text_encoder_output_cached
 
 
 class StableDiffusionFineTuneSetup(BaseStableDiffusionSetup):
@@ -116,7 +117,10 @@ class StableDiffusionFineTuneSetup(BaseStableDiffusionSetup):
             model: StableDiffusionModel,
             args: TrainArgs,
     ):
-        model.text_encoder.to(self.train_device)
+        if is_text_encoder_output_cached(args, model.train_progress.epoch):
+            model.text_encoder.to(self.temp_device)
+        else:
+            model.text_encoder.to(self.train_device)
         model.vae.to(self.train_device if self.debug_mode else self.temp_device)
         model.unet.to(self.train_device)
         if model.depth_estimator is not None:
@@ -9,6 +9,7 @@ from modules.module.LoRAModule import LoRAModuleWrapper
 from modules.util import create
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
+from modules.util.text_encoder_util import is_text_encoder_output_cached
 
 
 class StableDiffusionLoRASetup(BaseStableDiffusionSetup):
@@ -92,6 +93,10 @@ class StableDiffusionLoRASetup(BaseStableDiffusionSetup):
         model.text_encoder_lora.to(dtype=args.lora_weight_dtype.torch_dtype())
         model.unet_lora.to(dtype=args.lora_weight_dtype.torch_dtype())
 
+        if args.lora_flat_parameters:
+            model.text_encoder_lora.flatten_parameters()
+            model.unet_lora.flatten_parameters()
+
         model.text_encoder_lora.hook_to_module()
         model.unet_lora.hook_to_module()
 
@@ -136,7 +141,10 @@ class StableDiffusionLoRASetup(BaseStableDiffusionSetup):
             model: StableDiffusionModel,
             args: TrainArgs,
     ):
-        model.text_encoder.to(self.train_device)
+        if is_text_encoder_output_cached(args, model.train_progress.epoch):
+            model.text_encoder.to(self.temp_device)
+        else:
+            model.text_encoder.to(self.train_device)
         model.vae.to(self.train_device if self.debug_mode else self.temp_device)
         model.unet.to(self.train_device)
         if model.depth_estimator is not None:
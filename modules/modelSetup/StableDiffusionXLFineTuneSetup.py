@@ -8,6 +8,7 @@ from modules.modelSetup.BaseStableDiffusionXLSetup import BaseStableDiffusionXLS
 from modules.util import create
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
+from modules.util.text_encoder_util import is_text_encoder_output_cached
 
 
 class StableDiffusionXLFineTuneSetup(BaseStableDiffusionXLSetup):
@@ -114,8 +115,12 @@ class StableDiffusionXLFineTuneSetup(BaseStableDiffusionXLSetup):
             model: StableDiffusionXLModel,
             args: TrainArgs,
     ):
-        model.text_encoder_1.to(self.train_device)
-        model.text_encoder_2.to(self.train_device)
+        if is_text_encoder_output_cached(args, model.train_progress.epoch):
+            model.text_encoder_1.to(self.temp_device)
+            model.text_encoder_2.to(self.temp_device)
+        else:
+            model.text_encoder_1.to(self.train_device)
+            model.text_encoder_2.to(self.train_device)
         model.vae.to(self.temp_device)
         model.unet.to(self.train_device)
 
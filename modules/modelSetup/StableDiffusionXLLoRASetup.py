@@ -9,6 +9,7 @@ from modules.module.LoRAModule import LoRAModuleWrapper
 from modules.util import create
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
+from modules.util.text_encoder_util import is_text_encoder_output_cached
 
 
 class StableDiffusionXLLoRASetup(BaseStableDiffusionXLSetup):
@@ -106,15 +107,27 @@ class StableDiffusionXLLoRASetup(BaseStableDiffusionXLSetup):
             model.unet_lora.requires_grad_(train_unet)
 
         if model.text_encoder_1_lora is not None:
-            model.text_encoder_1_lora.hook_to_module()
             model.text_encoder_1_lora.to(dtype=args.lora_weight_dtype.torch_dtype())
         if model.text_encoder_2_lora is not None:
-            model.text_encoder_2_lora.hook_to_module()
             model.text_encoder_2_lora.to(dtype=args.lora_weight_dtype.torch_dtype())
         if model.unet_lora is not None:
-            model.unet_lora.hook_to_module()
             model.unet_lora.to(dtype=args.lora_weight_dtype.torch_dtype())
 
+        if args.lora_flat_parameters:
+            if model.text_encoder_1_lora is not None:
+                model.text_encoder_1_lora.flatten_parameters()
+            if model.text_encoder_2_lora is not None:
+                model.text_encoder_2_lora.flatten_parameters()
+            if model.unet_lora is not None:
+                model.unet_lora.flatten_parameters()
+
+        if model.text_encoder_1_lora is not None:
+            model.text_encoder_1_lora.hook_to_module()
+        if model.text_encoder_2_lora is not None:
+            model.text_encoder_2_lora.hook_to_module()
+        if model.unet_lora is not None:
+            model.unet_lora.hook_to_module()
+
         model.optimizer = create.create_optimizer(
             self.create_parameters_for_optimizer(model, args), model.optimizer_state_dict, args
         )
@@ -155,8 +168,12 @@ class StableDiffusionXLLoRASetup(BaseStableDiffusionXLSetup):
             model: StableDiffusionXLModel,
             args: TrainArgs,
     ):
-        model.text_encoder_1.to(self.train_device)
-        model.text_encoder_2.to(self.train_device)
+        if is_text_encoder_output_cached(args, model.train_progress.epoch):
+            model.text_encoder_1.to(self.temp_device)
+            model.text_encoder_2.to(self.temp_device)
+        else:
+            model.text_encoder_1.to(self.train_device)
+            model.text_encoder_2.to(self.train_device)
         model.vae.to(self.temp_device)
         model.unet.to(self.train_device)
 
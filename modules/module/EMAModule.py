@@ -2,23 +2,81 @@ from typing import Iterable
 
 import torch
 
+from modules.util.enum.EMAPrecision import EMAPrecision
+
+
+class EMAStagingCache:
+    """
+    Holds the staging buffers and copy streams of an EMA. They are reused between steps, but never copied with the EMA,
+    for example when a checkpoint snapshot is created.
+    """
+
+    __slots__ = ('buffers', 'streams')
+
+    def __init__(self):
+        # (device, dtype, pinned) -> two staging buffers
+        self.buffers = {}
+        # device -> stream used to copy parameters into the staging buffers
+        self.streams = {}
+
+    def __deepcopy__(self, memo):
+        return EMAStagingCache()
+
 
 class EMAModuleWrapper:
+    """
+    Keeps an exponential moving average of the trained parameters.
+
+    The EMA parameters are grouped by device and data type, and each group is updated with a single multi-tensor lerp.
+    If an EMA parameter has a different device or data type than its parameter, the parameters are copied in chunks
+    through two reusable staging buffers. With pinned staging, the buffers of a CPU EMA are in pinned memory, and the
+    copy of each chunk from the train device overlaps the update of the previous chunk.
+
+    With a reduced precision, floating point EMA parameters are stored as bfloat16. Each update is calculated in
+    float32 chunks, and rounded back either stochastically, or to the nearest value while the rounding error is kept in
+    a stochastically rounded bfloat16 residual. Both keep small updates of a high decay from being rounded away.
+    Stochastic rounding halves the memory of a float32 EMA. The residual needs as much memory as a float32 EMA, but is
+    more accurate, and the EMA parameters can be swapped directly into a bfloat16 model.
+
+    To use the EMA weights for sampling or saving, they are swapped into the model instead of copied. EMA parameters
+    on the same device exchange their storage with the trained parameters, other EMA parameters exchange their values
+    in chunks through a staging buffer.
+
+    Args:
+        parameters: the trained parameters
+        decay: the maximum decay of the EMA
+        update_step_interval: the number of optimization steps between two EMA updates
+        device: the device of the EMA parameters
+        pinned_staging: use pinned staging buffers for a CPU EMA
+        precision: the storage precision of the EMA parameters
+    """
+
+    # the size of each staging buffer
+    STAGING_BUFFER_BYTES = 64 * 1024 * 1024
+
     def __init__(
             self,
             parameters: Iterable[torch.nn.Parameter],
             decay: float = 0.9999,
             update_step_interval: int = 1,
             device: torch.device | None = None,
+            pinned_staging: bool = False,
+            precision: EMAPrecision = EMAPrecision.FULL,
     ):
-        parameters = list(parameters)
-        self.ema_parameters = [p.clone().detach().to(device) for p in parameters]
-
         self.temp_stored_parameters = None
+        self.swapped_parameters = None
 
         self.decay = decay
         self.update_step_interval = update_step_interval
         self.device = device
+        self.pinned_staging = pinned_staging
+        self.precision = precision
+
+        self.staging_cache = EMAStagingCache()
+
+        self.ema_parameters = None
+        self.ema_residuals = None
+        self.__set_ema_parameters(list(parameters))
 
         # TODO: add an automatic decay calculation based on this formula:
         # The impact of the last n steps can be calculated as:
@@ -34,6 +92,167 @@ class EMAModuleWrapper:
             self.decay
         )
 
+    def __set_ema_parameters(
+            self,
+            ema_parameters: list[torch.Tensor],
+            ema_residuals: list[torch.Tensor] | None = None,
+            dtypes: list[torch.dtype] | None = None,
+    ):
+        # converts the EMA parameters to the device and precision of this EMA. Residuals are added to their parameters
+        # first, so a state can be converted between all precisions. Full precision parameters are converted to dtypes.
+        # Each tensor is converted separately, to keep the peak memory low
+        self.ema_parameters = []
+        self.ema_residuals = [] if self.precision == EMAPrecision.BFLOAT_16_RESIDUAL else None
+
+        for index, ema_parameter in enumerate(ema_parameters):
+            ema_parameter = ema_parameter.detach()
+            if ema_residuals is not None and ema_parameter.is_floating_point():
+                ema_parameter = ema_parameter.float() + ema_residuals[index].to(ema_parameter.device).float()
+
+            # the EMA tensors are always contiguous, because chunked updates view them as flat tensors
+            if self.precision == EMAPrecision.FULL or not ema_parameter.is_floating_point():
+                dtype = dtypes[index] if dtypes is not None and ema_parameter.is_floating_point() else None
+                self.ema_parameters.append(
+                    ema_parameter.to(device=self.device, dtype=dtype, copy=True, memory_format=torch.contiguous_format)
+                )
+                if self.ema_residuals is not None:
+                    self.ema_residuals.append(torch.zeros_like(self.ema_parameters[-1]))
+                continue
+
+            low_precision_parameter = ema_parameter.to(
+                dtype=torch.bfloat16, copy=True, memory_format=torch.contiguous_format
+            )
+            if self.ema_residuals is not None:
+                residual = ema_parameter.float() - low_precision_parameter.float()
+                self.ema_residuals.append(residual.to(device=self.device, dtype=torch.bfloat16))
+            self.ema_parameters.append(low_precision_parameter.to(device=self.device))
+
+    def __staging_buffers(self, device: torch.device, dtype: torch.dtype, pin_memory: bool) -> list[torch.Tensor]:
+        key = (device, dtype, pin_memory)
+        if key not in self.staging_cache.buffers:
+            numel = self.STAGING_BUFFER_BYTES // torch.empty(0, dtype=dtype).element_size()
+            self.staging_cache.buffers[key] = [
+                torch.empty(numel, dtype=dtype, device=device, pin_memory=pin_memory) for _ in range(2)
+            ]
+        return self.staging_cache.buffers[key]
+
+    @staticmethod
+    def __chunks(
+            ema_tensor_lists: list[list[torch.Tensor]],
+            parameters: list[torch.Tensor],
+            chunk_numel: int,
+    ) -> list[list[tuple[int, list[torch.Tensor], torch.Tensor]]]:
+        # splits the flattened tensors into chunks of (buffer offset, ema tensor slices, parameter slice)
+        chunks = [[]]
+        filled = 0
+        for index, parameter in enumerate(parameters):
+            ema_flats = [ema_tensors[index].view(-1) for ema_tensors in ema_tensor_lists]
+            flat = parameter.detach().reshape(-1)
+            start = 0
+            while start < flat.numel():
+                if filled == chunk_numel:
+                    chunks.append([])
+                    filled = 0
+                end = start + min(flat.numel() - start, chunk_numel - filled)
+                chunks[-1].append((filled, [ema_flat[start:end] for ema_flat in ema_flats], flat[start:end]))
+                filled += end - start
+                start = end
+        return [chunk for chunk in chunks if chunk]
+
+    def __staged_lerp(self, ema_parameters: list[torch.Tensor], parameters: list[torch.Tensor], weight: float):
+        ema_device = ema_parameters[0].device
+        device = parameters[0].device
+
+        # copies from a cuda device to the cpu run on a separate stream, overlapping the update of the previous chunk
+        overlap = ema_device.type == 'cpu' and device.type == 'cuda'
+        buffers = self.__staging_buffers(ema_device, ema_parameters[0].dtype, overlap and self.pinned_staging)
+        chunks = self.__chunks([ema_parameters], parameters, buffers[0].numel())
+        if not chunks:
+            return
+
+        if overlap:
+            if device not in self.staging_cache.streams:
+                self.staging_cache.streams[device] = torch.cuda.Stream(device)
+            copy_stream = self.staging_cache.streams[device]
+            copy_stream.wait_stream(torch.cuda.current_stream(device))
+
+        def copy_chunk(chunk_index: int) -> torch.cuda.Event | None:
+            buffer = buffers[chunk_index % 2]
+            if not overlap:
+                for offset, _, parameter_slice in chunks[chunk_index]:
+                    buffer[offset:offset + parameter_slice.numel()].copy_(parameter_slice)
+                return None
+
+            with torch.cuda.stream(copy_stream):
+                for offset, _, parameter_slice in chunks[chunk_index]:
+                    buffer[offset:offset + parameter_slice.numel()].copy_(parameter_slice, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(copy_stream)
+            return event
+
+        event = copy_chunk(0)
+        for chunk_index, chunk in enumerate(chunks):
+            # the other buffer was last read by the update of the previous chunk, which is already finished
+            next_event = copy_chunk(chunk_index + 1) if chunk_index + 1 < len(chunks) else None
+            if event is not None:
+                event.synchronize()
+
+            buffer = buffers[chunk_index % 2]
+            torch._foreach_lerp_(
+                [ema_slices[0] for _, ema_slices, _ in chunk],
+                [buffer[offset:offset + parameter_slice.numel()] for offset, _, parameter_slice in chunk],
+                weight,
+            )
+            event = next_event
+
+    @staticmethod
+    def __stochastic_round(values: torch.Tensor, noise_buffer: torch.Tensor):
+        # adds random bits below the last bfloat16 bit, then truncates the float32 values to bfloat16
+        bits = values.view(torch.int32)
+        bits.add_(noise_buffer.view(torch.int32).random_(0, 1 << 16))
+        bits.bitwise_and_(-(1 << 16))
+
+    def __low_precision_lerp(
+            self,
+            ema_parameters: list[torch.Tensor],
+            ema_residuals: list[torch.Tensor] | None,
+            parameters: list[torch.Tensor],
+            weight: float,
+    ):
+        # the update is calculated in float32, in chunks of the size of the staging buffers
+        buffers = self.__staging_buffers(ema_parameters[0].device, torch.float32, False)
+        ema_tensor_lists = [ema_parameters] if ema_residuals is None else [ema_parameters, ema_residuals]
+
+        for chunk in self.__chunks(ema_tensor_lists, parameters, buffers[0].numel()):
+            last_offset, _, last_parameter_slice = chunk[-1]
+            values = buffers[0][:last_offset + last_parameter_slice.numel()]
+            targets = buffers[1][:values.numel()]
+            slices = [(offset, offset + parameter_slice.numel(), ema_slices, parameter_slice)
+                      for offset, ema_slices, parameter_slice in chunk]
+
+            for start, end, ema_slices, parameter_slice in slices:
+                values[start:end].copy_(ema_slices[0])
+                if ema_residuals is not None:
+                    values[start:end].add_(ema_slices[1])
+                targets[start:end].copy_(parameter_slice)
+
+            values.lerp_(targets, weight)
+
+            if ema_residuals is None:
+                self.__stochastic_round(values, targets)
+                for start, end, ema_slices, _ in slices:
+                    ema_slices[0].copy_(values[start:end])
+            else:
+                # rounds to the nearest value, and keeps the rounding error in the residual
+                for start, end, ema_slices, _ in slices:
+                    ema_slices[0].copy_(values[start:end])
+                    targets[start:end].copy_(ema_slices[0])
+                values.sub_(targets)
+                # the residual itself is rounded stochastically, so its rounding errors don't add up over many steps
+                self.__stochastic_round(values, targets)
+                for start, end, ema_slices, _ in slices:
+                    ema_slices[1].copy_(values[start:end])
+
     @torch.no_grad()
     def step(self, parameters: Iterable[torch.nn.Parameter], optimization_step):
         parameters = list(parameters)
@@ -41,46 +260,136 @@ class EMAModuleWrapper:
         one_minus_decay = 1 - self.get_current_decay(optimization_step)
 
         if (optimization_step + 1) % self.update_step_interval == 0:
-            for ema_parameter, parameter in zip(self.ema_parameters, parameters):
+            # (ema device, ema dtype, device, dtype) -> (ema parameters, ema residuals, parameters)
+            groups = {}
+            for index, (ema_parameter, parameter) in enumerate(zip(self.ema_parameters, parameters)):
                 if parameter.requires_grad:
-                    if ema_parameter.device == parameter.device:
-                        ema_parameter.add_((one_minus_decay * self.update_step_interval) * (parameter - ema_parameter))
-                    else:
-                        # in place calculations to save memory
-                        parameter_copy = parameter.detach().to(ema_parameter.device)
-                        parameter_copy.sub_(ema_parameter)
-                        parameter_copy.mul_(one_minus_decay * self.update_step_interval)
-                        ema_parameter.add_(parameter_copy)
-                        del parameter_copy
+                    key = (ema_parameter.device, ema_parameter.dtype, parameter.device, parameter.dtype)
+                    ema_group, residual_group, group = groups.setdefault(key, ([], [], []))
+                    ema_group.append(ema_parameter)
+                    if self.ema_residuals is not None:
+                        residual_group.append(self.ema_residuals[index])
+                    group.append(parameter.detach())
+
+            # lerp(ema, parameter, weight) = ema + weight * (parameter - ema)
+            weight = one_minus_decay * self.update_step_interval
+            for (ema_device, ema_dtype, device, dtype), (ema_group, residual_group, group) in groups.items():
+                if self.precision != EMAPrecision.FULL and ema_dtype == torch.bfloat16:
+                    self.__low_precision_lerp(ema_group, residual_group if self.ema_residuals is not None else None,
+                                              group, weight)
+                elif ema_device == device and ema_dtype == dtype:
+                    torch._foreach_lerp_(ema_group, group, weight)
+                else:
+                    self.__staged_lerp(ema_group, group, weight)
 
     def to(self, device: torch.device = None, dtype: torch.dtype = None) -> None:
+        # the data type of a reduced precision EMA can't be changed
+        if self.precision != EMAPrecision.FULL:
+            dtype = None
+
         self.device = device
         self.ema_parameters = [
             p.to(device=device, dtype=dtype) if p.is_floating_point() else p.to(device=device)
             for p in self.ema_parameters
         ]
+        if self.ema_residuals is not None:
+            self.ema_residuals = [r.to(device=device) for r in self.ema_residuals]
 
-    def copy_ema_to(self, parameters: Iterable[torch.nn.Parameter], store_temp: bool = True) -> None:
-        if store_temp:
-            self.temp_stored_parameters = [parameter.detach().cpu() for parameter in parameters]
+    def __swap(self, index: int, parameter: torch.nn.Parameter):
+        ema_parameter = self.ema_parameters[index]
+
+        # The storage of a flat parameter can't be exchanged, because other parameters are views into it. The storage
+        # of a parameter in a different memory format, for example channels last, is not exchanged either, to keep the
+        # memory format of the model.
+        if ema_parameter.device == parameter.device and ema_parameter.stride() == parameter.stride() \
+                and not getattr(parameter, 'has_views', False):
+            # exchanges the storage of both tensors without copying
+            self.ema_parameters[index] = parameter.data
+            parameter.data = ema_parameter
+            return
 
+        # Otherwise, exchanges the values in chunks of rows through a staging buffer on the device of the EMA. The
+        # chunks are copied with their strides, so the parameter doesn't need to be contiguous.
+        pin_memory = self.pinned_staging and ema_parameter.device.type == 'cpu' and parameter.device.type == 'cuda'
+        buffer = self.__staging_buffers(ema_parameter.device, ema_parameter.dtype, pin_memory)[0]
+        ema_rows = ema_parameter if ema_parameter.dim() > 0 else ema_parameter.unsqueeze(0)
+        rows = parameter.data if parameter.dim() > 0 else parameter.data.unsqueeze(0)
+        row_numel = max(1, rows[0].numel()) if rows.shape[0] > 0 else 1
+        rows_per_chunk = max(1, buffer.numel() // row_numel)
+        for start in range(0, rows.shape[0], rows_per_chunk):
+            end = min(start + rows_per_chunk, rows.shape[0])
+            ema_chunk = ema_rows[start:end]
+            chunk = rows[start:end]
+            if chunk.numel() <= buffer.numel():
+                chunk_buffer = buffer[:chunk.numel()].view(chunk.shape)
+            else:
+                # a single row that doesn't fit into the staging buffer
+                chunk_buffer = torch.empty_like(ema_chunk)
+            chunk_buffer.copy_(chunk)
+            chunk.copy_(ema_chunk)
+            ema_chunk.copy_(chunk_buffer)
+
+    def __copy(self, index: int, parameter: torch.nn.Parameter):
+        parameter.data.copy_(self.ema_parameters[index].to(parameter.device).data)
+        if self.ema_residuals is not None and parameter.is_floating_point():
+            parameter.data.add_(self.ema_residuals[index].to(parameter.device))
+
+    def copy_ema_to(self, parameters: Iterable[torch.nn.Parameter], store_temp: bool = True) -> None:
         parameters = list(parameters)
-        for ema_parameter, parameter in zip(self.ema_parameters, parameters):
-            parameter.data.copy_(ema_parameter.to(parameter.device).data)
+
+        if not store_temp:
+            for index, parameter in enumerate(parameters[:len(self.ema_parameters)]):
+                self.__copy(index, parameter)
+            return
+
+        # Parameters with the same data type as their EMA parameter are swapped with it, and swapped back by
+        # copy_temp_to. The other parameters are stored on the cpu. A temp entry of None marks a swapped parameter.
+        self.temp_stored_parameters = []
+        self.swapped_parameters = parameters
+        for index, parameter in enumerate(parameters[:len(self.ema_parameters)]):
+            if self.ema_parameters[index].dtype == parameter.dtype:
+                self.__swap(index, parameter)
+                self.temp_stored_parameters.append(None)
+            else:
+                self.temp_stored_parameters.append(parameter.detach().to('cpu', copy=True))
+                self.__copy(index, parameter)
 
     def copy_temp_to(self, parameters: Iterable[torch.nn.Parameter]) -> None:
-        for temp_parameter, parameter in zip(self.temp_stored_parameters, parameters):
-            parameter.data.copy_(temp_parameter.data)
+        for index, (temp_parameter, parameter) in enumerate(zip(self.temp_stored_parameters, parameters)):
+            if temp_parameter is None:
+                self.__swap(index, parameter)
+            else:
+                parameter.data.copy_(temp_parameter.data)
 
         self.temp_stored_parameters = None
+        self.swapped_parameters = None
+
+    def __current_ema_parameters(self) -> list[torch.Tensor]:
+        if self.temp_stored_parameters is None:
+            return self.ema_parameters
+
+        # while the EMA is swapped into the model, the swapped parameters hold the EMA values
+        return [
+            parameter.detach().to(ema_parameter.device) if temp_parameter is None else ema_parameter
+            for ema_parameter, parameter, temp_parameter
+            in zip(self.ema_parameters, self.swapped_parameters, self.temp_stored_parameters)
+        ]
 
     def load_state_dict(self, state_dict: dict) -> None:
         self.decay = self.decay if self.decay else state_dict.get("decay", self.decay)
-        self.ema_parameters = state_dict.get("ema_parameters", None)
-        self.to(self.device)
+        # the state is converted to the precision of this EMA, which can differ from the saved precision. Full precision
+        # parameters keep the data types they were created with
+        self.__set_ema_parameters(
+            state_dict.get("ema_parameters", None),
+            state_dict.get("ema_residuals", None),
+            [ema_parameter.dtype for ema_parameter in self.ema_parameters],
+        )
 
     def state_dict(self) -> dict:
-        return {
+        state_dict = {
             "decay": self.decay,
-            "ema_parameters": self.ema_parameters,
+            "ema_parameters": self.__current_ema_parameters(),
         }
+        if self.ema_residuals is not None:
+            state_dict["ema_residuals"] = self.ema_residuals
+        return state_dict
@@ -26,6 +26,12 @@ class LoRAModule(metaclass=ABCMeta):
         self.is_applied = False
         self.orig_forward = self.orig_module.forward if self.orig_module is not None else None
 
+        # set while the LoRA is merged into the weight of the original module
+        self.is_merged = False
+        self.was_hooked = False
+        self.orig_weight_backup = None
+        self.orig_weight_checksum = None
+
     def forward(self, x, *args, **kwargs):
         return self.orig_forward(x) + self.lora_up(self.lora_down(x)) * (self.alpha / self.rank)
 
@@ -71,13 +77,92 @@ class LoRAModule(metaclass=ABCMeta):
             self.orig_module.forward = self.orig_forward
             self.is_applied = False
 
-    def apply_to_module(self):
-        # TODO
-        pass
+    def __can_merge(self) -> bool:
+        # the LoRA layers are 1x1, so they can only be merged into weights without a spatial kernel
+        weight = self.orig_module.weight
+        return weight.numel() == weight.shape[0] * self.lora_down.weight.shape[1]
+
+    def __delta_weight(self) -> Tensor:
+        down = self.lora_down.weight.detach().float()
+        up = self.lora_up.weight.detach().float()
+        delta = (up.reshape(up.shape[0], -1) @ down.reshape(down.shape[0], -1)) * (self.alpha.item() / self.rank)
+        return delta.reshape(self.orig_module.weight.shape)
+
+    def apply_to_module(self, backup_device: torch.device | None = None):
+        if self.is_merged or not self.__can_merge():
+            return
+
+        weight = self.orig_module.weight
+        original_weight = weight.detach()
+        delta = self.__delta_weight().to(weight.device)
+        merged_weight = (original_weight.float() + delta).to(weight.dtype)
+
+        # the weight is restored by subtracting the delta again. Only the elements that are not restored exactly,
+        # because of rounding, are backed up. If too many of them differ, the whole weight is backed up
+        restored_weight = (merged_weight.float() - delta).to(weight.dtype)
+        mismatch = (restored_weight != original_weight).flatten().nonzero().squeeze(1)
+        del restored_weight, delta
+
+        backup_device = backup_device or weight.device
+        if mismatch.numel() * (mismatch.element_size() + weight.element_size()) < weight.numel() * weight.element_size():
+            self.orig_weight_backup = (
+                mismatch.to(backup_device), original_weight.flatten()[mismatch].to(backup_device)
+            )
+        else:
+            self.orig_weight_backup = original_weight.to(device=backup_device, copy=True)
+        self.orig_weight_checksum = original_weight.float().sum()
+        weight.data.copy_(merged_weight)
+
+        self.was_hooked = self.is_applied
+        self.remove_hook_from_module()
+        self.is_merged = True
+
+    def remove_from_module(self):
+        if not self.is_merged:
+            return
+
+        weight = self.orig_module.weight
+        if isinstance(self.orig_weight_backup, tuple):
+            indices, values = self.orig_weight_backup
+            restored_weight = (weight.detach().float() - self.__delta_weight().to(weight.device)).to(weight.dtype)
+            restored_weight.view(-1)[indices.to(weight.device)] = values.to(weight.device)
+            weight.data.copy_(restored_weight)
+        else:
+            weight.data.copy_(self.orig_weight_backup)
+
+        if not torch.equal(weight.detach().float().sum(), self.orig_weight_checksum):
+            print(f"the original weight of {self.prefix} was not restored exactly after merging the LoRA")
+
+        self.orig_weight_backup = None
+        self.orig_weight_checksum = None
+        self.is_merged = False
+
+        if self.was_hooked:
+            self.hook_to_module()
 
     def extract_from_module(self, base_module: nn.Module):
-        # TODO
-        pass
+        if not self.__can_merge():
+            return
+
+        # the weights are divided by the alpha scale, which needs to be positive
+        scale = self.alpha.item() / self.rank
+        if not scale > 0 or not math.isfinite(scale):
+            raise Exception(f"can't extract the LoRA {self.prefix} with an alpha of {self.alpha.item()}")
+
+        weight = self.orig_module.weight.detach()
+        delta = weight.float() - base_module.weight.detach().to(weight.device).float()
+        u, s, vh = torch.linalg.svd(delta.reshape(delta.shape[0], -1), full_matrices=False)
+
+        # the singular values are split evenly between both weights, the alpha scale is applied in the forward pass
+        rank = min(self.rank, s.shape[0])
+        s = torch.sqrt(s[:rank] / scale)
+        up = torch.zeros((u.shape[0], self.rank), device=weight.device)
+        down = torch.zeros((self.rank, vh.shape[1]), device=weight.device)
+        up[:, :rank] = u[:, :rank] * s
+        down[:rank] = s[:, None] * vh[:rank]
+
+        self.lora_up.weight.data.copy_(up.reshape(self.lora_up.weight.shape))
+        self.lora_down.weight.data.copy_(down.reshape(self.lora_down.weight.shape))
 
 
 class LinearLoRAModule(LoRAModule):
@@ -140,7 +225,10 @@ class DummyLoRAModule(LoRAModule):
     def remove_hook_from_module(self):
         pass
 
-    def apply_to_module(self):
+    def apply_to_module(self, backup_device: torch.device | None = None):
+        pass
+
+    def remove_from_module(self):
         pass
 
     def extract_from_module(self, base_module: nn.Module):
@@ -169,6 +257,11 @@ class LoRAModuleWrapper:
 
         self.modules = self.__create_modules(orig_module, alpha)
 
+        # set by flatten_parameters, one entry for each device and data type
+        self.flat_parameters = None
+        self.flat_gradients = None
+        self.flat_parameter_views = None
+
     def __create_modules(self, orig_module: nn.Module | None, alpha: float) -> dict[str, LoRAModule]:
         lora_modules = {}
 
@@ -186,17 +279,82 @@ class LoRAModuleWrapper:
         for name, module in self.modules.items():
             module.requires_grad_(requires_grad)
 
+        if self.flat_parameters is not None:
+            # without a gradient, the optimizer skips the flat parameter, just like the individual weights
+            for flat_parameter, flat_gradient in zip(self.flat_parameters, self.flat_gradients):
+                flat_parameter.requires_grad_(requires_grad)
+                flat_parameter.grad = flat_gradient if requires_grad else None
+
     def parameters(self) -> list[Parameter]:
+        if self.flat_parameters is not None:
+            return list(self.flat_parameters)
+
         parameters = []
         for name, module in self.modules.items():
             parameters += module.parameters()
         return parameters
 
     def to(self, device: torch.device = None, dtype: torch.dtype = None) -> 'LoRAModuleWrapper':
+        if self.flat_parameters is not None:
+            for index, flat_parameter in enumerate(self.flat_parameters):
+                requires_grad = flat_parameter.grad is not None
+                flat_parameter.data = flat_parameter.data.to(device=device, dtype=dtype)
+                self.flat_gradients[index] = self.flat_gradients[index].to(device=device, dtype=dtype)
+                flat_parameter.grad = self.flat_gradients[index] if requires_grad else None
+            self.__bind_flat_parameters()
+            return self
+
         for name, module in self.modules.items():
             module.to(device, dtype)
         return self
 
+    def flatten_parameters(self):
+        """
+        Moves all weights and gradients into flat buffers, one for each device and data type. Each weight becomes a
+        view into a flat parameter, and its gradient a view into the gradient of that parameter. Afterwards,
+        parameters() returns the flat parameters, so the optimizer, gradient clipping and the EMA only need a few
+        kernels for all weights. Gradients of the flat parameters are zeroed instead of being set to None.
+        """
+        if self.flat_parameters is not None:
+            return
+
+        # (device, dtype) -> weights
+        groups = {}
+        for name, module in self.modules.items():
+            for parameter in module.parameters():
+                groups.setdefault((parameter.device, parameter.dtype), []).append(parameter)
+
+        self.flat_parameters = []
+        self.flat_gradients = []
+        self.flat_parameter_views = []
+        for views in groups.values():
+            requires_grad = any(view.requires_grad for view in views)
+            flat_parameter = Parameter(
+                torch.cat([view.detach().reshape(-1) for view in views]), requires_grad=requires_grad
+            )
+            # exchanging the storage of a flat parameter would detach its views
+            flat_parameter.has_views = True
+
+            flat_gradient = torch.zeros_like(flat_parameter.data)
+            flat_parameter.grad = flat_gradient if requires_grad else None
+
+            self.flat_parameters.append(flat_parameter)
+            self.flat_gradients.append(flat_gradient)
+            self.flat_parameter_views.append(views)
+
+        self.__bind_flat_parameters()
+
+    def __bind_flat_parameters(self):
+        for flat_parameter, flat_gradient, views in \
+                zip(self.flat_parameters, self.flat_gradients, self.flat_parameter_views):
+            offset = 0
+            for view in views:
+                numel = view.numel()
+                view.data = flat_parameter.data[offset:offset + numel].view(view.shape)
+                # gradients are accumulated in place into an existing gradient
+                view.grad = flat_gradient[offset:offset + numel].view(view.shape)
+                offset += numel
+
     def load_state_dict(self, state_dict: dict[str, Tensor]):
         """
         Loads the state dict
@@ -229,6 +387,10 @@ class LoRAModuleWrapper:
         for name, module in self.modules.items():
             state_dict |= module.state_dict()
 
+        if self.flat_parameters is not None:
+            # flattened weights share the storage of their flat parameter, which safetensors refuses to save
+            state_dict = {key: value.clone() if isinstance(value, Tensor) else value for key, value in state_dict.items()}
+
         return state_dict
 
     def hook_to_module(self):
@@ -245,19 +407,35 @@ class LoRAModuleWrapper:
         for name, module in self.modules.items():
             module.remove_hook_from_module()
 
-    def apply_to_module(self):
+    def apply_to_module(self, backup_device: torch.device | None = None):
+        """
+        Applys the LoRA to the module, changing its weights. The LoRA is merged into the weights, and the hook is
+        removed, so the module runs at the speed of the original module. Weights with a spatial kernel can't be merged,
+        their LoRA stays hooked.
+
+        Args:
+            backup_device: the device of the backed up parts of the original weights, which are restored by
+                remove_from_module. Defaults to the device of each weight
+        """
+        for name, module in self.modules.items():
+            module.apply_to_module(backup_device)
+
+    def remove_from_module(self):
         """
-        Applys the LoRA to the module, changing its weights
+        Exactly restores the original weights of the module after apply_to_module, and restores the hook if the LoRA
+        was hooked before
         """
         for name, module in self.modules.items():
-            module.apply_to_module()
+            module.remove_from_module()
 
     def extract_from_module(self, base_module: nn.Module):
         """
         Creates a LoRA from the difference between the base_module and the orig_module
         """
+        base_modules = dict(base_module.named_modules())
         for name, module in self.modules.items():
-            module.extract_from_module(base_module)
+            if name in base_modules:
+                module.extract_from_module(base_modules[name])
 
     def prune(self):
         """
@@ -28,12 +28,19 @@ from modules.modelSampler.BaseModelSampler import BaseModelSampler
 from modules.modelSaver.BaseModelSaver import BaseModelSaver
 from modules.modelSetup.BaseModelSetup import BaseModelSetup
 from modules.trainer.BaseTrainer import BaseTrainer
-from modules.util import path_util, create
+from modules.util import path_util, create, distributed_util
+from modules.util.AsyncCheckpointWriter import AsyncCheckpointWriter
+from modules.util.BackgroundCacher import BackgroundCacher
+from modules.util.BatchPrefetcher import BatchPrefetcher
+from modules.util.MetricsAccumulator import MetricsAccumulator
+from modules.util.ShardedOptimizer import ShardedOptimizer
+from modules.util.StepProfiler import StepProfiler
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
 from modules.util.callbacks.TrainCallbacks import TrainCallbacks
 from modules.util.commands.TrainCommands import TrainCommands
 from modules.util.dtype_util import allow_mixed_precision
+from modules.util.enum.CompileMode import CompileMode
 from modules.util.enum.ImageFormat import ImageFormat
 from modules.util.enum.ModelFormat import ModelFormat
 from modules.util.enum.TimeUnit import TimeUnit
@@ -55,16 +62,30 @@ class GenericTrainer(BaseTrainer):
 
     parameters: list[Parameter]
 
+    async_checkpoint_writer: AsyncCheckpointWriter | None
+    profiler: StepProfiler
+    background_cacher: BackgroundCacher | None
+    cached_variations: set[int]
+
     tensorboard_subprocess: subprocess.Popen
     tensorboard: SummaryWriter
 
     def __init__(self, args: TrainArgs, callbacks: TrainCallbacks, commands: TrainCommands):
         super(GenericTrainer, self).__init__(args, callbacks, commands)
 
+        if args.distributed:
+            args.train_device = distributed_util.init_process_group(args.distributed_backend, args.train_device)
+
+        # only the main rank writes logs, samples, backups and saves
+        self.is_main_rank = distributed_util.is_main_rank()
+
         tensorboard_log_dir = os.path.join(args.workspace_dir, "tensorboard")
-        os.makedirs(Path(tensorboard_log_dir).absolute(), exist_ok=True)
-        self.tensorboard = SummaryWriter(os.path.join(tensorboard_log_dir, self.__get_string_timestamp()))
-        if args.tensorboard:
+        if self.is_main_rank:
+            os.makedirs(Path(tensorboard_log_dir).absolute(), exist_ok=True)
+            self.tensorboard = SummaryWriter(os.path.join(tensorboard_log_dir, self.__get_string_timestamp()))
+        else:
+            self.tensorboard = None
+        if args.tensorboard and self.is_main_rank:
             tensorboard_executable = os.path.join(os.path.dirname(sys.executable), "tensorboard")
 
             self.tensorboard_subprocess = subprocess.Popen(
@@ -78,10 +99,24 @@ class GenericTrainer(BaseTrainer):
                 ]
             )
         self.one_step_trained = False
+        self.background_cacher = None
+        self.cached_variations = set()
+
+        self.profiler = StepProfiler(
+            enabled=args.step_profiling,
+            device=torch.device(args.train_device),
+            report_interval=args.step_profiling_interval,
+        )
+
+        if args.async_backup:
+            self.async_checkpoint_writer = AsyncCheckpointWriter(args.async_backup_max_in_flight)
+        else:
+            self.async_checkpoint_writer = None
 
     def start(self):
-        if self.args.clear_cache_before_training and self.args.latent_caching:
+        if self.args.clear_cache_before_training and self.args.latent_caching and self.is_main_rank:
             self.__clear_cache()
+        distributed_util.barrier()
 
         if self.args.train_dtype.enable_tf():
             torch.backends.cuda.matmul.allow_tf32 = True
@@ -109,6 +144,9 @@ class GenericTrainer(BaseTrainer):
             else:
                 print(f"No backup found, continuing without backup...")
 
+        if self.args.training_method == TrainingMethod.LORA and extra_model_name:
+            self.__check_lora_backup_layout(extra_model_name)
+
         self.callbacks.on_update_status("loading the model")
         self.model = self.model_loader.load(
             model_type=self.args.model_type,
@@ -129,18 +167,107 @@ class GenericTrainer(BaseTrainer):
         self.data_loader = self.create_data_loader(
             self.model, self.model.train_progress
         )
+        self.data_loader.dl = distributed_util.shard_data_loader(self.data_loader.dl, self.args.batch_size)
+        if self.args.device_prefetch_batches > 0:
+            self.data_loader.dl = BatchPrefetcher(
+                self.data_loader.dl, torch.device(self.args.train_device), self.args.device_prefetch_batches
+            )
+        if self.args.background_caching and self.args.latent_caching and self.args.sharded_latent_cache \
+                and self.args.latent_caching_epochs > 1 and self.is_main_rank:
+            self.background_cacher = BackgroundCacher(
+                create_data_loader=lambda args, model, train_progress: create.create_data_loader(
+                    model, args.model_type, args.training_method, args, train_progress
+                ),
+                args=self.args,
+                caching_model_names=self.data_loader.caching_model_names,
+                device=torch.device(self.args.background_caching_device or self.args.train_device),
+                batch_size=self.args.background_caching_batch_size,
+                max_duty_cycle=self.args.background_caching_duty_cycle,
+            )
         self.model_saver = self.create_model_saver()
 
         self.model_sampler = self.create_model_sampler(self.model)
+        if self.args.training_method == TrainingMethod.LORA and self.args.lora_merge_for_sampling \
+                and not self.__merge_loras_for_sampling():
+            print("The LoRA is not merged for sampling, because the compiled model can't switch between merged and"
+                  " hooked LoRA weights")
         self.previous_sample_time = -1
         self.sample_queue = []
 
         self.parameters = list(self.model_setup.create_parameters(self.model, self.args))
 
+        # newly initialized weights can differ between ranks
+        distributed_util.broadcast_tensors(self.parameters)
+        if self.model.ema:
+            distributed_util.broadcast_tensors(self.model.ema.ema_parameters)
+            if self.model.ema.ema_residuals is not None:
+                distributed_util.broadcast_tensors(self.model.ema.ema_residuals)
+
+    def __check_lora_backup_layout(self, backup_path: str):
+        # flat LoRA parameters change the layout of the optimizer and EMA state, a backup can only be loaded with the
+        # same layout
+        args_path = os.path.join(backup_path, "onetrainer_config", "args.json")
+        if not os.path.isfile(args_path):
+            return
+
+        with open(args_path, "r") as f:
+            backup_flat_parameters = json.load(f).get("lora_flat_parameters", False)
+
+        if backup_flat_parameters != self.args.lora_flat_parameters:
+            raise Exception(
+                f"the backup '{backup_path}' was saved with lora_flat_parameters={backup_flat_parameters}, its"
+                f" optimizer and EMA state can't be loaded with lora_flat_parameters={self.args.lora_flat_parameters}."
+                f" Change the setting back to continue from this backup"
+            )
+
+    def __merge_loras_for_sampling(self) -> bool:
+        # compiled blocks trace the LoRA hooks into their graphs, and don't recompile when the hooks are removed. A
+        # merged LoRA would be applied a second time by the stale graph
+        return self.args.training_method == TrainingMethod.LORA and self.args.lora_merge_for_sampling \
+            and self.args.compile_mode == CompileMode.NONE
+
+    def __lora_merge_backup_device(self, train_device: torch.device) -> torch.device:
+        # the parts of the original weights that are backed up while a LoRA is merged stay on the train device, unless
+        # a backup of every merged weight could use more than half of its free memory
+        if train_device.type != 'cuda':
+            return train_device
+
+        weight_bytes = sum(
+            module.orig_module.weight.numel() * module.orig_module.weight.element_size()
+            for lora in self.model.loras() for module in lora.modules.values() if module.orig_module is not None
+        )
+        free_bytes, _ = torch.cuda.mem_get_info(train_device)
+        return train_device if weight_bytes < free_bytes // 2 else torch.device('cpu')
+
+    def __has_flat_parameters(self) -> bool:
+        return self.args.training_method == TrainingMethod.LORA and self.args.lora_flat_parameters
+
     def __gc(self):
-        torch.cuda.synchronize()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
         gc.collect()
-        torch.cuda.empty_cache()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def __start_next_epoch(self):
+        # the main rank fills the cache, all other ranks read from it afterwards
+        if self.is_main_rank:
+            if self.background_cacher is not None:
+                self.background_cacher.wait()
+            self.data_loader.start_next_epoch()
+            if self.background_cacher is not None:
+                self.cached_variations.add(self.model.train_progress.epoch % self.args.latent_caching_epochs)
+        distributed_util.barrier()
+        if not self.is_main_rank:
+            self.data_loader.start_next_epoch()
+
+    def __start_background_caching(self):
+        # the next epoch is cached while this epoch is trained, unless its variation is already cached. This is called
+        # after the models are moved to their train devices, so the copied models are not moved while caching
+        next_epoch = self.model.train_progress.epoch + 1
+        if self.background_cacher is not None and next_epoch < self.args.epochs \
+                and next_epoch % self.args.latent_caching_epochs not in self.cached_variations:
+            self.background_cacher.start(self.model, next_epoch)
 
     def __get_string_timestamp(self):
         return datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -150,20 +277,29 @@ class GenericTrainer(BaseTrainer):
             f'Clearing cache directory {self.args.cache_dir}! '
             f'You can disable this if you want to continue using the same cache.'
         )
+        if self.args.sharded_latent_cache:
+            print(
+                'The sharded latent cache only re-encodes samples that changed. '
+                'Disable clearing the cache to keep the unchanged samples.'
+            )
         if os.path.isdir(self.args.cache_dir):
             for filename in os.listdir(self.args.cache_dir):
                 path = os.path.join(self.args.cache_dir, filename)
-                if os.path.isdir(path) and filename.startswith('epoch-'):
+                if os.path.isdir(path) and (filename.startswith('epoch-') or filename.startswith('text-')):
                     shutil.rmtree(path)
 
+    def __list_backup_directories(self, backup_dirpath: str) -> list[str]:
+        # backups that are still being written in the background are skipped
+        return sorted(
+            [dirpath for dirpath in os.listdir(backup_dirpath) if
+             os.path.isdir(os.path.join(backup_dirpath, dirpath)) and not dirpath.endswith(".tmp")],
+            reverse=True,
+        )
+
     def __get_last_backup_dirpath(self):
         backup_dirpath = os.path.join(self.args.workspace_dir, "backup")
         if os.path.exists(backup_dirpath):
-            backup_directories = sorted(
-                [dirpath for dirpath in os.listdir(backup_dirpath) if
-                 os.path.isdir(os.path.join(backup_dirpath, dirpath))],
-                reverse=True,
-            )
+            backup_directories = self.__list_backup_directories(backup_dirpath)
 
             if backup_directories:
                 last_backup_dirpath = backup_directories[0]
@@ -174,11 +310,7 @@ class GenericTrainer(BaseTrainer):
     def __prune_backups(self, backups_to_keep: int):
         backup_dirpath = os.path.join(self.args.workspace_dir, "backup")
         if os.path.exists(backup_dirpath):
-            backup_directories = sorted(
-                [dirpath for dirpath in os.listdir(backup_dirpath) if
-                 os.path.isdir(os.path.join(backup_dirpath, dirpath))],
-                reverse=True,
-            )
+            backup_directories = self.__list_backup_directories(backup_dirpath)
 
             for dirpath in backup_directories[backups_to_keep:]:
                 dirpath = os.path.join(backup_dirpath, dirpath)
@@ -205,6 +337,33 @@ class GenericTrainer(BaseTrainer):
             folder_postfix: str = "",
             image_format: ImageFormat = ImageFormat.JPG,
             is_custom_sample: bool = False,
+    ):
+        merge_loras = self.__merge_loras_for_sampling()
+        if merge_loras:
+            backup_device = self.__lora_merge_backup_device(train_device)
+            for lora in self.model.loras():
+                lora.apply_to_module(backup_device)
+
+        try:
+            self.__sample_params_loop(
+                train_progress=train_progress,
+                sample_params_list=sample_params_list,
+                folder_postfix=folder_postfix,
+                image_format=image_format,
+                is_custom_sample=is_custom_sample,
+            )
+        finally:
+            if merge_loras:
+                for lora in self.model.loras():
+                    lora.remove_from_module()
+
+    def __sample_params_loop(
+            self,
+            train_progress: TrainProgress,
+            sample_params_list: list[SampleParams],
+            folder_postfix: str,
+            image_format: ImageFormat,
+            is_custom_sample: bool,
     ):
         for i, sample_params in enumerate(sample_params_list):
             if sample_params.enabled:
@@ -318,7 +477,67 @@ class GenericTrainer(BaseTrainer):
         shutil.copy2(self.args.concept_file_name, concepts_path)
         shutil.copy2(self.args.sample_definition_file_name, samples_path)
 
+    def __on_wait_for_async_checkpoint(self):
+        self.callbacks.on_update_status("waiting for background saving")
+
+    def __snapshot_shared_modules(self) -> list[torch.nn.Module]:
+        # LoRA and embedding savers only write the trained weights, so the frozen base model is not copied
+        if self.args.training_method not in [TrainingMethod.LORA, TrainingMethod.EMBEDDING]:
+            return []
+        return [value for value in vars(self.model).values() if isinstance(value, torch.nn.Module)]
+
+    def __backup_async(self):
+        self.callbacks.on_update_status("creating backup")
+
+        backup_path = os.path.join(self.args.workspace_dir, "backup", self.__get_string_timestamp())
+        temp_backup_path = backup_path + ".tmp"
+
+        print("Creating Backup " + backup_path)
+
+        self.async_checkpoint_writer.wait_for_slot(self.__on_wait_for_async_checkpoint)
+        model_snapshot = self.async_checkpoint_writer.snapshot(self.model, self.__snapshot_shared_modules())
+
+        def write_backup():
+            try:
+                self.model_saver.save(
+                    model_snapshot,
+                    self.args.model_type,
+                    ModelFormat.INTERNAL,
+                    temp_backup_path,
+                    torch.float32
+                )
+
+                # the backup only becomes visible after it was completely written
+                os.replace(temp_backup_path, backup_path)
+            except:
+                traceback.print_exc()
+                print("Could not save backup. Check your disk space!")
+                try:
+                    if os.path.isdir(temp_backup_path):
+                        shutil.rmtree(temp_backup_path)
+                except:
+                    traceback.print_exc()
+                    print("Could not delete partial backup")
+                    pass
+            finally:
+                if self.args.rolling_backup:
+                    self.__prune_backups(self.args.rolling_backup_count)
+
+        try:
+            self.__save_backup_config(temp_backup_path)
+        except:
+            traceback.print_exc()
+            print("Could not save backup config")
+
+        self.async_checkpoint_writer.submit(
+            f"backup {backup_path}", write_backup, self.__on_wait_for_async_checkpoint
+        )
+
     def backup(self):
+        if self.async_checkpoint_writer is not None:
+            self.__backup_async()
+            return
+
         self.__gc()
 
         self.callbacks.on_update_status("creating backup")
@@ -355,8 +574,46 @@ class GenericTrainer(BaseTrainer):
 
         self.__gc()
 
+    def __save_async(self, save_path: str):
+        self.async_checkpoint_writer.wait_for_slot(self.__on_wait_for_async_checkpoint)
+        try:
+            if self.model.ema:
+                self.model.ema.copy_ema_to(self.parameters, store_temp=True)
+
+            model_snapshot = self.async_checkpoint_writer.snapshot(self.model, self.__snapshot_shared_modules())
+        finally:
+            if self.model.ema:
+                self.model.ema.copy_temp_to(self.parameters)
+
+        def write_save():
+            try:
+                self.model_saver.save(
+                    model=model_snapshot,
+                    model_type=self.args.model_type,
+                    output_model_format=self.args.output_model_format,
+                    output_model_destination=save_path,
+                    dtype=self.args.output_dtype.torch_dtype()
+                )
+            except:
+                traceback.print_exc()
+                print("Could not save model. Check your disk space!")
+                try:
+                    if os.path.isfile(save_path):
+                        os.remove(save_path)
+                    elif os.path.isdir(save_path):
+                        shutil.rmtree(save_path)
+                except:
+                    traceback.print_exc()
+                    print("Could not delete partial save")
+                    pass
+
+        self.async_checkpoint_writer.submit(
+            f"save {save_path}", write_save, self.__on_wait_for_async_checkpoint
+        )
+
     def save(self, train_progress: TrainProgress):
-        self.__gc()
+        if self.async_checkpoint_writer is None:
+            self.__gc()
 
         self.callbacks.on_update_status("saving")
 
@@ -367,6 +624,10 @@ class GenericTrainer(BaseTrainer):
         )
         print("Saving " + save_path)
 
+        if self.async_checkpoint_writer is not None:
+            self.__save_async(save_path)
+            return
+
         try:
             if self.model.ema:
                 self.model.ema.copy_ema_to(self.parameters, store_temp=True)
@@ -397,6 +658,14 @@ class GenericTrainer(BaseTrainer):
     def __needs_sample(self, train_progress: TrainProgress):
         return self.action_needed("sample", self.args.sample_after, self.args.sample_after_unit, train_progress)
 
+    def __is_optimizer_sharded(self) -> bool:
+        return isinstance(self.model.optimizer, ShardedOptimizer)
+
+    def __consolidate_optimizer_state(self):
+        # the optimizer state of all ranks is needed to write it to a backup
+        if self.__is_optimizer_sharded():
+            self.model.optimizer.consolidate_state_dict()
+
     def __needs_backup(self, train_progress: TrainProgress):
         return self.action_needed(
             "backup", self.args.backup_after, self.args.backup_after_unit, train_progress, start_at_zero=False
@@ -421,6 +690,9 @@ class GenericTrainer(BaseTrainer):
         train_progress = self.model.train_progress
 
         if self.args.only_cache:
+            if not self.is_main_rank:
+                return
+
             self.callbacks.on_update_status("caching")
 
             self.model_setup.setup_eval_device(self.model)
@@ -429,7 +701,7 @@ class GenericTrainer(BaseTrainer):
             cached_epochs = [False] * self.args.latent_caching_epochs
             for epoch in tqdm(range(train_progress.epoch, self.args.epochs, 1), desc="epoch"):
                 if not cached_epochs[epoch % self.args.latent_caching_epochs]:
-                    self.data_loader.ds.start_next_epoch()
+                    self.data_loader.start_next_epoch()
                     cached_epochs[epoch % self.args.latent_caching_epochs] = True
             return
 
@@ -440,7 +712,7 @@ class GenericTrainer(BaseTrainer):
             num_cycles=self.args.learning_rate_cycles,
             num_epochs=self.args.epochs,
             approximate_epoch_length=self.data_loader.ds.approximate_length(),
-            batch_size=self.args.batch_size,
+            batch_size=self.args.batch_size * distributed_util.world_size(),
             gradient_accumulation_steps=self.args.gradient_accumulation_steps,
             global_step=train_progress.global_step
         )
@@ -455,27 +727,32 @@ class GenericTrainer(BaseTrainer):
         # This is used to schedule sampling only when the gradients don't take up any space
         has_gradient = False
 
-        accumulated_loss = 0.0
-        ema_loss = None
+        metrics = MetricsAccumulator(
+            flush_interval_steps=self.args.metrics_flush_interval_steps,
+            flush_interval_seconds=self.args.metrics_flush_interval_seconds,
+        )
         for epoch in tqdm(range(train_progress.epoch, self.args.epochs, 1), desc="epoch"):
             self.callbacks.on_update_status("starting epoch/caching")
 
             self.model_setup.setup_eval_device(self.model)
             self.__gc()
-            self.data_loader.ds.start_next_epoch()
+            self.__start_next_epoch()
             self.model_setup.setup_train_device(self.model, self.args)
+            self.__start_background_caching()
             self.__gc()
 
             current_epoch_length = len(self.data_loader.dl) + train_progress.epoch_step
-            step_tqdm = tqdm(self.data_loader.dl, desc="step")
-            for epoch_step, batch in enumerate(step_tqdm):
-                if self.__needs_sample(train_progress) or self.commands.get_and_reset_sample_default_command():
+            step_tqdm = tqdm(self.data_loader.dl, desc="step", disable=not self.is_main_rank)
+            for epoch_step, batch in enumerate(self.profiler.time_iterator("data_loading", step_tqdm)):
+                if self.is_main_rank and (
+                        self.__needs_sample(train_progress) or self.commands.get_and_reset_sample_default_command()
+                ):
                     self.__enqueue_sample_during_training(
                         lambda: self.__sample_during_training(train_progress, train_device)
                     )
 
                 sample_commands = self.commands.get_and_reset_sample_custom_commands()
-                if sample_commands:
+                if sample_commands and self.is_main_rank:
                     self.__enqueue_sample_during_training(
                         lambda: self.__sample_during_training(train_progress, train_device, sample_commands)
                     )
@@ -484,13 +761,26 @@ class GenericTrainer(BaseTrainer):
                     self.__gc()
 
                 if not has_gradient:
-                    self.__execute_sample_during_training()
-
-                if self.__needs_backup(train_progress):
-                    self.backup()
-
-                if self.__needs_save(train_progress):
-                    self.save(train_progress)
+                    with self.profiler.phase("sampling", host=True):
+                        self.__execute_sample_during_training()
+
+                needs_backup = self.is_main_rank and self.__needs_backup(train_progress)
+                needs_save = self.is_main_rank and self.__needs_save(train_progress)
+                if self.__is_optimizer_sharded():
+                    # every rank takes part in collecting the sharded optimizer state
+                    needs_backup, needs_save = distributed_util.broadcast_object((needs_backup, needs_save))
+
+                if needs_backup:
+                    with self.profiler.phase("backup", host=True):
+                        self.__consolidate_optimizer_state()
+                        if self.is_main_rank:
+                            self.backup()
+
+                if needs_save:
+                    with self.profiler.phase("save", host=True):
+                        self.__consolidate_optimizer_state()
+                        if self.is_main_rank:
+                            self.save(train_progress)
 
                 self.callbacks.on_update_status("training")
 
@@ -500,64 +790,76 @@ class GenericTrainer(BaseTrainer):
                     forward_context = nullcontext()
 
                 with forward_context:
-                    model_output_data = self.model_setup.predict(self.model, batch, self.args, train_progress)
+                    with self.profiler.phase("predict"):
+                        model_output_data = self.model_setup.predict(self.model, batch, self.args, train_progress)
 
-                    loss = self.model_setup.calculate_loss(self.model, batch, model_output_data, self.args)
+                    with self.profiler.phase("loss"):
+                        loss = self.model_setup.calculate_loss(self.model, batch, model_output_data, self.args)
 
                 loss = loss / self.args.gradient_accumulation_steps
-                if scaler:
-                    scaler.scale(loss).backward()
-                else:
-                    loss.backward()
+                with self.profiler.phase("backward"):
+                    if scaler:
+                        scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
                 has_gradient = True
-                accumulated_loss += loss.item()
+                metrics.add_loss(loss)
 
                 if self.__is_update_step(train_progress):
+                    with self.profiler.phase("all_reduce"):
+                        distributed_util.all_reduce_gradients(self.parameters)
+
                     if scaler:
-                        scaler.unscale_(self.model.optimizer)
-                        nn.utils.clip_grad_norm_(self.parameters, 1)
-                        scaler.step(self.model.optimizer)
-                        scaler.update()
+                        with self.profiler.phase("clip_grad"):
+                            scaler.unscale_(self.model.optimizer)
+                            grad_norm = nn.utils.clip_grad_norm_(self.parameters, 1)
+                        with self.profiler.phase("optimizer_step"):
+                            scaler.step(self.model.optimizer)
+                            scaler.update()
                     else:
-                        nn.utils.clip_grad_norm_(self.parameters, 1)
-                        self.model.optimizer.step()
+                        with self.profiler.phase("clip_grad"):
+                            grad_norm = nn.utils.clip_grad_norm_(self.parameters, 1)
+                        with self.profiler.phase("optimizer_step"):
+                            self.model.optimizer.step()
 
-                    self.model.optimizer.zero_grad(set_to_none=True)
+                    # the gradients of flat LoRA parameters are views of a shared buffer, and are zeroed in place
+                    self.model.optimizer.zero_grad(set_to_none=not self.__has_flat_parameters())
                     has_gradient = False
                     lr_scheduler.step()
 
-                    self.tensorboard.add_scalar(
-                        "learning_rate", lr_scheduler.get_last_lr()[0], train_progress.global_step
-                    )
-                    self.tensorboard.add_scalar("loss", accumulated_loss, train_progress.global_step)
-                    ema_loss = ema_loss or accumulated_loss
-                    ema_loss = (ema_loss * 0.99) + (accumulated_loss * 0.01)
-                    step_tqdm.set_postfix({
-                        'loss': accumulated_loss,
-                        'smooth loss': ema_loss,
-                    })
-                    accumulated_loss = 0.0
+                    metrics.finish_update_step(train_progress.global_step, lr_scheduler.get_last_lr()[0], grad_norm)
+                    if metrics.needs_flush():
+                        step_tqdm.set_postfix(metrics.flush(self.tensorboard))
+                        self.data_loader.report_cache_statistics(self.tensorboard, train_progress.global_step)
 
                     self.model_setup.after_optimizer_step(self.model, self.args, train_progress)
                     if self.model.ema:
                         update_step = train_progress.global_step // self.args.gradient_accumulation_steps
-                        self.tensorboard.add_scalar(
-                            "ema_decay",
-                            self.model.ema.get_current_decay(update_step),
-                            train_progress.global_step
-                        )
-                        self.model.ema.step(
-                            self.parameters,
-                            update_step
-                        )
+                        if self.tensorboard is not None:
+                            self.tensorboard.add_scalar(
+                                "ema_decay",
+                                self.model.ema.get_current_decay(update_step),
+                                train_progress.global_step
+                            )
+                        with self.profiler.phase("ema_step"):
+                            self.model.ema.step(
+                                self.parameters,
+                                update_step
+                            )
                     self.one_step_trained = True
 
-                train_progress.next_step(self.args.batch_size)
+                self.profiler.step(self.args.batch_size, self.tensorboard, train_progress.global_step)
+
+                # the train progress counts the samples of all ranks
+                train_progress.next_step(self.args.batch_size * distributed_util.world_size())
                 self.callbacks.on_update_train_progress(train_progress, current_epoch_length, self.args.epochs)
 
                 if self.commands.get_stop_command():
+                    metrics.flush(self.tensorboard)
                     return
 
+            step_tqdm.set_postfix(metrics.flush(self.tensorboard))
+
             train_progress.next_epoch()
             self.callbacks.on_update_train_progress(train_progress, current_epoch_length, self.args.epochs)
 
@@ -565,7 +867,13 @@ class GenericTrainer(BaseTrainer):
                 return
 
     def end(self):
+        if self.background_cacher is not None:
+            self.background_cacher.wait()
+
         if self.one_step_trained:
+            self.__consolidate_optimizer_state()
+
+        if self.one_step_trained and self.is_main_rank:
             if self.args.backup_before_save:
                 self.backup()
 
@@ -582,7 +890,20 @@ class GenericTrainer(BaseTrainer):
                 dtype=self.args.output_dtype.torch_dtype()
             )
 
-        self.tensorboard.close()
+        if self.async_checkpoint_writer is not None:
+            self.callbacks.on_update_status("waiting for background saving")
+            self.async_checkpoint_writer.wait()
 
-        if self.args.tensorboard:
+        if self.args.step_profiling and self.is_main_rank:
+            summary_path = os.path.join(self.args.workspace_dir, "profiler", f"{self.__get_string_timestamp()}.json")
+            self.profiler.save_summary(summary_path)
+            print("Saved step profiler summary to " + summary_path)
+
+        if self.tensorboard is not None:
+            self.tensorboard.close()
+
+        if self.args.tensorboard and self.is_main_rank:
             self.tensorboard_subprocess.kill()
+
+        distributed_util.barrier()
+        distributed_util.destroy_process_group()
@@ -23,8 +23,10 @@ from modules.util.args.TrainArgs import TrainArgs
 from modules.util.callbacks.TrainCallbacks import TrainCallbacks
 from modules.util.commands.TrainCommands import TrainCommands
 from modules.util.enum.AttentionMechanism import AttentionMechanism
+from modules.util.enum.CompileMode import CompileMode
 from modules.util.enum.DataType import DataType
 from modules.util.enum.EMAMode import EMAMode
+from modules.util.enum.EMAPrecision import EMAPrecision
 from modules.util.enum.ImageFormat import ImageFormat
 from modules.util.enum.LearningRateScheduler import LearningRateScheduler
 from modules.util.enum.ModelFormat import ModelFormat
@@ -165,6 +167,20 @@ class TrainUI(ctk.CTk):
                          tooltip="Starts the Tensorboard Web UI during training")
         components.switch(master, 6, 1, self.ui_state, "tensorboard")
 
+        # step profiling
+        components.label(master, 7, 0, "Step Profiling",
+                         tooltip="Measures the time spent in each phase of a training step. Results are logged to tensorboard and saved to <workspace>/profiler at the end of the training")
+        components.switch(master, 7, 1, self.ui_state, "step_profiling")
+
+        components.label(master, 8, 0, "Step Profiling Interval",
+                         tooltip="The number of steps between step profiler reports. Each report needs one device synchronization")
+        components.entry(master, 8, 1, self.ui_state, "step_profiling_interval")
+
+        # metrics flush interval
+        components.label(master, 9, 0, "Loss Logging Interval",
+                         tooltip="The maximum number of update steps between reading the loss from the train device. Higher values let the training run further ahead of the device")
+        components.entry(master, 9, 1, self.ui_state, "metrics_flush_interval_steps")
+
     def model_tab(self, master):
         master.grid_columnconfigure(0, weight=0)
         master.grid_columnconfigure(1, weight=1)
@@ -292,6 +308,119 @@ class TrainUI(ctk.CTk):
                          tooltip="Clears the cache directory before starting to train. Only disable this if you want to continue using the same cached data. Disabling this can lead to errors, if other settings are changed during a restart")
         components.switch(master, 5, 1, self.ui_state, "clear_cache_before_training")
 
+        # cache text encoder outputs
+        components.label(master, 6, 0, "Cache Text Encoder Outputs",
+                         tooltip="Caches the text encoder outputs while the text encoder is not trained, and removes the text encoder from the GPU. Not used if tag shuffling is enabled")
+        components.switch(master, 6, 1, self.ui_state, "cache_text_encoder_outputs")
+
+        # sharded latent cache
+        components.label(master, 7, 0, "Sharded Latent Cache",
+                         tooltip="Packs the cached data of each epoch into a few large files instead of one file per image. This speeds up caching and reading of big datasets. Only images that changed are cached again, so clearing the cache before training can be disabled")
+        components.switch(master, 7, 1, self.ui_state, "sharded_latent_cache")
+
+        # vae batch size
+        components.label(master, 8, 0, "VAE Batch Size",
+                         tooltip="The maximum number of images of the same resolution that are encoded together while caching. It is reduced automatically if the VAE runs out of memory. With values above 1, the latents can differ slightly from encoding each image on its own")
+        components.entry(master, 8, 1, self.ui_state, "vae_batch_size")
+
+        # dataloader threads
+        components.label(master, 9, 0, "Dataloader Threads",
+                         tooltip="The number of threads that decode images ahead of the VAE. Augmentations still run on one thread at a time. 0 loads all images on the main thread")
+        components.entry(master, 9, 1, self.ui_state, "dataloader_threads")
+
+        # dataloader prefetch batches
+        components.label(master, 10, 0, "Dataloader Prefetch Batches",
+                         tooltip="The number of batches the dataloader threads load ahead")
+        components.entry(master, 10, 1, self.ui_state, "dataloader_prefetch_batches")
+
+        # device prefetch batches
+        components.label(master, 11, 0, "Device Prefetch Batches",
+                         tooltip="The number of batches that are prepared in the background and copied to the train device while the previous batch is trained. 0 disables prefetching")
+        components.entry(master, 11, 1, self.ui_state, "device_prefetch_batches")
+
+        # dataset index
+        components.label(master, 12, 0, "Dataset Index",
+                         tooltip="Keeps an index of all concept directories in the cache directory. Only directories that changed since the last run are listed again, which speeds up the start of training on big datasets or network drives")
+        components.switch(master, 12, 1, self.ui_state, "dataset_index")
+
+        # aspect bucket planning
+        components.label(master, 13, 0, "Aspect Bucket Planning",
+                         tooltip="Derives the aspect ratio buckets from the aspect ratios of the dataset, so less of each image is cropped. Only used with aspect ratio bucketing")
+        components.switch(master, 13, 1, self.ui_state, "aspect_bucket_planning")
+
+        # aspect bucket count
+        components.label(master, 14, 0, "Aspect Bucket Count",
+                         tooltip="The maximum number of planned aspect ratio buckets. Each bucket contains at least one full batch")
+        components.entry(master, 14, 1, self.ui_state, "aspect_bucket_count")
+
+        # pre-resize images
+        components.label(master, 15, 0, "Pre-resize Images",
+                         tooltip="Stores a downsized copy of each image in the cache directory, and loads it instead of the original. This speeds up training without latent caching, or with more than one cached epoch")
+        components.switch(master, 15, 1, self.ui_state, "pre_resize_images")
+
+        # draft jpeg decoding
+        components.label(master, 16, 0, "Draft JPEG Decoding",
+                         tooltip="Decodes jpeg images at 1/2, 1/4 or 1/8 scale if they are much bigger than their bucket resolution, before they are resized with a high quality filter")
+        components.switch(master, 16, 1, self.ui_state, "draft_jpeg_decoding")
+
+        # ram cache budget
+        components.label(master, 17, 0, "RAM Cache Budget (GB)",
+                         tooltip="The RAM budget of the in-memory cache that is used without latent caching. The least recently used items above the budget are spilled to the cache directory. 0 disables the budget")
+        components.entry(master, 17, 1, self.ui_state, "ram_cache_budget_gb")
+
+        # ram cache data type
+        components.label(master, 18, 0, "RAM Cache Data Type",
+                         tooltip="The data type of latent distributions in the in-memory cache. Smaller data types use less memory")
+        components.options_kv(master, 18, 1, [
+            ("", DataType.NONE),
+            ("float16", DataType.FLOAT_16),
+            ("bfloat16", DataType.BFLOAT_16),
+        ], self.ui_state, "ram_cache_dtype")
+
+        # latent cache mean only
+        components.label(master, 19, 0, "Latent Cache Mean Only",
+                         tooltip="Only stores the mean of latent distributions in the sharded latent cache, which is the only value used during training. This halves the size of the cache")
+        components.switch(master, 19, 1, self.ui_state, "latent_cache_mean_only")
+
+        # latent cache data type
+        components.label(master, 20, 0, "Latent Cache Data Type",
+                         tooltip="The data type of latent distributions in the sharded latent cache. Values are converted back to their original data type while reading")
+        components.options_kv(master, 20, 1, [
+            ("", DataType.NONE),
+            ("float16", DataType.FLOAT_16),
+            ("bfloat16", DataType.BFLOAT_16),
+        ], self.ui_state, "latent_cache_dtype")
+
+        # latent cache compression
+        components.label(master, 21, 0, "Latent Cache Compression",
+                         tooltip="Compresses latent distributions in the sharded latent cache with zstd. Needs the zstandard package")
+        components.switch(master, 21, 1, self.ui_state, "latent_cache_compression")
+
+        # background caching
+        components.label(master, 22, 0, "Background Caching",
+                         tooltip="Fills the sharded latent cache of the next epoch in the background while the current epoch is trained. Only used with more than one latent caching epoch")
+        components.switch(master, 22, 1, self.ui_state, "background_caching")
+
+        # background caching device
+        components.label(master, 23, 0, "Background Caching Device",
+                         tooltip="The device used for background caching, for example a second GPU. Defaults to the train device")
+        components.entry(master, 23, 1, self.ui_state, "background_caching_device")
+
+        # background caching batch size
+        components.label(master, 24, 0, "Background Caching Batch Size",
+                         tooltip="The VAE batch size used for background caching. Smaller values use less memory on the caching device")
+        components.entry(master, 24, 1, self.ui_state, "background_caching_batch_size")
+
+        # background caching duty cycle
+        components.label(master, 25, 0, "Background Caching Duty Cycle",
+                         tooltip="The fraction of time background caching is allowed to work. Smaller values leave more compute for training")
+        components.entry(master, 25, 1, self.ui_state, "background_caching_duty_cycle")
+
+        # probe image resolution
+        components.label(master, 26, 0, "Probe Image Resolution",
+                         tooltip="Reads the resolution of each image from its file header for aspect ratio bucketing, instead of decoding the image. Always used with pre-resized images or draft jpeg decoding")
+        components.switch(master, 26, 1, self.ui_state, "probe_image_resolution")
+
     def concepts_tab(self, master):
         ConceptTab(master, self.train_args, self.ui_state)
 
@@ -376,6 +505,17 @@ class TrainUI(ctk.CTk):
                          tooltip="Number of steps between EMA update steps")
         components.entry(scroll_frame, 11, 1, self.ui_state, "ema_update_step_interval")
 
+        # ema pinned staging
+        components.label(scroll_frame, 12, 0, "EMA Pinned Staging",
+                         tooltip="Copies the parameters of a CPU EMA through pinned memory, overlapping the copy with the EMA update. This speeds up CPU EMA at the cost of a small amount of pinned memory")
+        components.switch(scroll_frame, 12, 1, self.ui_state, "ema_pinned_staging")
+
+        # ema precision
+        components.label(scroll_frame, 13, 0, "EMA Precision",
+                         tooltip="The storage precision of the EMA. BFLOAT_16_STOCHASTIC halves the memory of a float32 EMA. BFLOAT_16_RESIDUAL keeps the rounding error of each update in a second bfloat16 tensor, which is more accurate, and needs as much memory as a float32 EMA")
+        components.options(scroll_frame, 13, 1, [str(x) for x in list(EMAPrecision)], self.ui_state,
+                           "ema_precision")
+
         # column 2
         # train text encoder
         components.label(scroll_frame, 0, 3, "Train Text Encoder",
@@ -473,6 +613,17 @@ class TrainUI(ctk.CTk):
                          tooltip="Specifies the maximum noising strength used during training. This can be useful to reduce overfitting, but also reduces the impact of training samples on the overall image composition")
         components.entry(scroll_frame, 9, 7, self.ui_state, "max_noising_strength")
 
+        # compile mode
+        components.label(scroll_frame, 10, 6, "Compile Mode",
+                         tooltip="Compiles the transformer and resnet blocks with torch.compile. The first steps of each resolution will be slower")
+        components.options(scroll_frame, 10, 7, [str(x) for x in list(CompileMode)], self.ui_state,
+                           "compile_mode")
+
+        # channels last
+        components.label(scroll_frame, 11, 6, "Channels Last",
+                         tooltip="Uses the channels last memory format for the U-Net, which speeds up convolutions on recent GPUs")
+        components.switch(scroll_frame, 11, 7, self.ui_state, "channels_last")
+
     def sampling_tab(self, master):
         master.grid_rowconfigure(0, weight=0)
         master.grid_rowconfigure(1, weight=1)
@@ -535,6 +686,16 @@ class TrainUI(ctk.CTk):
                          tooltip="The interval used when automatically saving the model during training")
         components.time_entry(master, 3, 1, self.ui_state, "save_after", "save_after_unit")
 
+        # async backup
+        components.label(master, 4, 0, "Async Backup",
+                         tooltip="Writes backups and saves in the background while the training continues. This needs enough system memory to hold an additional copy of the model")
+        components.switch(master, 4, 1, self.ui_state, "async_backup")
+
+        # async backup max in flight
+        components.label(master, 4, 3, "Max Async Backups",
+                         tooltip="The maximum number of backups or saves that are written in the background at the same time")
+        components.entry(master, 4, 4, self.ui_state, "async_backup_max_in_flight")
+
     def lora_tab(self, master):
         master.grid_columnconfigure(0, weight=0)
         master.grid_columnconfigure(1, weight=1)
@@ -568,6 +729,16 @@ class TrainUI(ctk.CTk):
             ("bfloat16", DataType.BFLOAT_16),
         ], self.ui_state, "lora_weight_dtype")
 
+        # lora flat parameters
+        components.label(master, 4, 0, "Flat LoRA Parameters",
+                         tooltip="Stores all LoRA weights and gradients in a few flat buffers. This reduces the overhead of the optimizer, gradient clipping and EMA for the many small LoRA weights. Backups can only be continued with the same setting")
+        components.switch(master, 4, 1, self.ui_state, "lora_flat_parameters")
+
+        # lora merge for sampling
+        components.label(master, 5, 0, "Merge LoRA For Sampling",
+                         tooltip="Merges the LoRA into the model weights while sampling, which samples at the speed of the base model. The original weights are restored afterwards. With low precision model weights, very small LoRA changes can be lost in the samples. Not supported with model compilation")
+        components.switch(master, 5, 1, self.ui_state, "lora_merge_for_sampling")
+
         return master
 
     def embedding_tab(self, master):
@@ -0,0 +1,142 @@
+import copy
+import threading
+import traceback
+import types
+from typing import Any, Callable
+
+import torch
+from torch.nn import Parameter
+from torch.optim import Optimizer
+
+
+class OptimizerStateSnapshot:
+    """
+    Stands in for an optimizer inside a model snapshot. Model savers only ever call state_dict() on it.
+    """
+
+    def __init__(self, state_dict: dict):
+        self.__state_dict = state_dict
+
+    def state_dict(self) -> dict:
+        return self.__state_dict
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints on background threads, so the training loop can continue while a model is serialized.
+
+    Args:
+        max_in_flight: the maximum number of checkpoints that can be written at the same time.
+            Submitting another checkpoint blocks until the oldest write has finished.
+    """
+
+    def __init__(self, max_in_flight: int = 1):
+        self.max_in_flight = max(1, max_in_flight)
+        self.threads = []
+
+    @staticmethod
+    @torch.no_grad()
+    def snapshot(model: Any, shared_modules: list[torch.nn.Module] | None = None) -> Any:
+        """
+        Creates a consistent copy of the model, where every tensor is moved to the CPU. This includes the weights,
+        the EMA state, the train progress and the optimizer state. The copy does not share any memory with the
+        original model, which can continue training while the copy is written.
+
+        Args:
+            model: the model
+            shared_modules: modules that are not written by the model saver, for example the frozen base model while
+                training a LoRA. They are referenced by the copy instead of being copied, and should not be changed
+                while the copy is written.
+        """
+        memo = {}
+        visited = set()
+        for shared_module in shared_modules or []:
+            for module in shared_module.modules():
+                memo[id(module)] = module
+                visited.add(id(module))
+            for tensor in list(shared_module.parameters()) + list(shared_module.buffers()):
+                memo[id(tensor)] = tensor
+                visited.add(id(tensor))
+
+        AsyncCheckpointWriter.__collect_tensors(model, memo, visited)
+
+        optimizer = getattr(model, 'optimizer', None)
+        if isinstance(optimizer, Optimizer):
+            state_dict = optimizer.state_dict()
+            AsyncCheckpointWriter.__collect_tensors(state_dict, memo, visited)
+            memo[id(optimizer)] = OptimizerStateSnapshot(copy.deepcopy(state_dict, memo))
+
+        return copy.deepcopy(model, memo)
+
+    @staticmethod
+    def __collect_tensors(obj: Any, memo: dict, visited: set):
+        if isinstance(obj, (str, bytes, int, float, bool, type, types.FunctionType, types.ModuleType)) \
+                or obj is None or id(obj) in visited:
+            return
+        visited.add(id(obj))
+
+        if isinstance(obj, torch.Tensor):
+            if id(obj) not in memo:
+                cpu_tensor = obj.detach().to(device='cpu', copy=True)
+                if isinstance(obj, Parameter):
+                    cpu_tensor = Parameter(cpu_tensor, requires_grad=obj.requires_grad)
+                memo[id(obj)] = cpu_tensor
+        elif isinstance(obj, Optimizer):
+            # the optimizer state is copied through its state dict
+            pass
+        elif isinstance(obj, dict):
+            for key, value in obj.items():
+                AsyncCheckpointWriter.__collect_tensors(key, memo, visited)
+                AsyncCheckpointWriter.__collect_tensors(value, memo, visited)
+        elif isinstance(obj, (list, tuple, set)):
+            for value in obj:
+                AsyncCheckpointWriter.__collect_tensors(value, memo, visited)
+        elif isinstance(obj, types.MethodType):
+            AsyncCheckpointWriter.__collect_tensors(obj.__self__, memo, visited)
+        elif hasattr(obj, '__dict__'):
+            AsyncCheckpointWriter.__collect_tensors(vars(obj), memo, visited)
+
+    def wait_for_slot(self, on_wait: Callable[[], None] | None = None):
+        """
+        Blocks until another checkpoint can be submitted. Call this before creating a snapshot, so no more than
+        max_in_flight snapshots are kept in memory at the same time.
+
+        Args:
+            on_wait: called before blocking, if too many checkpoints are currently in flight
+        """
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        if len(self.threads) >= self.max_in_flight:
+            if on_wait is not None:
+                on_wait()
+            while len(self.threads) >= self.max_in_flight:
+                self.threads.pop(0).join()
+
+    def submit(self, name: str, write_fun: Callable[[], None], on_wait: Callable[[], None] | None = None):
+        """
+        Starts writing a checkpoint in the background
+
+        Args:
+            name: a name used in log messages
+            write_fun: the function that writes the checkpoint. It is called on a background thread
+            on_wait: called before blocking, if too many checkpoints are currently in flight
+        """
+        self.wait_for_slot(on_wait)
+
+        def run():
+            try:
+                write_fun()
+            except:
+                traceback.print_exc()
+                print(f"Error while writing {name} in the background")
+
+        thread = threading.Thread(target=run, name=name, daemon=False)
+        thread.start()
+        self.threads.append(thread)
+
+    def wait(self):
+        """
+        Blocks until all checkpoints are written
+        """
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
@@ -0,0 +1,100 @@
+import copy
+import threading
+import traceback
+from contextlib import nullcontext
+from typing import Callable
+
+import torch
+
+from modules.model.BaseModel import BaseModel
+from modules.util.TrainProgress import TrainProgress
+from modules.util.args.TrainArgs import TrainArgs
+
+
+class BackgroundCacher:
+    """
+    Fills the sharded latent cache of the next epoch on a background thread, while the current epoch is trained.
+
+    The cache is filled by a second data loader with its own copy of the models that calculate the cached data, for
+    example the VAE. These copies are placed on the caching device, which can be the train device or a second device.
+    When the main data loader starts the next epoch, every item is already cached, and the epoch can start without
+    encoding anything. If caching fails, the main data loader calculates the missing items itself.
+
+    Args:
+        create_data_loader: creates a data loader from (args, model, train_progress)
+        args: the train args
+        caching_model_names: the names of all models in the model object that calculate the cached data
+        device: the device used for caching
+        batch_size: the VAE batch size used for caching, which limits the memory used on the caching device
+        max_duty_cycle: the fraction of time the caching thread is allowed to work
+    """
+
+    def __init__(
+            self,
+            create_data_loader: Callable[[TrainArgs, BaseModel, TrainProgress], object],
+            args: TrainArgs,
+            caching_model_names: list[str],
+            device: torch.device,
+            batch_size: int,
+            max_duty_cycle: float,
+    ):
+        self.create_data_loader = create_data_loader
+        self.caching_model_names = caching_model_names
+        self.device = device
+        self.max_duty_cycle = min(max(max_duty_cycle, 0.01), 1.0)
+
+        self.args = copy.copy(args)
+        self.args.train_device = str(device)
+        self.args.vae_batch_size = max(1, batch_size)
+        self.args.device_prefetch_batches = 0
+        self.args.debug_mode = False
+        # the text encoder is shared with the training thread, its outputs are cached by the main data loader
+        self.args.cache_text_encoder_outputs = False
+
+        self.thread = None
+
+    def __copy_model(self, model: BaseModel) -> BaseModel:
+        caching_model = copy.copy(model)
+        for name in self.caching_model_names:
+            module = getattr(model, name, None)
+            if module is not None:
+                setattr(caching_model, name, copy.deepcopy(module).to(self.device).eval())
+        return caching_model
+
+    def __cache(self, model: BaseModel, epoch: int):
+        try:
+            data_loader = self.create_data_loader(self.args, model, TrainProgress(epoch=epoch))
+            for cache in data_loader.sharded_disk_caches:
+                cache.max_duty_cycle = self.max_duty_cycle
+
+            # a separate stream lets the caching kernels run alongside the training kernels
+            if self.device.type == 'cuda':
+                stream_context = torch.cuda.stream(torch.cuda.Stream(self.device))
+            else:
+                stream_context = nullcontext()
+
+            with stream_context, torch.no_grad():
+                data_loader.ds.start_next_epoch()
+        except Exception:
+            print(f"background caching of epoch {epoch} failed, it will be cached when the epoch starts")
+            traceback.print_exc()
+
+    def start(self, model: BaseModel, epoch: int):
+        """
+        Starts caching the given epoch. The models are copied in their current state before this function returns.
+        """
+        self.wait()
+
+        caching_model = self.__copy_model(model)
+        self.thread = threading.Thread(
+            target=self.__cache, args=(caching_model, epoch), name="BackgroundCacher", daemon=True
+        )
+        self.thread.start()
+
+    def wait(self):
+        """
+        Waits until the epoch that is currently cached is finished
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,154 @@
+import queue
+import threading
+from typing import Iterable, Iterator
+
+import torch
+from torch import Tensor
+
+
+class BatchPrefetcher:
+    """
+    Iterates over a data loader on a background thread, and moves each batch to the train device ahead of time.
+
+    On cuda devices, tensors that are still on the CPU are copied into reusable pinned buffers and transferred with
+    non-blocking copies on a separate stream, so the transfer of the next batch overlaps the computation of the current
+    batch. Pinned buffers are kept in a bounded pool for each shape and dtype, and are reused across steps. Tensors that
+    are already on the device are passed through. On other devices, batches are simply loaded one batch ahead.
+
+    Args:
+        data_loader: the data loader to wrap
+        device: the train device
+        prefetch_batches: the number of batches loaded ahead on cuda devices
+        max_buffers: the maximum number of pinned buffers
+    """
+
+    __END = object()
+
+    def __init__(
+            self,
+            data_loader: Iterable[dict],
+            device: torch.device,
+            prefetch_batches: int = 2,
+            max_buffers: int = 64,
+    ):
+        self.data_loader = data_loader
+        self.device = device
+        self.use_streams = device.type == 'cuda' and torch.cuda.is_available()
+        self.prefetch_batches = max(1, prefetch_batches) if self.use_streams else 1
+        self.max_buffers = max(1, max_buffers)
+
+        self.stream = torch.cuda.Stream(device) if self.use_streams else None
+
+        # unused pinned buffers for each (shape, dtype), with the event of the last copy out of the buffer
+        self.free_buffers: dict[tuple, list[tuple[Tensor, torch.cuda.Event]]] = {}
+        self.buffer_count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.data_loader)
+
+    def __acquire_buffer(self, tensor: Tensor) -> Tensor | None:
+        key = (tuple(tensor.shape), tensor.dtype)
+        with self.lock:
+            free_buffers = self.free_buffers.get(key)
+            free_buffer = free_buffers.pop() if free_buffers else None
+
+            if free_buffer is None and self.buffer_count >= self.max_buffers:
+                # free an unused buffer of a different shape, or fall back to a pageable copy
+                for other_buffers in self.free_buffers.values():
+                    if other_buffers:
+                        other_buffers.pop()
+                        self.buffer_count -= 1
+                        break
+                else:
+                    return None
+
+            if free_buffer is None:
+                self.buffer_count += 1
+
+        if free_buffer is not None:
+            buffer, event = free_buffer
+            # the buffer can only be overwritten after the previous copy out of it has finished
+            event.synchronize()
+            return buffer
+
+        return torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+
+    def __release_buffers(self, buffers: list[Tensor], event: torch.cuda.Event):
+        with self.lock:
+            for buffer in buffers:
+                self.free_buffers.setdefault((tuple(buffer.shape), buffer.dtype), []).append((buffer, event))
+
+    def __transfer(self, batch: dict) -> tuple[dict, list[str], list[Tensor], torch.cuda.Event | None]:
+        if not self.use_streams:
+            return batch, [], [], None
+
+        moved_names = []
+        buffers = []
+        with torch.cuda.stream(self.stream):
+            for name, value in batch.items():
+                if isinstance(value, Tensor) and value.device.type == 'cpu':
+                    buffer = self.__acquire_buffer(value)
+                    if buffer is not None:
+                        buffer.copy_(value)
+                        buffers.append(buffer)
+                        value = buffer
+                    batch[name] = value.to(self.device, non_blocking=True)
+                    moved_names.append(name)
+
+            event = torch.cuda.Event()
+            event.record(self.stream)
+
+        return batch, moved_names, buffers, event
+
+    def __run(self, batch_queue: queue.Queue, stop: threading.Event):
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in self.data_loader:
+                if not put(self.__transfer(batch)):
+                    return
+            put(self.__END)
+        except BaseException as e:
+            put(e)
+
+    def __iter__(self) -> Iterator[dict]:
+        batch_queue = queue.Queue(maxsize=self.prefetch_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.__run, args=(batch_queue, stop), name="BatchPrefetcher", daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                item = batch_queue.get()
+                if item is self.__END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+
+                batch, moved_names, buffers, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    for name in moved_names:
+                        # the tensors were allocated on the prefetch stream, but are used on the current stream
+                        batch[name].record_stream(current_stream)
+                    self.__release_buffers(buffers, event)
+
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+            # return the buffers of batches that were prefetched, but never used
+            while not batch_queue.empty():
+                item = batch_queue.get()
+                if isinstance(item, tuple) and item[3] is not None:
+                    self.__release_buffers(item[2], item[3])
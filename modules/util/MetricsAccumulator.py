@@ -0,0 +1,121 @@
+import time
+
+import torch
+from torch import Tensor
+from torch.utils.tensorboard import SummaryWriter
+
+
+class MetricsAccumulator:
+    """
+    Accumulates training metrics on the train device.
+
+    Calling .item() on a loss tensor forces the host to wait for the device. To keep the host ahead of the device,
+    losses and gradient norms are kept as device tensors and only copied to the host when the accumulator is flushed.
+    A flush happens after a fixed number of update steps or after a fixed number of seconds, whichever comes first.
+    """
+
+    def __init__(
+            self,
+            flush_interval_steps: int = 10,
+            flush_interval_seconds: float = 5.0,
+            ema_loss_decay: float = 0.99,
+    ):
+        self.flush_interval_steps = max(1, flush_interval_steps)
+        self.flush_interval_seconds = flush_interval_seconds
+        self.ema_loss_decay = ema_loss_decay
+
+        self.accumulated_loss = None
+        self.ema_loss = None
+
+        # (global_step, learning_rate, loss, ema_loss, grad_norm) for each update step that was not yet flushed
+        self.pending = []
+        self.last_flush_time = time.time()
+
+        self.last_loss = None
+        self.last_ema_loss = None
+        self.last_grad_norm = None
+
+    @torch.no_grad()
+    def add_loss(self, loss: Tensor):
+        loss = loss.detach().float()
+        if self.accumulated_loss is None:
+            self.accumulated_loss = loss.clone()
+        else:
+            self.accumulated_loss.add_(loss)
+
+    @torch.no_grad()
+    def finish_update_step(self, global_step: int, learning_rate: float, grad_norm: Tensor | None = None):
+        """
+        Closes the current update step. Does not synchronize with the device.
+        """
+        loss = self.accumulated_loss
+        self.accumulated_loss = None
+        if loss is None:
+            return
+
+        if self.ema_loss is None:
+            self.ema_loss = loss.clone()
+        else:
+            self.ema_loss.mul_(self.ema_loss_decay).add_(loss, alpha=1 - self.ema_loss_decay)
+
+        if grad_norm is not None:
+            grad_norm = grad_norm.detach().float()
+
+        self.pending.append((global_step, learning_rate, loss, self.ema_loss.clone(), grad_norm))
+
+    def needs_flush(self) -> bool:
+        if not self.pending:
+            return False
+
+        return len(self.pending) >= self.flush_interval_steps \
+            or time.time() - self.last_flush_time > self.flush_interval_seconds
+
+    @torch.no_grad()
+    def flush(self, tensorboard: SummaryWriter | None = None) -> dict:
+        """
+        Copies all pending metrics to the host with a single synchronization and writes them to tensorboard.
+
+        Returns:
+            the most recent metrics, to display them in a progress bar
+        """
+        self.last_flush_time = time.time()
+
+        if not self.pending:
+            return self.postfix()
+
+        losses = torch.stack([pending[2] for pending in self.pending])
+        ema_losses = torch.stack([pending[3] for pending in self.pending])
+        grad_norms = [pending[4] for pending in self.pending]
+        has_grad_norm = all(grad_norm is not None for grad_norm in grad_norms)
+
+        if has_grad_norm:
+            values = torch.stack([losses, ema_losses, torch.stack(grad_norms)]).cpu().tolist()
+        else:
+            values = torch.stack([losses, ema_losses]).cpu().tolist()
+
+        for i, (global_step, learning_rate, _, _, _) in enumerate(self.pending):
+            self.last_loss = values[0][i]
+            self.last_ema_loss = values[1][i]
+            self.last_grad_norm = values[2][i] if has_grad_norm else None
+
+            if tensorboard is not None:
+                tensorboard.add_scalar("learning_rate", learning_rate, global_step)
+                tensorboard.add_scalar("loss", self.last_loss, global_step)
+                tensorboard.add_scalar("smooth_loss", self.last_ema_loss, global_step)
+                if self.last_grad_norm is not None:
+                    tensorboard.add_scalar("grad_norm", self.last_grad_norm, global_step)
+
+        self.pending = []
+
+        return self.postfix()
+
+    def postfix(self) -> dict:
+        postfix = {
+            'loss': self.last_loss,
+            'smooth loss': self.last_ema_loss,
+        }
+
+        if self.last_grad_norm is not None:
+            postfix['grad norm'] = self.last_grad_norm
+
+        return postfix
@@ -0,0 +1,156 @@
+from typing import Callable, Iterable
+
+import torch
+from torch.nn import Parameter
+from torch.optim import Optimizer
+
+from modules.util import distributed_util
+
+
+class ShardedOptimizer(Optimizer):
+    """
+    Partitions the optimizer state across all ranks (ZeRO stage 1).
+
+    Every parameter is owned by exactly one rank. Each rank only creates optimizer state for the parameters it owns
+    and only updates those parameters. After each step, the updated parameters are broadcast from their owners.
+    Gradients are expected to be averaged across ranks before step() is called.
+
+    The state dict uses the same layout as the state dict of a non-sharded optimizer, indexed by the position of each
+    parameter in the full list of parameters. This makes it possible to resume training with a different world size,
+    or without data-parallel training. Call consolidate_state_dict() on all ranks before calling state_dict().
+    """
+
+    def __init__(
+            self,
+            parameters: Iterable[Parameter] | list[dict],
+            create_local_optimizer: Callable[[list[dict]], Optimizer],
+    ):
+        param_groups = list(parameters)
+        if len(param_groups) == 0 or not isinstance(param_groups[0], dict):
+            param_groups = [{'params': param_groups}]
+        param_groups = [dict(group, params=list(group['params'])) for group in param_groups]
+
+        self.rank = distributed_util.rank()
+        self.world_size = distributed_util.world_size()
+
+        all_parameters = [parameter for group in param_groups for parameter in group['params']]
+        self.owners = self.__partition(all_parameters, self.world_size)
+
+        local_param_groups = [
+            dict(group, params=[p for p in group['params'] if self.owners[id(p)] == self.rank])
+            for group in param_groups
+        ]
+        self.local_optimizer = create_local_optimizer(local_param_groups)
+
+        super(ShardedOptimizer, self).__init__(param_groups, {})
+
+        self.__consolidated_state_dict = None
+
+    @staticmethod
+    def __partition(parameters: list[Parameter], world_size: int) -> dict[int, int]:
+        # greedily assign the largest parameters to the rank with the fewest elements
+        owners = {}
+        rank_sizes = [0] * world_size
+        for parameter in sorted(parameters, key=lambda p: p.numel(), reverse=True):
+            rank = rank_sizes.index(min(rank_sizes))
+            owners[id(parameter)] = rank
+            rank_sizes[rank] += parameter.numel()
+        return owners
+
+    def __local_to_global_indices(self) -> dict[int, int]:
+        indices = {}
+        global_index = 0
+        local_index = 0
+        for group in self.param_groups:
+            for parameter in group['params']:
+                if self.owners[id(parameter)] == self.rank:
+                    indices[local_index] = global_index
+                    local_index += 1
+                global_index += 1
+        return indices
+
+    def __copy_hyperparameters(self, source_groups: list[dict], target_groups: list[dict]):
+        for source_group, target_group in zip(source_groups, target_groups):
+            for key, value in source_group.items():
+                if key != 'params':
+                    target_group[key] = value
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        self.__consolidated_state_dict = None
+
+        # the learning rate scheduler only modifies the param groups of this wrapper
+        self.__copy_hyperparameters(self.param_groups, self.local_optimizer.param_groups)
+        loss = self.local_optimizer.step(closure)
+        self.__copy_hyperparameters(self.local_optimizer.param_groups, self.param_groups)
+
+        for rank in range(self.world_size):
+            owned_parameters = [
+                parameter for group in self.param_groups for parameter in group['params']
+                if self.owners[id(parameter)] == rank
+            ]
+            distributed_util.broadcast_tensors(owned_parameters, src=rank)
+
+        return loss
+
+    def consolidate_state_dict(self, to: int = 0):
+        """
+        Collects the optimizer state of all ranks on a single rank. This needs to be called on all ranks.
+        """
+        local_state_dict = self.local_optimizer.state_dict()
+        local_to_global = self.__local_to_global_indices()
+
+        local_state = {
+            local_to_global[local_index]: {
+                key: value.detach().cpu() if isinstance(value, torch.Tensor) else value
+                for key, value in state.items()
+            }
+            for local_index, state in local_state_dict['state'].items()
+        }
+
+        gathered_states = distributed_util.gather_object(local_state, dst=to)
+
+        if self.rank == to:
+            state = {}
+            for rank_state in gathered_states:
+                state |= rank_state
+
+            param_groups = []
+            global_index = 0
+            for group in self.param_groups:
+                packed_group = {key: value for key, value in group.items() if key != 'params'}
+                packed_group['params'] = list(range(global_index, global_index + len(group['params'])))
+                global_index += len(group['params'])
+                param_groups.append(packed_group)
+
+            self.__consolidated_state_dict = {
+                'state': state,
+                'param_groups': param_groups,
+            }
+
+    def state_dict(self) -> dict:
+        if self.world_size == 1:
+            self.consolidate_state_dict()
+
+        if self.__consolidated_state_dict is None:
+            raise RuntimeError("consolidate_state_dict() needs to be called on all ranks before state_dict()")
+
+        return self.__consolidated_state_dict
+
+    def load_state_dict(self, state_dict: dict):
+        """
+        Loads a full (non-sharded) optimizer state dict. Each rank only keeps the state of its own parameters.
+        """
+        self.__copy_hyperparameters(state_dict['param_groups'], self.param_groups)
+
+        local_to_global = self.__local_to_global_indices()
+        local_state_dict = self.local_optimizer.state_dict()
+
+        local_state_dict['state'] = {
+            local_index: state_dict['state'][global_index]
+            for local_index, global_index in local_to_global.items()
+            if global_index in state_dict['state']
+        }
+        self.__copy_hyperparameters(state_dict['param_groups'], local_state_dict['param_groups'])
+
+        self.local_optimizer.load_state_dict(local_state_dict)
@@ -0,0 +1,191 @@
+import json
+import os
+import time
+from collections import deque
+from contextlib import nullcontext, contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+
+class StepProfiler:
+    """
+    Measures the time spent in each phase of a training step.
+
+    Device phases are timed with cuda events, so no synchronization is needed while recording. The recorded events are
+    only resolved every report_interval steps. Host phases and all phases on other devices are timed with
+    time.perf_counter(). If the profiler is disabled, every function returns immediately.
+    """
+
+    def __init__(
+            self,
+            enabled: bool,
+            device: torch.device,
+            report_interval: int = 100,
+            window_size: int = 1000,
+    ):
+        self.enabled = enabled
+        self.device = device
+        self.use_events = enabled and device.type == 'cuda'
+        self.report_interval = max(1, report_interval)
+
+        # (name, start, end) tuples that are not yet resolved
+        self.pending = []
+
+        # rolling window of timings in milliseconds for each phase
+        self.timings: dict[str, deque] = {}
+        self.total_counts: dict[str, int] = {}
+        self.total_times: dict[str, float] = {}
+
+        self.window_size = window_size
+        self.step_count = 0
+        self.report_samples = 0
+        self.report_start_time = time.perf_counter()
+        self.total_samples = 0
+        self.start_time = self.report_start_time
+        self.samples_per_second = 0.0
+
+    def phase(self, name: str, host: bool = False):
+        """
+        Returns a context manager that times the enclosed code
+
+        Args:
+            name: name of the phase
+            host: if True, the phase is timed on the host, even if device events are available
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self.__phase(name, host)
+
+    @contextmanager
+    def __phase(self, name: str, host: bool):
+        if self.use_events and not host:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            try:
+                yield
+            finally:
+                end.record()
+                self.pending.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.pending.append((name, start, time.perf_counter()))
+
+    def time_iterator(self, name: str, iterable: Iterable) -> Iterable:
+        """
+        Wraps an iterable, to time how long each call to next() takes
+        """
+        if not self.enabled:
+            return iterable
+        return self.__time_iterator(name, iter(iterable))
+
+    def __time_iterator(self, name: str, iterator: Iterator) -> Iterator:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.pending.append((name, start, time.perf_counter()))
+            yield item
+
+    def step(self, samples: int, tensorboard: SummaryWriter | None = None, global_step: int = 0):
+        """
+        Marks the end of a training step. Every report_interval steps, the recorded timings are published.
+        """
+        if not self.enabled:
+            return
+
+        self.step_count += 1
+        self.report_samples += samples
+        self.total_samples += samples
+
+        if self.step_count % self.report_interval == 0:
+            self.report(tensorboard, global_step)
+
+    def __resolve_pending(self):
+        if self.use_events and self.pending:
+            torch.cuda.synchronize(self.device)
+
+        for name, start, end in self.pending:
+            if isinstance(start, float):
+                elapsed = (end - start) * 1000.0
+            else:
+                elapsed = start.elapsed_time(end)
+
+            if name not in self.timings:
+                self.timings[name] = deque(maxlen=self.window_size)
+                self.total_counts[name] = 0
+                self.total_times[name] = 0.0
+
+            self.timings[name].append(elapsed)
+            self.total_counts[name] += 1
+            self.total_times[name] += elapsed
+
+        self.pending = []
+
+    @staticmethod
+    def __percentile(sorted_values: list[float], percentile: float) -> float:
+        if not sorted_values:
+            return 0.0
+        index = min(len(sorted_values) - 1, int(round(percentile / 100.0 * (len(sorted_values) - 1))))
+        return sorted_values[index]
+
+    def __phase_stats(self, name: str) -> dict:
+        sorted_values = sorted(self.timings[name])
+        return {
+            'count': self.total_counts[name],
+            'mean_ms': self.total_times[name] / max(1, self.total_counts[name]),
+            'p50_ms': self.__percentile(sorted_values, 50),
+            'p90_ms': self.__percentile(sorted_values, 90),
+            'p99_ms': self.__percentile(sorted_values, 99),
+            'total_s': self.total_times[name] / 1000.0,
+        }
+
+    def report(self, tensorboard: SummaryWriter | None = None, global_step: int = 0):
+        if not self.enabled:
+            return
+
+        self.__resolve_pending()
+
+        now = time.perf_counter()
+        elapsed = now - self.report_start_time
+        if elapsed > 0:
+            self.samples_per_second = self.report_samples / elapsed
+        self.report_start_time = now
+        self.report_samples = 0
+
+        if tensorboard is not None:
+            for name in self.timings.keys():
+                stats = self.__phase_stats(name)
+                tensorboard.add_scalar(f"profiler/{name}_p50_ms", stats['p50_ms'], global_step)
+                tensorboard.add_scalar(f"profiler/{name}_p90_ms", stats['p90_ms'], global_step)
+                tensorboard.add_scalar(f"profiler/{name}_p99_ms", stats['p99_ms'], global_step)
+            tensorboard.add_scalar("profiler/samples_per_second", self.samples_per_second, global_step)
+
+    def summary(self) -> dict:
+        self.__resolve_pending()
+
+        total_time = time.perf_counter() - self.start_time
+
+        return {
+            'steps': self.step_count,
+            'samples': self.total_samples,
+            'samples_per_second': self.total_samples / total_time if total_time > 0 else 0.0,
+            'window_size': self.window_size,
+            'phases': {name: self.__phase_stats(name) for name in self.timings.keys()},
+        }
+
+    def save_summary(self, path: str):
+        if not self.enabled:
+            return
+
+        os.makedirs(Path(path).parent.absolute(), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=4)
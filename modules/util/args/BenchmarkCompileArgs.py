@@ -0,0 +1,69 @@
+import argparse
+from typing import Any
+
+from modules.util.args.BaseArgs import BaseArgs
+from modules.util.enum.CompileMode import CompileMode
+
+
+class BenchmarkCompileArgs(BaseArgs):
+    device: str
+    compile_mode: CompileMode
+    compile_dynamic: bool
+    channels_last: bool
+    gradient_checkpointing: bool
+    lora_rank: int
+    resolutions: str
+    batch_size: int
+    warmup_steps: int
+    steps: int
+
+    def __init__(self, data: list[(str, Any, type, bool)]):
+        super(BenchmarkCompileArgs, self).__init__(data)
+
+    def resolution_list(self) -> list[tuple[int, int]]:
+        resolutions = []
+        for resolution in self.resolutions.split(','):
+            height, _, width = resolution.strip().partition('x')
+            resolutions.append((int(height), int(width or height)))
+        return resolutions
+
+    @staticmethod
+    def parse_args() -> 'BenchmarkCompileArgs':
+        parser = argparse.ArgumentParser(description="One Trainer Compile Benchmark Script.")
+
+        # @formatter:off
+
+        parser.add_argument("--device", type=str, required=False, default="cpu", dest="device", help="The device of the benchmark model")
+        parser.add_argument("--compile-mode", type=CompileMode, required=False, default=CompileMode.DEFAULT, dest="compile_mode", help="The compile mode that is compared to eager execution", choices=[mode for mode in CompileMode if mode != CompileMode.NONE])
+        parser.add_argument("--compile-dynamic", required=False, action='store_true', dest="compile_dynamic", help="Compile with dynamic shapes")
+        parser.add_argument("--channels-last", required=False, action='store_true', dest="channels_last", help="Use the channels last memory format for the unet")
+        parser.add_argument("--gradient-checkpointing", required=False, action='store_true', dest="gradient_checkpointing", help="Enable gradient checkpointing")
+        parser.add_argument("--lora-rank", type=int, required=False, default=0, dest="lora_rank", help="Train a LoRA of this rank instead of the whole unet. 0 disables the LoRA")
+        parser.add_argument("--resolutions", type=str, required=False, default="32", dest="resolutions", help="A comma separated list of latent resolutions, like 32 or 32x48, that are trained in turn, like aspect ratio buckets")
+        parser.add_argument("--batch-size", type=int, required=False, default=2, dest="batch_size", help="The batch size")
+        parser.add_argument("--warmup-steps", type=int, required=False, default=3, dest="warmup_steps", help="The number of untimed steps for each resolution, which includes the compilation")
+        parser.add_argument("--steps", type=int, required=False, default=20, dest="steps", help="The number of timed steps")
+
+        # @formatter:on
+
+        args = BenchmarkCompileArgs.default_values()
+        args.from_dict(vars(parser.parse_args()))
+        return args
+
+    @staticmethod
+    def default_values() -> 'BenchmarkCompileArgs':
+        data = []
+
+        # name, default value, data type, nullable
+        data.append(("device", "cpu", str, False))
+        data.append(("compile_mode", CompileMode.DEFAULT, CompileMode, False))
+        data.append(("compile_dynamic", False, bool, False))
+        data.append(("channels_last", False, bool, False))
+        data.append(("gradient_checkpointing", False, bool, False))
+        data.append(("lora_rank", 0, int, False))
+        data.append(("resolutions", "32", str, False))
+        data.append(("batch_size", 2, int, False))
+        data.append(("warmup_steps", 3, int, False))
+        data.append(("steps", 20, int, False))
+
+        return BenchmarkCompileArgs(data)
@@ -0,0 +1,53 @@
+import argparse
+from typing import Any
+
+from modules.util.args.BaseArgs import BaseArgs
+from modules.util.enum.EMAPrecision import EMAPrecision
+
+
+class BenchmarkEMAArgs(BaseArgs):
+    device: str
+    ema_device: str
+    pinned_staging: bool
+    precision: EMAPrecision
+    parameter_count: int
+    parameter_size: int
+    steps: int
+
+    def __init__(self, data: list[(str, Any, type, bool)]):
+        super(BenchmarkEMAArgs, self).__init__(data)
+
+    @staticmethod
+    def parse_args() -> 'BenchmarkEMAArgs':
+        parser = argparse.ArgumentParser(description="One Trainer EMA Benchmark Script.")
+
+        # @formatter:off
+
+        parser.add_argument("--device", type=str, required=False, default="cpu", dest="device", help="The device of the trained parameters")
+        parser.add_argument("--ema-device", type=str, required=False, default=None, dest="ema_device", help="The device of the EMA parameters. Defaults to the device of the trained parameters")
+        parser.add_argument("--pinned-staging", required=False, action='store_true', dest="pinned_staging", help="Use pinned staging buffers for a CPU EMA")
+        parser.add_argument("--precision", type=EMAPrecision, required=False, default=EMAPrecision.FULL, dest="precision", help="The storage precision of the EMA parameters", choices=list(EMAPrecision))
+        parser.add_argument("--parameter-count", type=int, required=False, default=2000, dest="parameter_count", help="The number of parameters. A LoRA has thousands of small parameters")
+        parser.add_argument("--parameter-size", type=int, required=False, default=4096, dest="parameter_size", help="The number of elements of each parameter")
+        parser.add_argument("--steps", type=int, required=False, default=50, dest="steps", help="The number of EMA updates")
+
+        # @formatter:on
+
+        args = BenchmarkEMAArgs.default_values()
+        args.from_dict(vars(parser.parse_args()))
+        return args
+
+    @staticmethod
+    def default_values() -> 'BenchmarkEMAArgs':
+        data = []
+
+        # name, default value, data type, nullable
+        data.append(("device", "cpu", str, False))
+        data.append(("ema_device", None, str, True))
+        data.append(("pinned_staging", False, bool, False))
+        data.append(("precision", EMAPrecision.FULL, EMAPrecision, False))
+        data.append(("parameter_count", 2000, int, False))
+        data.append(("parameter_size", 4096, int, False))
+        data.append(("steps", 50, int, False))
+
+        return BenchmarkEMAArgs(data)
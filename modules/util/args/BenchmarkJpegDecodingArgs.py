@@ -0,0 +1,40 @@
+import argparse
+from typing import Any
+
+from modules.util.args.BaseArgs import BaseArgs
+
+
+class BenchmarkJpegDecodingArgs(BaseArgs):
+    image_dir: str
+    resolution: int
+    repeats: int
+
+    def __init__(self, data: list[(str, Any, type, bool)]):
+        super(BenchmarkJpegDecodingArgs, self).__init__(data)
+
+    @staticmethod
+    def parse_args() -> 'BenchmarkJpegDecodingArgs':
+        parser = argparse.ArgumentParser(description="One Trainer Jpeg Decoding Benchmark Script.")
+
+        # @formatter:off
+
+        parser.add_argument("--image-dir", type=str, required=True, dest="image_dir", help="A directory of jpeg images")
+        parser.add_argument("--resolution", type=int, required=False, default=512, dest="resolution", help="The resolution of the shorter side of each image after resizing")
+        parser.add_argument("--repeats", type=int, required=False, default=3, dest="repeats", help="The number of times each image is decoded, the fastest decode is used")
+
+        # @formatter:on
+
+        args = BenchmarkJpegDecodingArgs.default_values()
+        args.from_dict(vars(parser.parse_args()))
+        return args
+
+    @staticmethod
+    def default_values() -> 'BenchmarkJpegDecodingArgs':
+        data = []
+
+        # name, default value, data type, nullable
+        data.append(("image_dir", "", str, False))
+        data.append(("resolution", 512, int, False))
+        data.append(("repeats", 3, int, False))
+
+        return BenchmarkJpegDecodingArgs(data)
@@ -0,0 +1,40 @@
+import argparse
+from typing import Any
+
+from modules.util.args.BaseArgs import BaseArgs
+
+
+class BenchmarkLatentCacheArgs(BaseArgs):
+    cache_dir: str
+    items: int
+    resolution: int
+
+    def __init__(self, data: list[(str, Any, type, bool)]):
+        super(BenchmarkLatentCacheArgs, self).__init__(data)
+
+    @staticmethod
+    def parse_args() -> 'BenchmarkLatentCacheArgs':
+        parser = argparse.ArgumentParser(description="One Trainer Latent Cache Benchmark Script.")
+
+        # @formatter:off
+
+        parser.add_argument("--cache-dir", type=str, required=True, dest="cache_dir", help="An empty directory where the benchmark caches are written")
+        parser.add_argument("--items", type=int, required=False, default=2000, dest="items", help="The number of cached items")
+        parser.add_argument("--resolution", type=int, required=False, default=64, dest="resolution", help="The latent resolution of each item")
+
+        # @formatter:on
+
+        args = BenchmarkLatentCacheArgs.default_values()
+        args.from_dict(vars(parser.parse_args()))
+        return args
+
+    @staticmethod
+    def default_values() -> 'BenchmarkLatentCacheArgs':
+        data = []
+
+        # name, default value, data type, nullable
+        data.append(("cache_dir", "", str, False))
+        data.append(("items", 2000, int, False))
+        data.append(("resolution", 64, int, False))
+
+        return BenchmarkLatentCacheArgs(data)
@@ -0,0 +1,43 @@
+import argparse
+from typing import Any
+
+from modules.util.args.BaseArgs import BaseArgs
+
+
+class BenchmarkMetricsSyncArgs(BaseArgs):
+    device: str
+    steps: int
+    gradient_accumulation_steps: int
+    flush_interval_steps: int
+
+    def __init__(self, data: list[(str, Any, type, bool)]):
+        super(BenchmarkMetricsSyncArgs, self).__init__(data)
+
+    @staticmethod
+    def parse_args() -> 'BenchmarkMetricsSyncArgs':
+        parser = argparse.ArgumentParser(description="One Trainer Metrics Synchronization Benchmark Script.")
+
+        # @formatter:off
+
+        parser.add_argument("--device", type=str, required=False, default="cpu", dest="device", help="The device of the benchmark model")
+        parser.add_argument("--steps", type=int, required=False, default=100, dest="steps", help="The number of update steps")
+        parser.add_argument("--gradient-accumulation-steps", type=int, required=False, default=4, dest="gradient_accumulation_steps", help="The number of micro-batches of each update step")
+        parser.add_argument("--flush-interval-steps", type=int, required=False, default=10, dest="flush_interval_steps", help="The number of update steps between two metrics flushes")
+
+        # @formatter:on
+
+        args = BenchmarkMetricsSyncArgs.default_values()
+        args.from_dict(vars(parser.parse_args()))
+        return args
+
+    @staticmethod
+    def default_values() -> 'BenchmarkMetricsSyncArgs':
+        data = []
+
+        # name, default value, data type, nullable
+        data.append(("device", "cpu", str, False))
+        data.append(("steps", 100, int, False))
+        data.append(("gradient_accumulation_steps", 4, int, False))
+        data.append(("flush_interval_steps", 10, int, False))
+
+        return BenchmarkMetricsSyncArgs(data)
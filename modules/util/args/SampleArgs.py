@@ -13,6 +13,7 @@ class SampleArgs(BaseArgs):
     weight_dtype: DataType
     base_model_name: str
     embedding_name: str
+    lora_name: str
     prompt: str
     negative_prompt: str
     destination: str
@@ -40,6 +41,7 @@ class SampleArgs(BaseArgs):
         parser.add_argument("--weight-dtype", type=DataType, required=False, default=DataType.FLOAT_32, dest="weight_dtype", help="The data type to use for weights during sampling", choices=list(DataType))
         parser.add_argument("--base-model-name", type=str, required=True, dest="base_model_name", help="The base model to sample from")
         parser.add_argument("--embedding-name", type=str, required=False, default="", dest="extra_model_name", help="An embedding to use during sampling")
+        parser.add_argument("--lora-name", type=str, required=False, default=None, dest="lora_name", help="A LoRA to use during sampling. It is merged into the model weights")
         parser.add_argument("--prompt", type=str, required=True, dest="prompt", help="The prompt for sampling")
         parser.add_argument("--negative-prompt", type=str, required=False, default="", dest="negative_prompt", help="The negative prompt for sampling")
         parser.add_argument("--destination", type=str, required=True, dest="destination", help="The destination to save the output")
@@ -60,6 +62,7 @@ class SampleArgs(BaseArgs):
         data.append(("weight_dtype", DataType.FLOAT_32, DataType))
         data.append(("base_model_name", "", str, False))
         data.append(("embedding_name", None, str, True))
+        data.append(("lora_name", None, str, True))
         data.append(("prompt", "", str, False))
         data.append(("negative_prompt", "", str, False))
         data.append(("destination", "", str, False))
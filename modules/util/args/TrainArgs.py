@@ -5,8 +5,11 @@ from modules.util.ModelWeightDtypes import ModelWeightDtypes
 from modules.util.args.BaseArgs import BaseArgs
 from modules.util.args.arg_type_util import nullable_bool
 from modules.util.enum.AttentionMechanism import AttentionMechanism
+from modules.util.enum.CompileMode import CompileMode
 from modules.util.enum.DataType import DataType
+from modules.util.enum.DistributedBackend import DistributedBackend
 from modules.util.enum.EMAMode import EMAMode
+from modules.util.enum.EMAPrecision import EMAPrecision
 from modules.util.enum.ImageFormat import ImageFormat
 from modules.util.enum.LearningRateScheduler import LearningRateScheduler
 from modules.util.enum.ModelFormat import ModelFormat
@@ -24,6 +27,10 @@ class TrainArgs(BaseArgs):
     workspace_dir: str
     cache_dir: str
     tensorboard: bool
+    step_profiling: bool
+    step_profiling_interval: int
+    metrics_flush_interval_steps: int
+    metrics_flush_interval_seconds: float
     continue_last_backup: bool
 
     # model settings
@@ -45,6 +52,27 @@ class TrainArgs(BaseArgs):
     aspect_ratio_bucketing: bool
     latent_caching: bool
     latent_caching_epochs: int
+    sharded_latent_cache: bool
+    vae_batch_size: int
+    dataloader_threads: int
+    dataloader_prefetch_batches: int
+    device_prefetch_batches: int
+    dataset_index: bool
+    aspect_bucket_planning: bool
+    aspect_bucket_count: int
+    pre_resize_images: bool
+    draft_jpeg_decoding: bool
+    probe_image_resolution: bool
+    ram_cache_budget_gb: float
+    ram_cache_dtype: DataType
+    latent_cache_mean_only: bool
+    latent_cache_dtype: DataType
+    latent_cache_compression: bool
+    background_caching: bool
+    background_caching_device: str
+    background_caching_batch_size: int
+    background_caching_duty_cycle: float
+    cache_text_encoder_outputs: bool
     clear_cache_before_training: bool
 
     # training settings
@@ -58,6 +86,8 @@ class TrainArgs(BaseArgs):
     ema: EMAMode
     ema_decay: float
     ema_update_step_interval: int
+    ema_pinned_staging: bool
+    ema_precision: EMAPrecision
     train_text_encoder: bool
     train_text_encoder_epochs: int
     text_encoder_learning_rate: float
@@ -72,6 +102,10 @@ class TrainArgs(BaseArgs):
     force_epsilon_prediction: bool
     train_device: str
     temp_device: str
+    distributed: bool
+    distributed_backend: DistributedBackend
+    distributed_world_size: int
+    optimizer_sharding: bool
     train_dtype: DataType
     only_cache: bool
     resolution: int
@@ -86,7 +120,13 @@ class TrainArgs(BaseArgs):
     lora_rank: int
     lora_alpha: float
     lora_weight_dtype: DataType
+    lora_flat_parameters: bool
+    lora_merge_for_sampling: bool
     attention_mechanism: AttentionMechanism
+    compile_mode: CompileMode
+    compile_dynamic: bool
+    compile_text_encoder: bool
+    channels_last: bool
 
     # optimizer settings
     optimizer: Optimizer
@@ -144,6 +184,8 @@ class TrainArgs(BaseArgs):
     backup_after_unit: TimeUnit
     rolling_backup: bool
     rolling_backup_count: int
+    async_backup: bool
+    async_backup_max_in_flight: int
     backup_before_save: bool
     save_after: float
     save_after_unit: TimeUnit
@@ -190,6 +232,10 @@ class TrainArgs(BaseArgs):
         parser.add_argument("--workspace-dir", type=str, required=True, dest="workspace_dir", help="directory to use as a workspace")
         parser.add_argument("--cache-dir", type=str, required=True, dest="cache_dir", help="The directory used for caching")
         parser.add_argument("--tensorboard", required=False, action='store_true', dest="tensorboard", help="Start a tensorboard interface during training. The web server will run on port 6006")
+        parser.add_argument("--step-profiling", required=False, action='store_true', dest="step_profiling", help="Measure the time spent in each phase of a training step and log it to tensorboard")
+        parser.add_argument("--step-profiling-interval", type=int, required=False, default=100, dest="step_profiling_interval", help="The number of steps between step profiler reports")
+        parser.add_argument("--metrics-flush-interval-steps", type=int, required=False, default=10, dest="metrics_flush_interval_steps", help="The maximum number of update steps between reading the loss from the train device")
+        parser.add_argument("--metrics-flush-interval-seconds", type=float, required=False, default=5.0, dest="metrics_flush_interval_seconds", help="The maximum number of seconds between reading the loss from the train device")
         parser.add_argument("--continue-last-backup", required=False, action='store_true', dest="continue_last_backup", help="Continues training from the last backup in <workspace>/run/backup")
 
         # model settings
@@ -211,6 +257,27 @@ class TrainArgs(BaseArgs):
         parser.add_argument("--aspect-ratio-bucketing", required=False, action='store_true', dest="aspect_ratio_bucketing", help="Enable aspect ratio bucketing")
         parser.add_argument("--latent-caching", required=False, action='store_true', dest="latent_caching", help="Enable latent caching")
         parser.add_argument("--latent-caching-epochs", type=int, required=False, default=1, dest="latent_caching_epochs", help="The amount of epochs to cache, to increase sample diversity")
+        parser.add_argument("--sharded-latent-cache", required=False, action='store_true', dest="sharded_latent_cache", help="Pack the latent cache of each epoch into a few memory mapped shard files instead of one file per sample. Only samples that changed are encoded again, unless the cache is cleared before training")
+        parser.add_argument("--vae-batch-size", type=int, required=False, default=1, dest="vae_batch_size", help="The maximum number of images of the same resolution that are encoded together by the VAE. It is reduced automatically if the VAE runs out of memory. With values above 1, the latents can differ slightly from encoding each image on its own")
+        parser.add_argument("--dataloader-threads", type=int, required=False, default=0, dest="dataloader_threads", help="The number of worker threads that decode images ahead of the VAE. Augmentations still run on one thread at a time. 0 loads images on the main thread")
+        parser.add_argument("--dataloader-prefetch-batches", type=int, required=False, default=2, dest="dataloader_prefetch_batches", help="The number of batches the dataloader threads load ahead")
+        parser.add_argument("--device-prefetch-batches", type=int, required=False, default=0, dest="device_prefetch_batches", help="The number of batches that are prepared on a background thread and transferred to the train device ahead of time. 0 disables prefetching")
+        parser.add_argument("--dataset-index", required=False, action='store_true', dest="dataset_index", help="Keep a persistent index of each concept directory in the cache directory, and only list directories that changed")
+        parser.add_argument("--aspect-bucket-planning", required=False, action='store_true', dest="aspect_bucket_planning", help="Derive the aspect ratio buckets from the aspect ratios of the dataset, instead of using a fixed set")
+        parser.add_argument("--aspect-bucket-count", type=int, required=False, default=16, dest="aspect_bucket_count", help="The maximum number of planned aspect ratio buckets")
+        parser.add_argument("--pre-resize-images", required=False, action='store_true', dest="pre_resize_images", help="Store a downsized copy of each image in the cache directory, and load it instead of the original")
+        parser.add_argument("--draft-jpeg-decoding", required=False, action='store_true', dest="draft_jpeg_decoding", help="Decode jpeg images at a reduced scale if they are much bigger than their bucket resolution")
+        parser.add_argument("--probe-image-resolution", required=False, action='store_true', dest="probe_image_resolution", help="Read the resolution of each image from its file header for aspect ratio bucketing, instead of decoding the image.")
+        parser.add_argument("--ram-cache-budget-gb", type=float, required=False, default=0, dest="ram_cache_budget_gb", help="The RAM budget in GB of the in-memory cache that is used without latent caching. Items above the budget are spilled to the cache directory. 0 disables the budget")
+        parser.add_argument("--ram-cache-dtype", type=DataType, required=False, default=DataType.NONE, dest="ram_cache_dtype", help="The data type of latent distributions in the in-memory cache", choices=list(DataType))
+        parser.add_argument("--latent-cache-mean-only", required=False, action='store_true', dest="latent_cache_mean_only", help="Only store the mean of latent distributions in the sharded latent cache, which is the only value used during training")
+        parser.add_argument("--latent-cache-dtype", type=DataType, required=False, default=DataType.NONE, dest="latent_cache_dtype", help="The data type of latent distributions in the sharded latent cache", choices=list(DataType))
+        parser.add_argument("--latent-cache-compression", required=False, action='store_true', dest="latent_cache_compression", help="Compress latent distributions in the sharded latent cache with zstd. Needs the zstandard package")
+        parser.add_argument("--background-caching", required=False, action='store_true', dest="background_caching", help="Fill the sharded latent cache of the next epoch on a background thread while the current epoch is trained. Only used with more than one latent caching epoch")
+        parser.add_argument("--background-caching-device", type=str, required=False, default="", dest="background_caching_device", help="The device used for background caching. Defaults to the train device")
+        parser.add_argument("--background-caching-batch-size", type=int, required=False, default=1, dest="background_caching_batch_size", help="The VAE batch size used for background caching, which limits its memory usage")
+        parser.add_argument("--background-caching-duty-cycle", type=float, required=False, default=0.5, dest="background_caching_duty_cycle", help="The fraction of time background caching is allowed to work, which limits its compute usage")
+        parser.add_argument("--cache-text-encoder-outputs", required=False, action='store_true', dest="cache_text_encoder_outputs", help="Cache the text encoder outputs while the text encoder is not trained")
         parser.add_argument("--clear-cache-before-training", required=False, action='store_true', dest="clear_cache_before_training", help="Clears the latent cache before starting to train")
 
         # training settings
@@ -225,6 +292,8 @@ class TrainArgs(BaseArgs):
         parser.add_argument("--ema", type=EMAMode, required=False, default=EMAMode.OFF, dest="ema", help="Activate EMA during training", choices=list(EMAMode))
         parser.add_argument("--ema-decay", type=float, required=False, default=0.999, dest="ema_decay", help="Decay parameter of the EMA model")
         parser.add_argument("--ema-update-step-interval", type=int, required=False, default=5, dest="ema_update_step_interval", help="")
+        parser.add_argument("--ema-pinned-staging", required=False, action='store_true', dest="ema_pinned_staging", help="Copy the parameters of a CPU EMA through pinned staging buffers, overlapping the copy with the EMA update")
+        parser.add_argument("--ema-precision", type=EMAPrecision, required=False, default=EMAPrecision.FULL, dest="ema_precision", help="The storage precision of the EMA. The bfloat16 modes keep the EMA accurate with stochastic rounding or a residual of the rounding error", choices=list(EMAPrecision))
         parser.add_argument("--train-text-encoder", required=False, action='store_true', dest="train_text_encoder", help="Whether the text encoder should be trained")
         parser.add_argument("--train-text-encoder-epochs", type=int, required=False, default=2 ** 30, dest="train_text_encoder_epochs", help="Number of epochs to train the text encoder for")
         parser.add_argument("--text-encoder-learning-rate", type=float, required=False, default=None, dest="text_encoder_learning_rate", help="Learning rate for the text encoder")
@@ -239,6 +308,10 @@ class TrainArgs(BaseArgs):
         parser.add_argument("--force-epsilon-prediction", required=False, action='store_true', dest="force_epsilon_prediction", help="Forces the training to use epsilon-prediction")
         parser.add_argument("--train-device", type=str, required=False, default="cuda", dest="train_device", help="The device to train on")
         parser.add_argument("--temp-device", type=str, required=False, default="cpu", dest="temp_device", help="The device to use for temporary data")
+        parser.add_argument("--distributed", required=False, action='store_true', dest="distributed", help="Enable multi-process data-parallel training. Can be started through torchrun, or spawns --distributed-world-size local processes")
+        parser.add_argument("--distributed-backend", type=DistributedBackend, required=False, default=DistributedBackend.NCCL, dest="distributed_backend", help="The torch.distributed backend used for data-parallel training", choices=list(DistributedBackend))
+        parser.add_argument("--distributed-world-size", type=int, required=False, default=1, dest="distributed_world_size", help="The number of local processes to start for data-parallel training, if not started through torchrun")
+        parser.add_argument("--optimizer-sharding", required=False, action='store_true', dest="optimizer_sharding", help="Partition the optimizer state across all ranks during data-parallel training")
         parser.add_argument("--train-dtype", type=DataType, required=False, default=DataType.FLOAT_16, dest="train_dtype", help="The data type to use for training weights", choices=list(DataType))
         parser.add_argument("--only-cache", required=False, action='store_true', dest="only_cache", help="Only do the caching process without any training")
         parser.add_argument("--resolution", type=int, required=True, dest="resolution", help="Resolution to train at")
@@ -253,7 +326,13 @@ class TrainArgs(BaseArgs):
         parser.add_argument("--lora-rank", type=int, required=False, default=1, dest="lora_rank", help="The rank parameter used when initializing new LoRA networks")
         parser.add_argument("--lora-alpha", type=float, required=False, default=1.0, dest="lora_alpha", help="The alpha parameter used when initializing new LoRA networks")
         parser.add_argument("--lora-weight-dtype", type=DataType, required=False, default=DataType.FLOAT_32, dest="lora_weight_dtype", help="The data type to use for training the LoRA", choices=list(DataType))
+        parser.add_argument("--lora-flat-parameters", required=False, action='store_true', dest="lora_flat_parameters", help="Store all LoRA weights and gradients in a few flat buffers, so the optimizer, gradient clipping and EMA update them in a few kernels. Backups can only be continued with the same setting")
+        parser.add_argument("--lora-merge-for-sampling", required=False, action='store_true', dest="lora_merge_for_sampling", help="Merge the LoRA into the model weights while sampling during training. The original weights are restored afterwards. Not supported with --compile-mode")
         parser.add_argument("--attention-mechanism", type=AttentionMechanism, required=False, default=AttentionMechanism.XFORMERS, dest="attention_mechanism", help="The Attention mechanism to use", choices=list(AttentionMechanism))
+        parser.add_argument("--compile-mode", type=CompileMode, required=False, default=CompileMode.NONE, dest="compile_mode", help="Compile the transformer and resnet blocks with torch.compile", choices=list(CompileMode))
+        parser.add_argument("--compile-dynamic", required=False, action='store_true', dest="compile_dynamic", help="Compile with dynamic shapes, to avoid recompiling for every aspect ratio bucket")
+        parser.add_argument("--compile-text-encoder", required=False, action='store_true', dest="compile_text_encoder", help="Also compile the text encoder blocks")
+        parser.add_argument("--channels-last", required=False, action='store_true', dest="channels_last", help="Use the channels last memory format for the unet")
 
         # optimizer settings
         parser.add_argument("--optimizer-adam-w-mode", type=nullable_bool, default=None, dest="optimizer_adam_w_mode", help='Whether to use weight decay correction for Adam optimizer.')
@@ -310,6 +389,8 @@ class TrainArgs(BaseArgs):
         parser.add_argument("--backup-after-unit", type=TimeUnit, required=True, dest="backup_after_unit", help="The unit applied to the backup-after option")
         parser.add_argument("--rolling-backup", required=False, action='store_true', dest="rolling_backup", help="Enable rolling backups")
         parser.add_argument("--rolling-backup-count", type=int, required=False, default=3, dest="rolling_backup_count", help="The number of backups to keep if rolling backups are enabled")
+        parser.add_argument("--async-backup", required=False, action='store_true', dest="async_backup", help="Write backups and saves in the background while training continues")
+        parser.add_argument("--async-backup-max-in-flight", type=int, required=False, default=1, dest="async_backup_max_in_flight", help="The maximum number of backups or saves that are written in the background at the same time")
         parser.add_argument("--backup-before-save", required=False, action='store_true', dest="backup_before_save", help="Create a backup before saving the final model")
         parser.add_argument("--save-after", type=float, required=False, default=0, dest="save_after", help="The interval for backups")
         parser.add_argument("--save-after-unit", type=TimeUnit, required=False, default=TimeUnit.NEVER, dest="save_after_unit", help="The unit applied to the backup-after option")
@@ -334,6 +415,10 @@ class TrainArgs(BaseArgs):
         data.append(("workspace_dir", "workspace/run", str, False))
         data.append(("cache_dir", "workspace-cache/run", str, False))
         data.append(("tensorboard", True, bool, False))
+        data.append(("step_profiling", False, bool, False))
+        data.append(("step_profiling_interval", 100, int, False))
+        data.append(("metrics_flush_interval_steps", 10, int, False))
+        data.append(("metrics_flush_interval_seconds", 5.0, float, False))
         data.append(("continue_last_backup", False, bool, False))
 
         # model settings
@@ -355,6 +440,27 @@ class TrainArgs(BaseArgs):
         data.append(("aspect_ratio_bucketing", True, bool, False))
         data.append(("latent_caching", True, bool, False))
         data.append(("latent_caching_epochs", 1, int, False))
+        data.append(("sharded_latent_cache", False, bool, False))
+        data.append(("vae_batch_size", 1, int, False))
+        data.append(("dataloader_threads", 0, int, False))
+        data.append(("dataloader_prefetch_batches", 2, int, False))
+        data.append(("device_prefetch_batches", 0, int, False))
+        data.append(("dataset_index", False, bool, False))
+        data.append(("aspect_bucket_planning", False, bool, False))
+        data.append(("aspect_bucket_count", 16, int, False))
+        data.append(("pre_resize_images", False, bool, False))
+        data.append(("draft_jpeg_decoding", False, bool, False))
+        data.append(("probe_image_resolution", False, bool, False))
+        data.append(("ram_cache_budget_gb", 0.0, float, False))
+        data.append(("ram_cache_dtype", DataType.NONE, DataType, False))
+        data.append(("latent_cache_mean_only", False, bool, False))
+        data.append(("latent_cache_dtype", DataType.NONE, DataType, False))
+        data.append(("latent_cache_compression", False, bool, False))
+        data.append(("background_caching", False, bool, False))
+        data.append(("background_caching_device", "", str, False))
+        data.append(("background_caching_batch_size", 1, int, False))
+        data.append(("background_caching_duty_cycle", 0.5, float, False))
+        data.append(("cache_text_encoder_outputs", False, bool, False))
         data.append(("clear_cache_before_training", True, bool, False))
 
         # training settings
@@ -368,6 +474,8 @@ class TrainArgs(BaseArgs):
         data.append(("ema", EMAMode.OFF, EMAMode, False))
         data.append(("ema_decay", 0.999, float, False))
         data.append(("ema_update_step_interval", 5, int, False))
+        data.append(("ema_pinned_staging", False, bool, False))
+        data.append(("ema_precision", EMAPrecision.FULL, EMAPrecision, False))
         data.append(("train_text_encoder", True, bool, False))
         data.append(("train_text_encoder_epochs", 30, int, False))
         data.append(("text_encoder_learning_rate", 3e-6, float, True))
@@ -382,6 +490,10 @@ class TrainArgs(BaseArgs):
         data.append(("force_epsilon_prediction", False, bool, False))
         data.append(("train_device", "cuda", str, False))
         data.append(("temp_device", "cpu", str, False))
+        data.append(("distributed", False, bool, False))
+        data.append(("distributed_backend", DistributedBackend.NCCL, DistributedBackend, False))
+        data.append(("distributed_world_size", 1, int, False))
+        data.append(("optimizer_sharding", False, bool, False))
         data.append(("train_dtype", DataType.FLOAT_16, DataType, False))
         data.append(("only_cache", False, bool, False))
         data.append(("resolution", 512, int, False))
@@ -396,7 +508,13 @@ class TrainArgs(BaseArgs):
         data.append(("lora_rank", 16, int, False))
         data.append(("lora_alpha", 1.0, float, False))
         data.append(("lora_weight_dtype", DataType.FLOAT_32, DataType, False))
+        data.append(("lora_flat_parameters", False, bool, False))
+        data.append(("lora_merge_for_sampling", False, bool, False))
         data.append(("attention_mechanism", AttentionMechanism.XFORMERS, AttentionMechanism, False))
+        data.append(("compile_mode", CompileMode.NONE, CompileMode, False))
+        data.append(("compile_dynamic", False, bool, False))
+        data.append(("compile_text_encoder", False, bool, False))
+        data.append(("channels_last", False, bool, False))
 
         # optimizer settings
         data.append(("optimizer", Optimizer.ADAMW, Optimizer, False))
@@ -454,6 +572,8 @@ class TrainArgs(BaseArgs):
         data.append(("backup_after_unit", TimeUnit.MINUTE, TimeUnit, False))
         data.append(("rolling_backup", False, bool, False))
         data.append(("rolling_backup_count", 3, int, False))
+        data.append(("async_backup", False, bool, False))
+        data.append(("async_backup_max_in_flight", 1, int, False))
         data.append(("backup_before_save", True, bool, False))
         data.append(("save_after", 0, int, False))
         data.append(("save_after_unit", TimeUnit.NEVER, TimeUnit, False))
@@ -0,0 +1,40 @@
+import argparse
+from typing import Any
+
+from modules.util.args.BaseArgs import BaseArgs
+
+
+class ValidateEMAPrecisionArgs(BaseArgs):
+    steps: int
+    decay: float
+    seed: int
+
+    def __init__(self, data: list[(str, Any, type, bool)]):
+        super(ValidateEMAPrecisionArgs, self).__init__(data)
+
+    @staticmethod
+    def parse_args() -> 'ValidateEMAPrecisionArgs':
+        parser = argparse.ArgumentParser(description="One Trainer EMA Precision Validation Script.")
+
+        # @formatter:off
+
+        parser.add_argument("--steps", type=int, required=False, default=10000, dest="steps", help="The number of EMA updates")
+        parser.add_argument("--decay", type=float, required=False, default=0.9999, dest="decay", help="The decay of the EMA")
+        parser.add_argument("--seed", type=int, required=False, default=42, dest="seed", help="The seed of the simulated parameter updates")
+
+        # @formatter:on
+
+        args = ValidateEMAPrecisionArgs.default_values()
+        args.from_dict(vars(parser.parse_args()))
+        return args
+
+    @staticmethod
+    def default_values() -> 'ValidateEMAPrecisionArgs':
+        data = []
+
+        # name, default value, data type, nullable
+        data.append(("steps", 10000, int, False))
+        data.append(("decay", 0.9999, float, False))
+        data.append(("seed", 42, int, False))
+
+        return ValidateEMAPrecisionArgs(data)
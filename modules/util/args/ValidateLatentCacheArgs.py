@@ -0,0 +1,37 @@
+import argparse
+from typing import Any
+
+from modules.util.args.BaseArgs import BaseArgs
+
+
+class ValidateLatentCacheArgs(BaseArgs):
+    reference_cache_dir: str
+    cache_dir: str
+
+    def __init__(self, data: list[(str, Any, type, bool)]):
+        super(ValidateLatentCacheArgs, self).__init__(data)
+
+    @staticmethod
+    def parse_args() -> 'ValidateLatentCacheArgs':
+        parser = argparse.ArgumentParser(description="One Trainer Latent Cache Validation Script.")
+
+        # @formatter:off
+
+        parser.add_argument("--reference-cache-dir", type=str, required=True, dest="reference_cache_dir", help="The cache directory of a sharded latent cache in the default storage format")
+        parser.add_argument("--cache-dir", type=str, required=True, dest="cache_dir", help="The cache directory of a sharded latent cache in a compact storage format")
+
+        # @formatter:on
+
+        args = ValidateLatentCacheArgs.default_values()
+        args.from_dict(vars(parser.parse_args()))
+        return args
+
+
+    @staticmethod
+    def default_values():
+        data = []
+
+        data.append(("reference_cache_dir", "", str, False))
+        data.append(("cache_dir", "", str, False))
+
+        return ValidateLatentCacheArgs(data)
@@ -0,0 +1,70 @@
+import argparse
+from typing import Any
+
+from modules.util.ModelWeightDtypes import ModelWeightDtypes
+from modules.util.args.BaseArgs import BaseArgs
+from modules.util.enum.DataType import DataType
+from modules.util.enum.ModelType import ModelType
+
+
+class ValidateLoRAMergeArgs(BaseArgs):
+    model_type: ModelType
+    weight_dtype: DataType
+    base_model_name: str
+    lora_name: str
+    prompt: str
+    negative_prompt: str
+    seed: int
+    destination: str
+    text_encoder_layer_skip: int
+
+    def __init__(self, data: list[(str, Any, type, bool)]):
+        super(ValidateLoRAMergeArgs, self).__init__(data)
+
+    def weight_dtypes(self) -> ModelWeightDtypes:
+        return ModelWeightDtypes(
+            self.weight_dtype,
+            self.weight_dtype,
+            self.weight_dtype,
+            self.weight_dtype,
+            self.weight_dtype,
+        )
+
+    @staticmethod
+    def parse_args() -> 'ValidateLoRAMergeArgs':
+        parser = argparse.ArgumentParser(description="One Trainer LoRA Merge Validation Script.")
+
+        # @formatter:off
+
+        parser.add_argument("--model-type", type=ModelType, required=True, dest="model_type", help="Type of the base model", choices=list(ModelType))
+        parser.add_argument("--weight-dtype", type=DataType, required=False, default=DataType.FLOAT_32, dest="weight_dtype", help="The data type to use for weights during sampling", choices=list(DataType))
+        parser.add_argument("--base-model-name", type=str, required=True, dest="base_model_name", help="The base model to sample from")
+        parser.add_argument("--lora-name", type=str, required=True, dest="lora_name", help="The LoRA that is sampled with hooks and merged into the model weights")
+        parser.add_argument("--prompt", type=str, required=True, dest="prompt", help="The prompt for sampling")
+        parser.add_argument("--negative-prompt", type=str, required=False, default="", dest="negative_prompt", help="The negative prompt for sampling")
+        parser.add_argument("--seed", type=int, required=False, default=42, dest="seed", help="The seed used for every sample")
+        parser.add_argument("--destination", type=str, required=True, dest="destination", help="The directory to save the samples")
+        parser.add_argument("--text-encoder-layer-skip", type=int, required=False, default=0, dest="text_encoder_layer_skip", help="Skip last layers of the text encoder")
+
+        # @formatter:on
+
+        args = ValidateLoRAMergeArgs.default_values()
+        args.from_dict(vars(parser.parse_args()))
+        return args
+
+    @staticmethod
+    def default_values() -> 'ValidateLoRAMergeArgs':
+        data = []
+
+        # name, default value, data type, nullable
+        data.append(("model_type", ModelType.STABLE_DIFFUSION_15, ModelType, False))
+        data.append(("weight_dtype", DataType.FLOAT_32, DataType, False))
+        data.append(("base_model_name", "", str, False))
+        data.append(("lora_name", "", str, False))
+        data.append(("prompt", "", str, False))
+        data.append(("negative_prompt", "", str, False))
+        data.append(("seed", 42, int, False))
+        data.append(("destination", "", str, False))
+        data.append(("text_encoder_layer_skip", 0, int, False))
+
+        return ValidateLoRAMergeArgs(data)
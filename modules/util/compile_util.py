@@ -0,0 +1,87 @@
+import torch
+from diffusers.models.attention import BasicTransformerBlock
+from diffusers.models.attention_processor import Attention
+from diffusers.models.resnet import ResnetBlock2D
+from torch import nn
+from transformers.models.clip.modeling_clip import CLIPEncoderLayer
+from transformers.models.xlm_roberta.modeling_xlm_roberta import XLMRobertaLayer
+
+from modules.util.args.TrainArgs import TrainArgs
+from modules.util.enum.CompileMode import CompileMode
+
+# blocks that are compiled individually. Compiling single blocks instead of the whole model keeps gradient
+# checkpointing outside of the compiled graphs, so checkpointed forward functions don't cause graph breaks
+__COMPILED_BLOCK_TYPES = (
+    BasicTransformerBlock,
+    ResnetBlock2D,
+    Attention,
+    CLIPEncoderLayer,
+    XLMRobertaLayer,
+)
+
+# number of different input shapes each block can be compiled for, before falling back to eager execution
+__MAX_SHAPES_PER_BLOCK = 32
+
+
+def __find_blocks(module: nn.Module) -> list[nn.Module]:
+    # only the outermost blocks are compiled, nested blocks are part of their graph
+    if isinstance(module, __COMPILED_BLOCK_TYPES):
+        return [module]
+
+    blocks = []
+    for child_module in module.children():
+        blocks += __find_blocks(child_module)
+    return blocks
+
+
+def __raise_cache_size_limit(block_count: int, dynamic: bool):
+    # the compiled code of all blocks of the same type is cached together. Without dynamic shapes, each aspect ratio
+    # bucket needs its own entry for every block
+    shapes_per_block = 1 if dynamic else __MAX_SHAPES_PER_BLOCK
+    cache_size_limit = block_count * shapes_per_block * 2  # training and inference graphs
+
+    import torch._dynamo
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, cache_size_limit)
+    if hasattr(torch._dynamo.config, 'accumulated_cache_size_limit'):
+        torch._dynamo.config.accumulated_cache_size_limit = max(
+            torch._dynamo.config.accumulated_cache_size_limit, cache_size_limit
+        )
+
+
+def enable_compile_for_blocks(orig_module: nn.Module, args: TrainArgs):
+    """
+    Compiles the forward function of every transformer, resnet and attention block in orig_module with torch.compile.
+    The module itself is not replaced, so state dict keys and LoRA hooks stay unchanged. LoRA hooks need to be
+    installed before the first forward call, gradient checkpointing needs to be enabled after this call.
+    """
+    if args.compile_mode == CompileMode.NONE:
+        return
+
+    blocks = __find_blocks(orig_module)
+
+    try:
+        compiled_forwards = [
+            torch.compile(
+                block.forward,
+                mode=args.compile_mode.torch_mode(),
+                dynamic=args.compile_dynamic,
+            ) for block in blocks
+        ]
+    except Exception as e:
+        print(f"Could not compile the model, continuing without compilation: {e}")
+        return
+
+    block_counts = {}
+    for block, compiled_forward in zip(blocks, compiled_forwards):
+        block_counts[type(block)] = block_counts.get(type(block), 0) + 1
+        block.forward = compiled_forward
+
+    if block_counts:
+        __raise_cache_size_limit(max(block_counts.values()), args.compile_dynamic)
+
+
+def enable_channels_last(orig_module: nn.Module):
+    """
+    Converts the weights of all convolutions to the channels last memory format
+    """
+    orig_module.to(memory_format=torch.channels_last)
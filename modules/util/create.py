@@ -47,6 +47,8 @@ from modules.modelSetup.StableDiffusionXLEmbeddingSetup import StableDiffusionXL
 from modules.modelSetup.StableDiffusionXLFineTuneSetup import StableDiffusionXLFineTuneSetup
 from modules.modelSetup.StableDiffusionXLLoRASetup import StableDiffusionXLLoRASetup
 from modules.module.EMAModule import EMAModuleWrapper
+from modules.util import distributed_util
+from modules.util.ShardedOptimizer import ShardedOptimizer
 from modules.util.TrainProgress import TrainProgress
 from modules.util.args.TrainArgs import TrainArgs
 from modules.util.enum.EMAMode import EMAMode
@@ -215,6 +217,30 @@ def create_optimizer(
         parameters: Iterable[Parameter] | list[dict],
         state_dict: dict | None,
         args: TrainArgs,
+) -> torch.optim.Optimizer:
+    if args.optimizer_sharding and distributed_util.world_size() > 1:
+        parameters = [dict(group, params=list(group['params'])) for group in parameters]
+        optimizer = ShardedOptimizer(
+            parameters,
+            lambda local_parameters: __create_optimizer(local_parameters, args),
+        )
+    else:
+        optimizer = __create_optimizer(parameters, args)
+
+    if state_dict is not None:
+        for i, params in enumerate(parameters):
+            state_dict['param_groups'][i]['lr'] = params['lr']
+            state_dict['param_groups'][i]['initial_lr'] = params['initial_lr']
+
+        # TODO: this will break if the optimizer class changed during a restart
+        optimizer.load_state_dict(state_dict)
+
+    return optimizer
+
+
+def __create_optimizer(
+        parameters: Iterable[Parameter] | list[dict],
+        args: TrainArgs,
 ) -> torch.optim.Optimizer:
     optimizer = None
 
@@ -557,14 +583,6 @@ def create_optimizer(
                 warmup_init=args.optimizer_warmup_init if args.optimizer_warmup_init is not None else False,
             )
 
-    if state_dict is not None:
-        for i, params in enumerate(parameters):
-            state_dict['param_groups'][i]['lr'] = params['lr']
-            state_dict['param_groups'][i]['initial_lr'] = params['initial_lr']
-
-        # TODO: this will break if the optimizer class changed during a restart
-        optimizer.load_state_dict(state_dict)
-
     return optimizer
 
 
@@ -585,6 +603,8 @@ def create_ema(
         decay=args.ema_decay,
         update_step_interval=args.ema_update_step_interval,
         device=device,
+        pinned_staging=args.ema_pinned_staging,
+        precision=args.ema_precision,
     )
 
     if state_dict is not None:
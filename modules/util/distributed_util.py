@@ -0,0 +1,221 @@
+import os
+import socket
+from typing import Callable, Iterable, Iterator
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Sampler
+
+from modules.util.enum.DistributedBackend import DistributedBackend
+
+# number of gradient elements that are reduced in a single all_reduce call
+__REDUCE_BUCKET_SIZE = 25 * 1024 * 1024
+
+# gloo group used to exchange python objects without copying them to the train device
+__object_group = None
+
+
+def is_enabled() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank() -> int:
+    return dist.get_rank() if is_enabled() else 0
+
+
+def local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", rank())) if is_enabled() else 0
+
+
+def world_size() -> int:
+    return dist.get_world_size() if is_enabled() else 1
+
+
+def is_main_rank() -> bool:
+    return rank() == 0
+
+
+def barrier():
+    if is_enabled():
+        dist.barrier()
+
+
+def __find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _spawn_entry(local_rank: int, world_size: int, fun: Callable[..., None], *args):
+    os.environ["RANK"] = str(local_rank)
+    os.environ["LOCAL_RANK"] = str(local_rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
+    fun(*args)
+
+
+def launch(fun: Callable[..., None], world_size: int, *args):
+    """
+    Runs fun(*args) in world_size processes on the local machine. If the process was already started by a launcher
+    like torchrun, fun is called directly.
+    """
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        fun(*args)
+        return
+
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(__find_free_port()))
+    mp.spawn(_spawn_entry, args=(world_size, fun, *args), nprocs=world_size, join=True)
+
+
+def init_process_group(backend: DistributedBackend, train_device: str) -> str:
+    """
+    Initializes the default process group from the environment variables set by launch() or torchrun.
+
+    Returns:
+        the train device of this rank
+    """
+    if is_enabled():
+        return train_device
+
+    device = torch.device(train_device)
+    if backend == DistributedBackend.NCCL and device.type != 'cuda':
+        backend = DistributedBackend.GLOO
+
+    dist.init_process_group(backend=backend.torch_backend())
+
+    global __object_group
+    if backend != DistributedBackend.GLOO:
+        __object_group = dist.new_group(backend=DistributedBackend.GLOO.torch_backend())
+
+    if device.type == 'cuda':
+        device = torch.device('cuda', local_rank())
+        torch.cuda.set_device(device)
+
+    return str(device)
+
+
+def destroy_process_group():
+    global __object_group
+    if is_enabled():
+        dist.destroy_process_group()
+    __object_group = None
+
+
+def broadcast_object(obj, src: int = 0):
+    """
+    Sends a picklable object from the src rank to every other rank
+
+    Returns:
+        the object of the src rank
+    """
+    if not is_enabled() or world_size() == 1:
+        return obj
+
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src, group=__object_group)
+    return objects[0]
+
+
+def gather_object(obj, dst: int = 0) -> list | None:
+    """
+    Collects a picklable object from every rank on the dst rank
+
+    Returns:
+        a list with the object of each rank on the dst rank, None on every other rank
+    """
+    if not is_enabled() or world_size() == 1:
+        return [obj]
+
+    objects = [None] * world_size() if rank() == dst else None
+    dist.gather_object(obj, objects, dst=dst, group=__object_group)
+    return objects
+
+
+def __buckets(tensors: list[torch.Tensor]) -> Iterator[list[torch.Tensor]]:
+    groups = {}
+    for tensor in tensors:
+        groups.setdefault((tensor.device, tensor.dtype), []).append(tensor)
+
+    for group in groups.values():
+        bucket = []
+        bucket_size = 0
+        for tensor in group:
+            bucket.append(tensor)
+            bucket_size += tensor.numel()
+            if bucket_size >= __REDUCE_BUCKET_SIZE:
+                yield bucket
+                bucket = []
+                bucket_size = 0
+        if bucket:
+            yield bucket
+
+
+@torch.no_grad()
+def all_reduce_gradients(parameters: Iterable[torch.nn.Parameter]):
+    """
+    Averages the gradients of all parameters across all ranks. Gradients are flattened into buckets to reduce the
+    number of collective calls.
+    """
+    if not is_enabled() or world_size() == 1:
+        return
+
+    grads = [parameter.grad for parameter in parameters if parameter.grad is not None]
+    for bucket in __buckets(grads):
+        flat = torch._utils._flatten_dense_tensors(bucket)
+        dist.all_reduce(flat)
+        flat.div_(world_size())
+        for grad, reduced in zip(bucket, torch._utils._unflatten_dense_tensors(flat, bucket)):
+            grad.copy_(reduced)
+
+
+@torch.no_grad()
+def broadcast_tensors(tensors: Iterable[torch.Tensor], src: int = 0):
+    """
+    Copies the values of all tensors from the src rank to every other rank
+    """
+    if not is_enabled() or world_size() == 1:
+        return
+
+    for bucket in __buckets(list(tensors)):
+        flat = torch._utils._flatten_dense_tensors(bucket)
+        dist.broadcast(flat, src)
+        for tensor, broadcasted in zip(bucket, torch._utils._unflatten_dense_tensors(flat, bucket)):
+            tensor.copy_(broadcasted)
+
+
+class DistributedBatchSampler(Sampler[list[int]]):
+    """
+    Shards a dataset at the batch level. The dataset is split into consecutive batches, so aspect ratio sorting is
+    preserved. Every rank gets the same number of batches, incomplete batches and left over batches are dropped.
+    """
+
+    def __init__(self, dataset, batch_size: int, rank: int, world_size: int):
+        super(DistributedBatchSampler, self).__init__(dataset)
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+
+    def __len__(self) -> int:
+        return (len(self.dataset) // self.batch_size) // self.world_size
+
+    def __iter__(self) -> Iterator[list[int]]:
+        for i in range(len(self)):
+            batch_index = i * self.world_size + self.rank
+            start = batch_index * self.batch_size
+            yield list(range(start, start + self.batch_size))
+
+
+def shard_data_loader(data_loader: DataLoader, batch_size: int) -> DataLoader:
+    """
+    Creates a data loader that only returns the batches of the current rank
+    """
+    if not is_enabled() or world_size() == 1:
+        return data_loader
+
+    return DataLoader(
+        data_loader.dataset,
+        batch_sampler=DistributedBatchSampler(data_loader.dataset, batch_size, rank(), world_size()),
+        collate_fn=data_loader.collate_fn,
+    )
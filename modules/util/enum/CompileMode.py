@@ -0,0 +1,22 @@
+from enum import Enum
+
+
+class CompileMode(Enum):
+    NONE = 'NONE'
+    DEFAULT = 'DEFAULT'
+    REDUCE_OVERHEAD = 'REDUCE_OVERHEAD'
+    MAX_AUTOTUNE = 'MAX_AUTOTUNE'
+
+    def __str__(self):
+        return self.value
+
+    def torch_mode(self) -> str | None:
+        match self:
+            case CompileMode.DEFAULT:
+                return 'default'
+            case CompileMode.REDUCE_OVERHEAD:
+                return 'reduce-overhead'
+            case CompileMode.MAX_AUTOTUNE:
+                return 'max-autotune'
+            case _:
+                return None
@@ -0,0 +1,16 @@
+from enum import Enum
+
+
+class DistributedBackend(Enum):
+    NCCL = 'NCCL'
+    GLOO = 'GLOO'
+
+    def __str__(self):
+        return self.value
+
+    def torch_backend(self) -> str:
+        match self:
+            case DistributedBackend.NCCL:
+                return 'nccl'
+            case DistributedBackend.GLOO:
+                return 'gloo'
@@ -0,0 +1,10 @@
+from enum import Enum
+
+
+class EMAPrecision(Enum):
+    FULL = 'FULL'
+    BFLOAT_16_STOCHASTIC = 'BFLOAT_16_STOCHASTIC'
+    BFLOAT_16_RESIDUAL = 'BFLOAT_16_RESIDUAL'
+
+    def __str__(self):
+        return self.value
@@ -0,0 +1,25 @@
+from PIL import Image
+
+
+def probe_image_resolution(path: str) -> tuple[int, int]:
+    """
+    Returns the (height, width) of an image. Only the file header is read, the pixel data is not decoded. Like the
+    mgds LoadImage, the exif orientation is not applied, so the resolution matches the loaded image and its mask.
+    """
+    with Image.open(path) as image:
+        width, height = image.size
+    return height, width
+
+
+def load_image_draft(path: str, height: int, width: int, mode: str, draft: bool = True) -> Image.Image:
+    """
+    Loads an image in the given mode, without applying its exif orientation. If draft is set, jpeg images are decoded
+    at the smallest scale (1/2, 1/4 or 1/8) that is still at least (height, width), other images are decoded at full
+    size. The returned image is not resized any further.
+    """
+    image = Image.open(path)
+
+    if draft and image.format == 'JPEG':
+        image.draft(mode, (width, height))
+
+    return image.convert(mode)
@@ -0,0 +1,16 @@
+from modules.util.args.TrainArgs import TrainArgs
+from modules.util.enum.TrainingMethod import TrainingMethod
+
+
+def is_text_encoder_output_cached(args: TrainArgs, epoch: int) -> bool:
+    """
+    Returns True if the text encoder outputs are read from the cache during this epoch instead of being calculated
+    for every batch. This is only possible while the text encoder is not trained.
+    """
+    if not args.cache_text_encoder_outputs:
+        return False
+
+    if args.training_method not in [TrainingMethod.FINE_TUNE, TrainingMethod.LORA]:
+        return False
+
+    return not (args.train_text_encoder and epoch < args.train_text_encoder_epochs)
@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+
+import torch
+import torch.nn.functional as F
+from diffusers import UNet2DConditionModel
+
+from modules.module.LoRAModule import LoRAModuleWrapper
+from modules.modelSetup.stableDiffusion.checkpointing_util import enable_checkpointing_for_transformer_blocks
+from modules.util import compile_util
+from modules.util.args.BenchmarkCompileArgs import BenchmarkCompileArgs
+from modules.util.args.TrainArgs import TrainArgs
+from modules.util.enum.CompileMode import CompileMode
+
+
+def create_unet(args: BenchmarkCompileArgs, compile_mode: CompileMode, device: torch.device):
+    torch.manual_seed(42)
+    unet = UNet2DConditionModel(
+        sample_size=32,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+        norm_num_groups=16,
+    ).to(device)
+
+    if args.lora_rank > 0:
+        unet.requires_grad_(False)
+        lora = LoRAModuleWrapper(unet, args.lora_rank, "lora_unet", 1.0, ["attentions"])
+        lora.to(device)
+        lora.requires_grad_(True)
+        # LoRA hooks are installed before the blocks are compiled, like in the model setups
+        lora.hook_to_module()
+        parameters = list(lora.parameters())
+    else:
+        parameters = list(unet.parameters())
+
+    train_args = TrainArgs.default_values()
+    train_args.compile_mode = compile_mode
+    train_args.compile_dynamic = args.compile_dynamic
+
+    if args.channels_last:
+        compile_util.enable_channels_last(unet)
+    compile_util.enable_compile_for_blocks(unet, train_args)
+    if args.gradient_checkpointing:
+        unet.enable_gradient_checkpointing()
+        enable_checkpointing_for_transformer_blocks(unet)
+    unet.train()
+
+    return unet, torch.optim.AdamW(parameters, lr=1e-4)
+
+
+def train_step(unet, optimizer, args: BenchmarkCompileArgs, resolution: tuple[int, int], device: torch.device):
+    height, width = resolution
+    latents = torch.randn(args.batch_size, 4, height, width, device=device)
+    if args.channels_last:
+        latents = latents.to(memory_format=torch.channels_last)
+    timesteps = torch.randint(0, 1000, (args.batch_size,), device=device)
+    encoder_hidden_states = torch.randn(args.batch_size, 8, 32, device=device)
+
+    predicted = unet(latents, timesteps, encoder_hidden_states).sample
+    loss = F.mse_loss(predicted, latents)
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad(set_to_none=True)
+
+
+def synchronize(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run(args: BenchmarkCompileArgs, compile_mode: CompileMode, device: torch.device) -> tuple[float, float]:
+    unet, optimizer = create_unet(args, compile_mode, device)
+    resolutions = args.resolution_list()
+
+    # each resolution is compiled during its warmup steps
+    start_time = time.perf_counter()
+    for resolution in resolutions:
+        for _ in range(args.warmup_steps):
+            train_step(unet, optimizer, args, resolution, device)
+    synchronize(device)
+    warmup_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for step in range(args.steps):
+        train_step(unet, optimizer, args, resolutions[step % len(resolutions)], device)
+    synchronize(device)
+    step_time = (time.perf_counter() - start_time) / args.steps
+
+    return warmup_time, step_time
+
+
+def main():
+    args = BenchmarkCompileArgs.parse_args()
+    device = torch.device(args.device)
+
+    eager_warmup_time, eager_step_time = run(args, CompileMode.NONE, device)
+    print(f"eager: warmup {eager_warmup_time:.2f} s, {eager_step_time * 1000:.2f} ms per step")
+
+    compiled_warmup_time, compiled_step_time = run(args, args.compile_mode, device)
+    print(f"compiled ({args.compile_mode}): warmup {compiled_warmup_time:.2f} s, "
+          f"{compiled_step_time * 1000:.2f} ms per step, speedup {eager_step_time / compiled_step_time:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+
+import torch
+
+from modules.module.EMAModule import EMAModuleWrapper
+from modules.util.args.BenchmarkEMAArgs import BenchmarkEMAArgs
+
+
+@torch.no_grad()
+def loop_step(ema_parameters: list[torch.Tensor], parameters: list[torch.nn.Parameter], one_minus_decay: float):
+    # the EMA update before the multi-tensor engine: one update with temporaries for each parameter
+    for ema_parameter, parameter in zip(ema_parameters, parameters):
+        if parameter.requires_grad:
+            if ema_parameter.device == parameter.device:
+                ema_parameter.add_(one_minus_decay * (parameter - ema_parameter))
+            else:
+                parameter_copy = parameter.detach().to(ema_parameter.device)
+                parameter_copy.sub_(ema_parameter)
+                parameter_copy.mul_(one_minus_decay)
+                ema_parameter.add_(parameter_copy)
+                del parameter_copy
+
+
+def create_parameters(args: BenchmarkEMAArgs, device: torch.device) -> list[torch.nn.Parameter]:
+    torch.manual_seed(42)
+    return [
+        torch.nn.Parameter(torch.randn(args.parameter_size, device=device)) for _ in range(args.parameter_count)
+    ]
+
+
+def synchronize(*devices: torch.device):
+    for device in devices:
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device: torch.device):
+    if device.type == 'cuda':
+        synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory(device: torch.device) -> str:
+    if device.type == 'cuda':
+        return f", peak memory {torch.cuda.max_memory_allocated(device) / (1 << 20):.1f} MiB"
+    return ""
+
+
+def main():
+    args = BenchmarkEMAArgs.parse_args()
+    device = torch.device(args.device)
+    ema_device = torch.device(args.ema_device or args.device)
+
+    parameters = create_parameters(args, device)
+    ema_parameters = [parameter.detach().to(ema_device, copy=True) for parameter in parameters]
+
+    reset_peak_memory(device)
+    start_time = time.perf_counter()
+    for step in range(args.steps):
+        loop_step(ema_parameters, parameters, 1 - min((1 + step) / (10 + step), 0.999))
+    synchronize(device, ema_device)
+    loop_time = (time.perf_counter() - start_time) / args.steps
+    print(f"per-parameter loop: {loop_time * 1000:.3f} ms per update{peak_memory(device)}")
+    del ema_parameters
+
+    ema = EMAModuleWrapper(
+        parameters, decay=0.999, device=ema_device, pinned_staging=args.pinned_staging, precision=args.precision
+    )
+
+    reset_peak_memory(device)
+    start_time = time.perf_counter()
+    for step in range(args.steps):
+        ema.step(parameters, step)
+    synchronize(device, ema_device)
+    engine_time = (time.perf_counter() - start_time) / args.steps
+    print(f"multi-tensor engine ({args.precision}): {engine_time * 1000:.3f} ms per update, "
+          f"speedup {loop_time / engine_time:.2f}x{peak_memory(device)}")
+
+
+if __name__ == '__main__':
+    main()
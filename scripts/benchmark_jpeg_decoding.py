@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+
+import numpy as np
+from PIL import Image
+
+from modules.util.args.BenchmarkJpegDecodingArgs import BenchmarkJpegDecodingArgs
+from modules.util.image_util import load_image_draft, probe_image_resolution
+
+
+def load_full(path: str, height: int, width: int) -> Image.Image:
+    # decodes the image at full size, like the mgds LoadImage, before resizing it
+    image = Image.open(path).convert('RGB')
+    return image.resize((width, height), resample=Image.LANCZOS)
+
+
+def load_draft(path: str, height: int, width: int) -> Image.Image:
+    image = load_image_draft(path, height, width, 'RGB')
+    if image.width > width and image.height > height:
+        image = image.resize((width, height), resample=Image.LANCZOS)
+    return image
+
+
+def fastest_load(load, path: str, height: int, width: int, repeats: int) -> tuple[float, Image.Image]:
+    best_duration = None
+    image = None
+    for _ in range(max(1, repeats)):
+        start_time = time.perf_counter()
+        image = load(path, height, width)
+        duration = time.perf_counter() - start_time
+        best_duration = duration if best_duration is None else min(best_duration, duration)
+    return best_duration, image
+
+
+def main():
+    args = BenchmarkJpegDecodingArgs.parse_args()
+
+    paths = sorted(
+        os.path.join(args.image_dir, filename) for filename in os.listdir(args.image_dir)
+        if os.path.splitext(filename)[1].lower() in ['.jpg', '.jpeg']
+    )
+
+    full_durations = []
+    draft_durations = []
+    errors = []
+    for path in paths:
+        original_height, original_width = probe_image_resolution(path)
+        scale = args.resolution / min(original_height, original_width)
+        if scale >= 1:
+            # images that would be upscaled are decoded at full size in both cases
+            continue
+        height, width = round(original_height * scale), round(original_width * scale)
+
+        full_duration, full_image = fastest_load(load_full, path, height, width, args.repeats)
+        draft_duration, draft_image = fastest_load(load_draft, path, height, width, args.repeats)
+
+        full_durations.append(full_duration)
+        draft_durations.append(draft_duration)
+        errors.append(np.abs(
+            np.asarray(full_image, dtype=np.int16) - np.asarray(draft_image, dtype=np.int16)
+        ).mean())
+
+        print(f"{os.path.basename(path)}: {original_width}x{original_height} -> {width}x{height}, "
+              f"full {full_duration * 1000:.1f} ms, draft {draft_duration * 1000:.1f} ms")
+
+    if not full_durations:
+        print(f"no jpeg image in {args.image_dir} is bigger than the resolution {args.resolution}")
+        return
+
+    print(f"{len(full_durations)} images: full decode {np.mean(full_durations) * 1000:.1f} ms per image, "
+          f"draft decode {np.mean(draft_durations) * 1000:.1f} ms per image, "
+          f"speedup {np.sum(full_durations) / np.sum(draft_durations):.2f}x, "
+          f"mean pixel difference {np.mean(errors):.3f}")
+
+
+if __name__ == '__main__':
+    main()
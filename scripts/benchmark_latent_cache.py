@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+
+sys.path.append(os.getcwd())
+
+import torch
+from diffusers.models.vae import DiagonalGaussianDistribution
+
+from modules.dataLoader.cache.ShardedDiskCache import ShardedDiskCache
+from modules.util.args.BenchmarkLatentCacheArgs import BenchmarkLatentCacheArgs
+
+SPLIT_NAMES = ['latent_image_distribution']
+AGGREGATE_NAMES = ['crop_resolution', 'image_path']
+
+
+class SyntheticItems:
+    def __init__(self, args: BenchmarkLatentCacheArgs):
+        self.image_dir = os.path.join(args.cache_dir, "images")
+        self.items = args.items
+        self.resolution = args.resolution
+
+        # the sharded cache hashes the content of every source file, so each item needs a file
+        os.makedirs(self.image_dir, exist_ok=True)
+        for index in range(self.items):
+            with open(self.image_path(index), "wb") as f:
+                f.write(index.to_bytes(8, 'little'))
+
+    def image_path(self, index: int) -> str:
+        return os.path.join(self.image_dir, f"{index}.jpg")
+
+    def get_item(self, name: str, index: int):
+        if name == 'latent_image_distribution':
+            generator = torch.Generator().manual_seed(index)
+            parameters = torch.randn(1, 8, self.resolution, self.resolution, generator=generator)
+            return DiagonalGaussianDistribution(parameters)
+        if name == 'crop_resolution':
+            return self.resolution * 8, self.resolution * 8
+        if name == 'image_path':
+            return self.image_path(index)
+        if name == 'concept':
+            return {'path': self.image_dir}
+        return None
+
+
+class SyntheticShardedDiskCache(ShardedDiskCache):
+    """
+    A sharded disk cache that reads its input items from SyntheticItems instead of the previous pipeline modules
+    """
+
+    def __init__(self, items: SyntheticItems, **kwargs):
+        super(SyntheticShardedDiskCache, self).__init__(**kwargs)
+        self.synthetic_items = items
+
+    def get_previous_length(self, name: str) -> int:
+        return self.synthetic_items.items
+
+    def get_previous_item(self, name: str, index: int):
+        return self.synthetic_items.get_item(name, index)
+
+
+def evict_from_page_cache(directory: str):
+    # written pages need to reach the disk before the kernel can drop them
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            fd = os.open(os.path.join(dirpath, filename), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def directory_bytes(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(directory) for filename in filenames
+    )
+
+
+def per_file_path(directory: str, index: int, name: str) -> str:
+    return os.path.join(directory, f"{index}-{name}.pt")
+
+
+def write_per_file(directory: str, items: SyntheticItems):
+    # one file for each item and name, like the per-file disk cache
+    os.makedirs(directory, exist_ok=True)
+    for index in range(items.items):
+        for name in SPLIT_NAMES + AGGREGATE_NAMES:
+            value = items.get_item(name, index)
+            if isinstance(value, DiagonalGaussianDistribution):
+                value = value.parameters
+            torch.save(value, per_file_path(directory, index, name))
+
+
+def read_per_file(directory: str, items: SyntheticItems):
+    for index in range(items.items):
+        for name in SPLIT_NAMES + AGGREGATE_NAMES:
+            value = torch.load(per_file_path(directory, index, name))
+            if isinstance(value, torch.Tensor):
+                # the values are used, so every byte is read
+                DiagonalGaussianDistribution(value).mean.sum()
+
+
+def read_sharded(cache: ShardedDiskCache, items: SyntheticItems):
+    for index in range(items.items):
+        for value in cache.get_item(index).values():
+            if isinstance(value, DiagonalGaussianDistribution):
+                # tensors are views into the mapped shards, they are only read when they are used
+                value.mean.sum()
+
+
+def measure(name: str, read, directory: str, items: SyntheticItems):
+    total_bytes = directory_bytes(directory)
+    for pass_name in ['cold', 'warm']:
+        if pass_name == 'cold':
+            evict_from_page_cache(directory)
+        start_time = time.perf_counter()
+        read()
+        duration = time.perf_counter() - start_time
+        print(f"{name} ({pass_name}): {items.items / duration:.1f} items/s, "
+              f"{total_bytes / duration / (1 << 20):.1f} MiB/s, {total_bytes / (1 << 20):.1f} MiB in total")
+
+
+def main():
+    args = BenchmarkLatentCacheArgs.parse_args()
+    items = SyntheticItems(args)
+
+    per_file_dir = os.path.join(args.cache_dir, "per-file", "epoch-0")
+    write_per_file(per_file_dir, items)
+
+    sharded_cache_dir = os.path.join(args.cache_dir, "sharded")
+    cache = SyntheticShardedDiskCache(
+        items, cache_dir=sharded_cache_dir, split_names=SPLIT_NAMES, aggregate_names=AGGREGATE_NAMES,
+        device=torch.device('cpu'),
+    )
+    # writes the shards, no shard is mapped until the first item is read
+    cache.start(0)
+
+    measure("per-file", lambda: read_per_file(per_file_dir, items), per_file_dir, items)
+    measure("sharded", lambda: read_sharded(cache, items), os.path.join(sharded_cache_dir, "epoch-0-shards"), items)
+
+
+if __name__ == '__main__':
+    main()
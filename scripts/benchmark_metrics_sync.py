@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+sys.path.append(os.getcwd())
+
+import torch
+from torch import nn
+
+from modules.util.MetricsAccumulator import MetricsAccumulator
+from modules.util.args.BenchmarkMetricsSyncArgs import BenchmarkMetricsSyncArgs
+
+
+@contextmanager
+def count_syncs(device: torch.device, counter: list[int]):
+    """
+    Counts every read of a tensor value on the host. On an accelerator, each of these reads waits for the device. On
+    the cpu, the same reads are counted, so the benchmark shows the sync points of the training loop on any device.
+    """
+    item, tolist, cpu = torch.Tensor.item, torch.Tensor.tolist, torch.Tensor.cpu
+
+    def counting_item(tensor, *args, **kwargs):
+        if tensor.device.type == device.type:
+            counter[0] += 1
+        return item(tensor, *args, **kwargs)
+
+    def counting_tolist(tensor, *args, **kwargs):
+        if tensor.device.type == device.type:
+            counter[0] += 1
+        return tolist(tensor, *args, **kwargs)
+
+    def counting_cpu(tensor, *args, **kwargs):
+        if tensor.device.type == device.type != 'cpu':
+            counter[0] += 1
+        return cpu(tensor, *args, **kwargs)
+
+    torch.Tensor.item, torch.Tensor.tolist, torch.Tensor.cpu = counting_item, counting_tolist, counting_cpu
+    try:
+        yield
+    finally:
+        torch.Tensor.item, torch.Tensor.tolist, torch.Tensor.cpu = item, tolist, cpu
+
+
+def create_model(device: torch.device) -> nn.Module:
+    torch.manual_seed(42)
+    return nn.Sequential(
+        nn.Linear(64, 256),
+        nn.SiLU(),
+        nn.Linear(256, 256),
+        nn.SiLU(),
+        nn.Linear(256, 64),
+    ).to(device)
+
+
+def train_step(model: nn.Module, device: torch.device):
+    inputs = torch.randn(16, 64, device=device)
+    loss = nn.functional.mse_loss(model(inputs), inputs)
+    loss.backward()
+    return loss
+
+
+def run_item_loop(args: BenchmarkMetricsSyncArgs, device: torch.device) -> tuple[int, float]:
+    # the training loop before the metrics accumulator: one loss.item() for each micro-batch
+    model = create_model(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    counter = [0]
+
+    start_time = time.perf_counter()
+    with count_syncs(device, counter):
+        accumulated_loss = 0.0
+        ema_loss = None
+        for _ in range(args.steps):
+            for _ in range(args.gradient_accumulation_steps):
+                loss = train_step(model, device)
+                accumulated_loss += loss.item()
+
+            nn.utils.clip_grad_norm_(model.parameters(), 1)
+            optimizer.step()
+            optimizer.zero_grad()
+
+            ema_loss = ema_loss or accumulated_loss
+            ema_loss = (ema_loss * 0.99) + (accumulated_loss * 0.01)
+            accumulated_loss = 0.0
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+    return counter[0], time.perf_counter() - start_time
+
+
+def run_accumulator_loop(args: BenchmarkMetricsSyncArgs, device: torch.device) -> tuple[int, float]:
+    model = create_model(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    metrics = MetricsAccumulator(
+        flush_interval_steps=args.flush_interval_steps,
+        flush_interval_seconds=float('inf'),
+    )
+    counter = [0]
+
+    start_time = time.perf_counter()
+    with count_syncs(device, counter):
+        for step in range(args.steps):
+            for _ in range(args.gradient_accumulation_steps):
+                loss = train_step(model, device)
+                metrics.add_loss(loss)
+
+            grad_norm = nn.utils.clip_grad_norm_(model.parameters(), 1)
+            optimizer.step()
+            optimizer.zero_grad()
+
+            metrics.finish_update_step(step, 1e-3, grad_norm)
+            if metrics.needs_flush():
+                metrics.flush()
+        metrics.flush()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+    return counter[0], time.perf_counter() - start_time
+
+
+def main():
+    args = BenchmarkMetricsSyncArgs.parse_args()
+    device = torch.device(args.device)
+
+    for name, run in [("loss.item() loop", run_item_loop), ("metrics accumulator", run_accumulator_loop)]:
+        syncs, duration = run(args, device)
+        print(f"{name}: {syncs} syncs in {args.steps} update steps, {syncs / args.steps:.2f} syncs per update step, "
+              f"{duration / args.steps * 1000:.3f} ms per update step")
+
+
+if __name__ == '__main__':
+    main()
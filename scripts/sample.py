@@ -18,8 +18,13 @@ def main():
     device = torch.device("cuda")
 
     training_method = TrainingMethod.FINE_TUNE
-    if args.embedding_name is not None:
+    extra_model_name = None
+    if args.lora_name is not None:
+        training_method = TrainingMethod.LORA
+        extra_model_name = args.lora_name
+    elif args.embedding_name is not None:
         training_method = TrainingMethod.EMBEDDING
+        extra_model_name = args.embedding_name
 
     model_loader = create.create_model_loader(args.model_type, training_method=training_method)
     model_setup = create.create_model_setup(args.model_type, device, device, training_method=training_method)
@@ -29,10 +34,15 @@ def main():
         args.model_type,
         args.weight_dtypes(),
         args.base_model_name,
-        args.embedding_name
+        extra_model_name
     )
     model_setup.setup_eval_device(model)
 
+    # the LoRA is merged into the model weights, so sampling runs at the speed of the base model
+    for lora in model.loras():
+        lora.hook_to_module()
+        lora.apply_to_module()
+
     model_sampler = create.create_model_sampler(
         model=model,
         model_type=args.model_type,
@@ -3,6 +3,7 @@ import sys
 
 sys.path.append(os.getcwd())
 
+from modules.util import distributed_util
 from modules.util.callbacks.TrainCallbacks import TrainCallbacks
 from modules.util.commands.TrainCommands import TrainCommands
 
@@ -10,8 +11,7 @@ from modules.trainer.GenericTrainer import GenericTrainer
 from modules.util.args.TrainArgs import TrainArgs
 
 
-def main():
-    args = TrainArgs.parse_args()
+def train(args: TrainArgs):
     callbacks = TrainCallbacks()
     commands = TrainCommands()
 
@@ -29,5 +29,14 @@ def main():
         trainer.end()
 
 
+def main():
+    args = TrainArgs.parse_args()
+
+    if args.distributed:
+        distributed_util.launch(train, args.distributed_world_size, args)
+    else:
+        train(args)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,67 @@
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import torch
+
+from modules.module.EMAModule import EMAModuleWrapper
+from modules.util.args.ValidateEMAPrecisionArgs import ValidateEMAPrecisionArgs
+from modules.util.enum.EMAPrecision import EMAPrecision
+
+
+def ema_values(ema: EMAModuleWrapper) -> list[torch.Tensor]:
+    if ema.ema_residuals is None:
+        return [ema_parameter.double() for ema_parameter in ema.ema_parameters]
+    return [
+        ema_parameter.double() + ema_residual.double()
+        for ema_parameter, ema_residual in zip(ema.ema_parameters, ema.ema_residuals)
+    ]
+
+
+def max_error(reference: list[torch.Tensor], values: list[torch.Tensor]) -> float:
+    return max((value - reference_value).abs().max().item() for reference_value, value in zip(reference, values))
+
+
+def main():
+    args = ValidateEMAPrecisionArgs.parse_args()
+    device = torch.device('cpu')
+
+    torch.manual_seed(args.seed)
+    parameters = [torch.nn.Parameter(torch.randn(size)) for size in [(64, 64), (1000,)]]
+
+    # the reference is calculated in float64, the naive EMA stores bfloat16 values without any correction
+    reference = EMAModuleWrapper(parameters, args.decay, device=device)
+    reference.to(device, torch.float64)
+    naive = EMAModuleWrapper(parameters, args.decay, device=device)
+    naive.to(device, torch.bfloat16)
+    emas = {precision: EMAModuleWrapper(parameters, args.decay, device=device, precision=precision)
+            for precision in EMAPrecision}
+
+    for step in range(args.steps):
+        # small updates with a drift, which a bfloat16 EMA with a high decay rounds away
+        for parameter in parameters:
+            parameter.data.add_(torch.randn_like(parameter) * 0.001 + 0.0001)
+        for ema in [reference, naive] + list(emas.values()):
+            ema.step(parameters, step)
+
+    reference_values = ema_values(reference)
+    print(f"max absolute error after {args.steps} steps, compared to a float64 EMA:")
+    print(f"    naive bfloat16: {max_error(reference_values, ema_values(naive)):.3e}")
+    for precision, ema in emas.items():
+        print(f"    {precision}: {max_error(reference_values, ema_values(ema)):.3e}")
+
+    # every state is loaded into every precision, and converted to the data types of that precision
+    print("max absolute error after loading a state into another precision:")
+    for saved_precision, saved_ema in emas.items():
+        state_dict = saved_ema.state_dict()
+        for precision in EMAPrecision:
+            ema = EMAModuleWrapper(parameters, args.decay, device=device, precision=precision)
+            ema.load_state_dict(state_dict)
+            dtype = ema.ema_parameters[0].dtype
+            print(f"    {saved_precision} -> {precision} ({str(dtype).removeprefix('torch.')}): "
+                  f"{max_error(ema_values(saved_ema), ema_values(ema)):.3e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import torch
+from diffusers.models.vae import DiagonalGaussianDistribution
+
+from modules.dataLoader.cache.ShardedDiskCache import ShardedDiskCache
+from modules.util.args.ValidateLatentCacheArgs import ValidateLatentCacheArgs
+
+
+def max_error(reference, value) -> float | None:
+    # compact distributions only store the mean, which is the value used during training
+    if isinstance(reference, DiagonalGaussianDistribution) and isinstance(value, DiagonalGaussianDistribution):
+        reference, value = reference.mode(), value.mode()
+
+    if isinstance(reference, torch.Tensor) and isinstance(value, torch.Tensor):
+        return (reference.float() - value.float()).abs().max().item() if reference.numel() > 0 else 0.0
+    return None
+
+
+def main():
+    args = ValidateLatentCacheArgs.parse_args()
+
+    variation = 0
+    while os.path.isdir(os.path.join(args.reference_cache_dir, f"epoch-{variation}-shards")):
+        # the caches are only read, cached_epochs only needs to include the variation
+        reference_cache = ShardedDiskCache(cache_dir=args.reference_cache_dir, cached_epochs=variation + 1)
+        cache = ShardedDiskCache(cache_dir=args.cache_dir, cached_epochs=variation + 1)
+
+        reference_index = reference_cache.read_index(variation)
+        index = cache.read_index(variation)
+        keys = [key for key in reference_index if key in index]
+
+        errors = {}
+        for key in keys:
+            reference_item = reference_cache.read_entries(*reference_index[key], torch.device('cpu'))
+            item = cache.read_entries(*index[key], torch.device('cpu'))
+            for name, reference_value in reference_item.items():
+                error = max_error(reference_value, item.get(name))
+                if error is not None:
+                    errors[name] = max(errors.get(name, 0.0), error)
+
+        print(f"epoch {variation}: {len(keys)} items compared, {len(reference_index) - len(keys)} items missing")
+        for name, error in errors.items():
+            print(f"    {name}: max absolute error {error}")
+
+        variation += 1
+
+    if variation == 0:
+        print(f"no sharded latent cache found in {args.reference_cache_dir}")
+
+
+if __name__ == '__main__':
+    main()
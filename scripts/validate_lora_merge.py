@@ -0,0 +1,83 @@
+import os
+import sys
+
+sys.path.append(os.getcwd())
+
+import numpy as np
+import torch
+from PIL.Image import Image
+
+from modules.util import create
+from modules.util.args.ValidateLoRAMergeArgs import ValidateLoRAMergeArgs
+from modules.util.enum.ImageFormat import ImageFormat
+from modules.util.enum.TrainingMethod import TrainingMethod
+from modules.util.params.SampleParams import SampleParams
+
+
+def sample(model_sampler, args: ValidateLoRAMergeArgs, destination: str) -> np.ndarray:
+    images = []
+
+    def on_sample(image: Image):
+        images.append(np.asarray(image.convert("RGB"), dtype=np.int16))
+
+    model_sampler.sample(
+        sample_params=SampleParams.default_values().from_dict(
+            {
+                "prompt": args.prompt,
+                "negative_prompt": args.negative_prompt,
+                "height": 512,
+                "width": 512,
+                "seed": args.seed,
+            }
+        ),
+        image_format=ImageFormat.PNG,
+        destination=destination,
+        text_encoder_layer_skip=args.text_encoder_layer_skip,
+        on_sample=on_sample,
+    )
+    return images[0]
+
+
+def main():
+    args = ValidateLoRAMergeArgs.parse_args()
+    device = torch.device("cuda")
+
+    model_loader = create.create_model_loader(args.model_type, training_method=TrainingMethod.LORA)
+    model_setup = create.create_model_setup(args.model_type, device, device, training_method=TrainingMethod.LORA)
+
+    print("Loading model " + args.base_model_name)
+    model = model_loader.load(
+        args.model_type,
+        args.weight_dtypes(),
+        args.base_model_name,
+        args.lora_name,
+    )
+    model_setup.setup_eval_device(model)
+
+    model_sampler = create.create_model_sampler(
+        model=model,
+        model_type=args.model_type,
+        train_device=device
+    )
+
+    for lora in model.loras():
+        lora.hook_to_module()
+    hooked_image = sample(model_sampler, args, os.path.join(args.destination, "hooked.png"))
+
+    for lora in model.loras():
+        lora.apply_to_module()
+    merged_image = sample(model_sampler, args, os.path.join(args.destination, "merged.png"))
+
+    for lora in model.loras():
+        lora.remove_from_module()
+    restored_image = sample(model_sampler, args, os.path.join(args.destination, "restored.png"))
+
+    # merged weights are rounded to the weight dtype, so small differences are expected
+    print(f"merged: max pixel difference {np.abs(merged_image - hooked_image).max()}, "
+          f"mean pixel difference {np.abs(merged_image - hooked_image).mean():.4f}")
+    print(f"restored: max pixel difference {np.abs(restored_image - hooked_image).max()}, "
+          f"mean pixel difference {np.abs(restored_image - hooked_image).mean():.4f}")
+
+
+if __name__ == '__main__':
+    main()